@@ -293,6 +293,7 @@ class FrozenDict(_FrozenDict):
         return "FrozenDict({!r})".format(list(self.items()))
 
 _name_counter = 0
+_name_lock = threading.Lock()
 
 def fresh_name(hint : str = "name", omit : {str} = ()) -> str:
     """Generate a new name.
@@ -303,19 +304,19 @@ def fresh_name(hint : str = "name", omit : {str} = ()) -> str:
 
     The `hint` parameter will be used in the generated name.
 
-    CAUTION:
-     - This procedure is not thread-safe.
-     - Names generated by this procedure are only unique within this process.
-       (This is relevant because names generated in multiprocessing jobs might
-       overlap with each other and with names generated by the parent process.)
+    CAUTION: names generated by this procedure are only unique within this
+    process.  (This is relevant because names generated in multiprocessing
+    jobs might overlap with each other and with names generated by the parent
+    process.)
     """
     global _name_counter
-    name = None
-    i = _name_counter
-    while name is None or name in omit:
-        name = "_{}{}".format(hint, i)
-        i += 1
-    _name_counter = i
+    with _name_lock:
+        name = None
+        i = _name_counter
+        while name is None or name in omit:
+            name = "_{}{}".format(hint, i)
+            i += 1
+        _name_counter = i
     return name
 
 def capitalize(s):
@@ -48,14 +48,15 @@ from cozy.common import OrderedSet, unique, Visitor, save_property
 from cozy.syntax import TFunc, TBag, Exp, EVar, EAll, ESingleton
 from cozy.target_syntax import EDeepIn
 from cozy.evaluation import eval
-from cozy.syntax_tools import pprint, alpha_equivalent, free_vars, subst, BottomUpRewriter
+from cozy.syntax_tools import pprint, alpha_equivalent, free_vars, subst, BottomUpRewriter, Aeq
 from cozy.pools import Pool, RUNTIME_POOL, STATE_POOL
 
 class Context(object):
     """A Context describes each variable in the environment.
 
     A Context is hashable and comparable---but note that equality (==) is
-    stricter than alpha equivalence (see `Context.alpha_equivalent`).
+    stricter than alpha equivalence (see `Context.alpha_equivalent`).  Use
+    `Context.canonical_key` to hash contexts up to alpha equivalence.
     """
 
     def vars(self) -> {(EVar, Pool)}:
@@ -126,6 +127,21 @@ class Context(object):
         """
         raise NotImplementedError()
 
+    def canonical_key(self):
+        """Return a hashable key that is invariant under alpha renaming.
+
+        Alpha-equivalent contexts have equal keys, so clients can find an
+        alpha-equivalent context with a dictionary lookup instead of calling
+        `alpha_equivalent` on every candidate.  The converse is not
+        guaranteed: clients that need exact alpha equivalence should confirm
+        a match with `alpha_equivalent`.
+        """
+        raise NotImplementedError()
+
+    def _canonical_binders(self) -> {str:EVar}:
+        """Map each binder in this context to a name that depends only on its depth."""
+        raise NotImplementedError()
+
     def adapt(self, e : Exp, ctx, e_fvs : {EVar} = None) -> Exp:
         """
         If expression `e` is legal in context `ctx` and this context is
@@ -180,6 +196,10 @@ class RootCtx(Context):
         return examples
     def alpha_equivalent(self, other):
         return self == other
+    def canonical_key(self):
+        return (tuple(self.state_vars), tuple(self.args))
+    def _canonical_binders(self):
+        return {}
     def adapt(self, e : Exp, ctx, e_fvs=None) -> Exp:
         if self == ctx:
             return e
@@ -221,6 +241,7 @@ class UnderBinder(Context):
         self.var = v
         self.bag = bag
         self.pool = bag_pool
+        self._canonical_key = None
     def vars(self):
         return self._parent.vars() | {(self.var, self.pool)}
     def funcs(self):
@@ -247,6 +268,16 @@ class UnderBinder(Context):
         if not self._parent.alpha_equivalent(other._parent):
             return False
         return alpha_equivalent(self.bag, self._parent.adapt(other.bag, other._parent))
+    def canonical_key(self):
+        if self._canonical_key is None:
+            renaming = self._parent._canonical_binders()
+            bag = subst(self.bag, renaming) if renaming else self.bag
+            self._canonical_key = (self._parent.canonical_key(), self.pool, self.var.type, Aeq(bag))
+        return self._canonical_key
+    def _canonical_binders(self):
+        renaming = self._parent._canonical_binders()
+        renaming[self.var.id] = EVar("_binder{}".format(len(renaming))).with_type(self.var.type)
+        return renaming
     def adapt(self, e : Exp, ctx, e_fvs=None) -> Exp:
         if self == ctx:
             return e
@@ -3,18 +3,147 @@
 Important functions:
  - eval: execute an expression in an environment
  - eval_bulk: execute the same expression in many different environments
+ - compile_columns: prepare an expression for repeated calls on many
+   environments stored column-by-column
+ - compiled_programs: the cache of compiled expressions used by eval_bulk
+ - MemoizingEvaluator: evaluate many expressions on one list of inputs,
+   sharing the work for common subexpressions
+
+There are two ways to execute an expression.  By default, expressions are
+compiled to nested Python closures (see `_compile_closure`).  The original
+stack machine (see `_compile` and `_eval_compiled`) is slower but simpler; it
+is used with --stack-evaluator and serves as a reference implementation.
+
+When an expression is evaluated in many environments at once, its scalar
+parts (arithmetic, comparisons, boolean connectives, and conditionals) are
+evaluated a whole column of values at a time (see `_compile_columnar`).
 """
 
-from functools import cmp_to_key, lru_cache
+from collections import OrderedDict
+from functools import lru_cache
 import itertools
+import operator
+import threading
 from fractions import Fraction
 
 from cozy.target_syntax import *
 from cozy.syntax_tools import pprint, free_vars, free_funcs, purify
-from cozy.common import FrozenDict, OrderedSet, extend, unique
+from cozy.common import ADT, FrozenDict, OrderedSet, extend, unique
 from cozy.typecheck import is_numeric, is_collection
 from cozy.structures import extension_handler
-from cozy.value_types import Map, Bag, Handle, compare_values, values_equal, LT, EQ, GT
+from cozy.value_types import Map, Bag, Handle, compare_values, comparator, values_equal, equality_key, has_native_equality, LT, EQ, GT
+from cozy.opts import Option
+
+stack_evaluator = Option("stack-evaluator", bool, False,
+    description="Evaluate expressions with the reference stack machine "
+        + "instead of compiling them to Python closures.  This is slower.")
+eval_cache_size = Option("eval-cache-size", int, 4096,
+    description="Number of compiled expressions to keep for eval_bulk.  "
+        + "Use 0 to compile every expression afresh.")
+subexpression_cache_size = Option("subexpression-cache-size", int, 100000,
+    description="Number of subexpression outputs that each "
+        + "MemoizingEvaluator remembers.  Use 0 to disable memoization.")
+
+class ProgramCache(object):
+    """An LRU cache of compiled programs for `eval_bulk`.
+
+    Programs are keyed by `_program_key`, so expressions that differ only in
+    the names of their bound variables share an entry.  The `hits` and
+    `misses` counters record how well the cache is doing.
+
+    Compiled programs keep the values of bound variables in mutable cells
+    while they run, so they must not run on two threads at once.  Each thread
+    therefore has its own table of programs.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def programs(self):
+        programs = getattr(self._local, "programs", None)
+        if programs is None:
+            programs = self._local.programs = OrderedDict() # key -> (vars, types, function)
+        return programs
+
+    def lookup(self, e : Exp):
+        capacity = eval_cache_size.value
+        if capacity <= 0:
+            self.misses += 1
+            return _compile_program(e)
+        key = (_program_key(e), stack_evaluator.value)
+        programs = self.programs
+        res = programs.get(key)
+        if res is not None:
+            self.hits += 1
+            programs.move_to_end(key)
+            return res
+        self.misses += 1
+        res = _compile_program(e)
+        programs[key] = res
+        while len(programs) > capacity:
+            programs.popitem(last=False)
+        return res
+
+    def clear(self):
+        self.programs.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.programs)
+
+compiled_programs = ProgramCache()
+
+def _program_key(e : Exp):
+    """A hashable key that identifies how `e` compiles.
+
+    Unlike equality on expressions, the key includes the type of every node,
+    since the compiled code depends on them; lists (which appear in some types)
+    become tuples.  Variables bound by lambdas are replaced by their binding
+    depth.
+    """
+    binders = { }
+    def key(x, depth):
+        if isinstance(x, EVar):
+            return (EVar, binders.get(x.id, x.id), key(getattr(x, "type", None), depth))
+        if isinstance(x, ELambda):
+            with extend(binders, x.arg.id, depth):
+                return (ELambda, key(x.arg.type, depth), key(x.body, depth + 1))
+        if isinstance(x, ADT):
+            return (type(x), key(getattr(x, "type", None), depth)) + tuple(key(c, depth) for c in x.children())
+        if isinstance(x, (tuple, list)):
+            return (tuple,) + tuple(key(c, depth) for c in x)
+        return (type(x), x)
+    return key(e, 0)
+
+def _compile_program(e : Exp):
+    """Compile `e` for `eval_bulk`.
+
+    Returns (vars, types, f) where `vars` are the names of the free variables
+    and functions of `e`, `types` maps free variable names to their types, and
+    `f` evaluates `e` on a list of environments, each given as a list of values
+    for `vars`.
+    """
+    e = purify(e)
+    types = { v.id : v.type for v in free_vars(e) }
+    vars = tuple(OrderedSet(itertools.chain(types.keys(), free_funcs(e).keys())))
+    vmap = { v : i for (i, v) in enumerate(vars) }
+    return (vars, types, _compile_rows(e, vmap))
+
+def _compile_rows(e : Exp, vmap : {str:int}):
+    if stack_evaluator.value:
+        ops = []
+        _compile(e, vmap, ops)
+        return lambda envs: [_eval_compiled(ops, env) for env in envs]
+    g = _compile_columnar(e, vmap)
+    if g is not None:
+        g = g[0]
+        return lambda envs: list(g(list(zip(*envs)), len(envs))) if envs else []
+    f = _compile_closure(e, vmap)
+    return lambda envs: [f(env) for env in envs]
 
 def eval(e : Exp, env : {str:object}, *args, **kwargs):
     """Evaluate an expression in an environment.
@@ -48,16 +177,15 @@ def eval_bulk(
 
     However, using `eval_bulk` is much faster than repeatedly calling `eval` on
     the same expression.
+
+    Compiled expressions are kept in `compiled_programs`, so evaluating the
+    same expression again does not compile it again.
     """
 
     if not envs:
         return []
 
-    e = purify(e)
-    ops = []
-    types = { v.id : v.type for v in free_vars(e) }
-    vars = OrderedSet(itertools.chain(types.keys(), free_funcs(e).keys()))
-    vmap = { v : i for (i, v) in enumerate(vars) }
+    vars, types, f = compiled_programs.lookup(e)
 
     try:
         envs = [ [(env.get(v, mkval(types[v])) if (use_default_values_for_undefined_vars and v in types) else env[v]) for v in vars] for env in envs ]
@@ -67,8 +195,129 @@ def eval_bulk(
         print("e = {}".format(pprint(e)), file=sys.stderr)
         print("eval_bulk({!r}, {!r}, use_default_values_for_undefined_vars={!r})".format(e, envs, use_default_values_for_undefined_vars), file=sys.stderr)
         raise
-    _compile(e, vmap, ops)
-    return [_eval_compiled(ops, env) for env in envs]
+    return f(envs)
+
+def compile_columns(e : Exp, vars : [str]):
+    """Compile an expression for evaluation on inputs stored as columns.
+
+    The free variables and functions of `e` must all be named in `vars`.
+    The returned function takes a list of columns, one for each of `vars`
+    (in order), and the number of rows n.
+    Each column holds that variable's values in all n environments.  The
+    function returns the list of n results.
+    """
+    e = purify(e)
+    vmap = { v : i for (i, v) in enumerate(vars) }
+    if not stack_evaluator.value:
+        g = _compile_columns(e, vmap)
+        return lambda cols, n: list(g(cols, n))
+    f = _compile_rows(e, vmap)
+    return lambda cols, n: f(list(_rows(cols, n)))
+
+class MemoizingEvaluator(object):
+    """Evaluates many expressions on one fixed list of inputs.
+
+    The outputs of subexpressions are remembered by structural key (see
+    `_program_key`), so expressions that share subtrees evaluate each shared
+    subtree once rather than once per expression.  Only the top-level operator
+    of a new expression is evaluated; its children are replaced by variables
+    bound to their remembered outputs.
+
+    Children that the evaluator would only look at on some inputs (the
+    branches of a conditional, the right side of a short-circuiting boolean
+    operator, and the bodies of lambdas) are evaluated as part of their
+    parent.
+
+    At most `subexpression_cache_size` outputs are kept; the least recently
+    used are forgotten first.  The `hits` and `misses` counters record how
+    well the cache is doing.
+    """
+
+    def __init__(self, inputs : [{str:object}]):
+        self.inputs = list(inputs)
+        self.outputs = OrderedDict() # key -> tuple of outputs
+        self.compiled = { }          # key -> (vars, compiled top-level operator)
+        self.columns = { }           # var name -> column of its values
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def eval(self, e : Exp) -> tuple:
+        """Evaluate `e` on every input.
+
+        Equivalent to `tuple(eval_bulk(e, self.inputs))`.
+        """
+        key = _program_key(e)
+        res = self.outputs.get(key)
+        if res is not None:
+            self.hits += 1
+            self.outputs.move_to_end(key)
+            return res
+        self.misses += 1
+        res = self._eval_top(e)
+        self._store(key, res)
+        return res
+
+    def remember(self, e : Exp, outputs : [object]):
+        """Record the outputs of `e` on every input, computed elsewhere."""
+        assert len(outputs) == len(self.inputs)
+        self._store(_program_key(e), tuple(outputs))
+
+    def _store(self, key, outputs):
+        capacity = subexpression_cache_size.value
+        if capacity <= 0:
+            return
+        self.outputs[key] = outputs
+        self.outputs.move_to_end(key)
+        while len(self.outputs) > capacity:
+            self.outputs.popitem(last=False)
+
+    def _column(self, name):
+        col = self.columns.get(name)
+        if col is None:
+            col = [inp[name] for inp in self.inputs]
+            self.columns[name] = col
+        return col
+
+    def _eval_top(self, e):
+        new_children = []
+        child_outputs = []
+        for i, c in enumerate(e.children()):
+            if _memoizable_child(e, i, c):
+                v = EVar("_child{}".format(len(child_outputs))).with_type(c.type)
+                new_children.append(v)
+                child_outputs.append(self.eval(c))
+            else:
+                new_children.append(c)
+        shell = type(e)(*new_children).with_type(e.type) if child_outputs else e
+
+        key = _program_key(shell)
+        res = self.compiled.get(key)
+        if res is None:
+            child_names = ["_child{}".format(i) for i in range(len(child_outputs))]
+            vars = tuple(OrderedSet(itertools.chain(
+                child_names,
+                (v.id for v in free_vars(shell)),
+                free_funcs(shell).keys())))
+            res = (vars[len(child_names):], compile_columns(shell, vars))
+            self.compiled[key] = res
+        vars, f = res
+        return tuple(f(child_outputs + [self._column(v) for v in vars], len(self.inputs)))
+
+def _memoizable_child(e : Exp, i : int, c) -> bool:
+    """Should MemoizingEvaluator evaluate child `c` (the `i`th child of `e`) on its own?"""
+    if not isinstance(c, Exp) or isinstance(c, EVar) or isinstance(c, ELambda):
+        return False
+    if not any(isinstance(cc, Exp) for cc in c.children()):
+        # literals are cheaper to evaluate than to look up
+        return False
+    if isinstance(e, ECond):
+        return i == 0
+    if isinstance(e, EBinOp) and e.op in (BOp.And, BOp.Or, "=>"):
+        return i == 0
+    return True
 
 @lru_cache(maxsize=None)
 def mkval(type : Type):
@@ -202,10 +451,11 @@ def read_map(stk):
     stk.append(m[k])
 
 def has_key(key_type):
+    # Maps index their keys, so the key type is not needed here
     def _has_key(stk):
         k = stk.pop()
         m = stk.pop()
-        stk.append(any(values_equal(key_type, k, kk) for kk in m.keys()))
+        stk.append(k in m)
     return _has_key
 
 def read_map_keys(stk):
@@ -236,30 +486,69 @@ def binaryop_sub(stk):
     v1 = stk.pop()
     stk.append(v1 - v2)
 
+def _key_function(t):
+    """A function mapping values of type t to their `equality_key`."""
+    if has_native_equality(t):
+        return lambda v: v
+    return lambda v: equality_key(t, v)
+
+def _subtract(key, v1, v2):
+    """Remove the first occurrence of each element of v2 from v1.
+
+    Returns a list of the remaining elements of v1, in order.  Elements are
+    matched by `key`.
+    """
+    if not v2:
+        return list(v1)
+    counts = { }
+    for x in v2:
+        k = key(x)
+        counts[k] = counts.get(k, 0) + 1
+    res = []
+    for x in v1:
+        k = key(x)
+        n = counts.get(k)
+        if n:
+            counts[k] = n - 1
+        else:
+            res.append(x)
+    return res
+
+# Collections with at most this many elements are scanned by membership
+# tests; hashing their elements would cost more than it saves.
+_SMALL_COLLECTION = 8
+
+def _membership(elem_type):
+    """Build a function that tests whether a value is in a collection.
+
+    Small collections and lists are scanned.  Larger bags are tested against
+    their key sets (see `Bag.key_set`), which each bag builds once, so testing
+    many values against the same bag (as when a lambda body tests "x in ys"
+    for each x) does not scan it again and again.
+    """
+    native = has_native_equality(elem_type)
+    def contains(x, xs):
+        if isinstance(xs, Bag) and len(xs) > _SMALL_COLLECTION:
+            return equality_key(elem_type, x) in xs.key_set(elem_type)
+        if native:
+            return x in xs
+        return any(values_equal(elem_type, x, y) for y in xs)
+    return contains
+
 def binaryop_sub_bags(elem_type):
+    key = _key_function(elem_type)
     def binaryop_sub_bags(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        elems = list(v1)
-        for x in v2:
-            for i in range(len(elems)):
-                if values_equal(elem_type, x, elems[i]):
-                    del elems[i]
-                    break
-        stk.append(Bag(elems))
+        stk.append(Bag(_subtract(key, v1, v2)))
     return binaryop_sub_bags
 
 def binaryop_sub_lists(elem_type):
+    key = _key_function(elem_type)
     def binaryop_sub_lists(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        elems = list(v1)
-        for x in v2:
-            for i in range(len(elems)):
-                if values_equal(elem_type, x, elems[i]):
-                    del elems[i]
-                    break
-        stk.append(tuple(elems))
+        stk.append(tuple(_subtract(key, v1, v2)))
     return binaryop_sub_lists
 
 def binaryop_eq(t, deep=False):
@@ -305,10 +594,11 @@ def binaryop_ge(t):
     return binaryop_ge
 
 def binaryop_in(elem_type):
+    contains = _membership(elem_type)
     def binaryop_in(stk):
         v2 = stk.pop()
         v1 = stk.pop()
-        stk.append(any(values_equal(elem_type, v1, v2elem) for v2elem in v2))
+        stk.append(contains(v1, v2))
     return binaryop_in
 
 def unaryop_not(stk):
@@ -333,24 +623,30 @@ def unaryop_neg(stk):
     stk.append(-stk.pop())
 
 def unaryop_areunique(elem_type):
-    keyfunc = cmp_to_key(lambda v1, v2: compare_values(elem_type, v1, v2))
+    key = _key_function(elem_type)
     def unaryop_areunique(stk):
         v = stk.pop()
-        l = sorted(v, key=keyfunc)
+        seen = set()
         res = True
-        for i in range(len(l) - 1):
-            if values_equal(elem_type, l[i], l[i+1]):
+        for x in v:
+            k = key(x)
+            if k in seen:
                 res = False
                 break
+            seen.add(k)
         stk.append(res)
     return unaryop_areunique
 
 def unaryop_distinct(elem_type):
+    key = _key_function(elem_type)
     def unaryop_distinct(stk):
         v = stk.pop()
+        seen = set()
         res = []
         for x in v:
-            if not any(values_equal(elem_type, x, y) for y in res):
+            k = key(x)
+            if k not in seen:
+                seen.add(k)
                 res.append(x)
         stk.append(Bag(res))
     return unaryop_distinct
@@ -689,10 +985,7 @@ def _compile(e, env : {str:int}, out):
         _compile(EMap(e.e, ELambda(e.value_function.arg, ETuple((e.value_function.arg, e.value_function.body)).with_type(TTuple((e.value_function.arg.type, e.value_function.body.type))))).with_type(TBag(TTuple((e.value_function.arg.type, e.value_function.body.type)))), env, out)
         default = mkval(e.type.v)
         def make_map(stk):
-            res = Map(e.type, default)
-            for (k, v) in list(stk.pop()):
-                res[k] = v
-            stk.append(res)
+            stk.append(Map(e.type, default, list(stk.pop())))
         out.append(make_map)
     elif isinstance(e, EMapGet):
         _compile(e.map, env, out)
@@ -743,3 +1036,431 @@ def _compile(e, env : {str:int}, out):
             raise NotImplementedError(type(e))
     if hasattr(e, "type") and isinstance(e.type, TList):
         out.append(iterable_to_list)
+
+def _compile_closure(e, env : {str:object}):
+    """Compile an expression to a Python function.
+
+    This is an alternative to `_compile`.  Instead of a list of stack
+    operations, it produces a single function that takes a list of values for
+    the variables in `env` and returns the value of `e`.  Each subexpression
+    becomes a closure that calls the closures for its children directly, so
+    evaluation does not need to maintain an explicit stack or build new lists
+    of operations for every element of a collection.
+
+    The `env` maps each free variable's name to its index in the list of
+    values.  Variables bound by lambdas are mapped to a one-element list
+    ("box") that holds the current value of the variable.
+
+    The two compilers must agree on every expression; see
+    tests/evaluation.py.
+    """
+    f = _compile_closure_core(e, env)
+    if hasattr(e, "type") and isinstance(e.type, TList):
+        ff = f
+        f = lambda vals: tuple(ff(vals))
+    return f
+
+def _compile_closure_core(e, env):
+    if isinstance(e, EVar):
+        i = env[e.id]
+        if isinstance(i, int):
+            return lambda vals: vals[i]
+        return lambda vals: i[0]
+    elif isinstance(e, EBool):
+        v = bool(e.val)
+        return lambda vals: v
+    elif isinstance(e, ENum):
+        s = e.val
+        if e.type == FLOAT:
+            s = Fraction(str(s))
+        return lambda vals: s
+    elif isinstance(e, EStr):
+        s = e.val
+        return lambda vals: s
+    elif isinstance(e, EEnumEntry):
+        s = e.name
+        return lambda vals: s
+    elif isinstance(e, EEmptyList):
+        return lambda vals: _EMPTY_BAG
+    elif isinstance(e, ESingleton):
+        f = _compile_closure(e.e, env)
+        if isinstance(e.type, TList):
+            return lambda vals: (f(vals),)
+        return lambda vals: Bag((f(vals),))
+    elif isinstance(e, EHandle):
+        addr = _compile_closure(e.addr, env)
+        value = _compile_closure(e.value, env)
+        return lambda vals: Handle(addr(vals), value(vals))
+    elif isinstance(e, ENull):
+        return lambda vals: None
+    elif isinstance(e, ECond):
+        cond = _compile_closure(e.cond, env)
+        then_branch = _compile_closure(e.then_branch, env)
+        else_branch = _compile_closure(e.else_branch, env)
+        return lambda vals: then_branch(vals) if cond(vals) else else_branch(vals)
+    elif isinstance(e, EMakeRecord):
+        # NOTE: the stack machine builds records with their fields in reverse
+        # order; do the same so that the two backends agree exactly.
+        fields = tuple(reversed([(f, _compile_closure(ee, env)) for (f, ee) in e.fields]))
+        return lambda vals: FrozenDict((f, ff(vals)) for (f, ff) in fields)
+    elif isinstance(e, EGetField):
+        f = _compile_closure(e.e, env)
+        if isinstance(e.e.type, THandle):
+            assert e.field_name == "val"
+            return lambda vals: f(vals).value
+        assert isinstance(e.e.type, TRecord)
+        field_name = e.field_name
+        return lambda vals: f(vals)[field_name]
+    elif isinstance(e, ETuple):
+        fs = tuple(_compile_closure(ee, env) for ee in e.es)
+        return lambda vals: tuple(f(vals) for f in fs)
+    elif isinstance(e, ETupleGet):
+        f = _compile_closure(e.e, env)
+        index = e.index
+        return lambda vals: f(vals)[index]
+    elif isinstance(e, EStateVar):
+        return _compile_closure(e.e, env)
+    elif isinstance(e, ENative):
+        f = _compile_closure(e.e, env)
+        name = e.type.name
+        return lambda vals: (name, f(vals))
+    elif isinstance(e, EUnaryOp):
+        f = _compile_closure(e.e, env)
+        if e.op == UOp.Not:
+            return lambda vals: not f(vals)
+        elif e.op == UOp.Sum:
+            return lambda vals: sum(f(vals))
+        elif e.op == UOp.Exists:
+            return lambda vals: bool(f(vals))
+        elif e.op == UOp.Empty:
+            return lambda vals: not f(vals)
+        elif e.op == UOp.All:
+            return lambda vals: all(f(vals))
+        elif e.op == UOp.Any:
+            return lambda vals: any(f(vals))
+        elif e.op == UOp.Length:
+            return lambda vals: len(f(vals))
+        elif e.op in (UOp.AreUnique, UOp.Distinct):
+            # reuse the stack operation on a one-element stack
+            op = (unaryop_areunique if e.op == UOp.AreUnique else unaryop_distinct)(e.e.type.elem_type)
+            def run_op(vals):
+                stk = [f(vals)]
+                op(stk)
+                return stk[0]
+            return run_op
+        elif e.op == UOp.The:
+            default = mkval(e.type)
+            def the(vals):
+                v = f(vals)
+                return v[0] if v else default
+            return the
+        elif e.op == UOp.Reversed:
+            return lambda vals: tuple(reversed(f(vals)))
+        elif e.op == "-":
+            return lambda vals: -f(vals)
+        else:
+            raise NotImplementedError(e.op)
+    elif isinstance(e, EBinOp):
+        if e.op == BOp.And:
+            return _compile_closure(ECond(e.e1, e.e2, EFALSE).with_type(BOOL), env)
+        elif e.op == BOp.Or:
+            return _compile_closure(ECond(e.e1, ETRUE, e.e2).with_type(BOOL), env)
+        elif e.op == "=>":
+            return _compile_closure(ECond(e.e1, e.e2, ETRUE).with_type(BOOL), env)
+        f1 = _compile_closure(e.e1, env)
+        f2 = _compile_closure(e.e2, env)
+        e1type = e.e1.type
+        if e.op == "+":
+            if isinstance(e.type, TSet):
+                return lambda vals: Bag(unique(itertools.chain(f1(vals), f2(vals))))
+            elif is_collection(e.type):
+                return lambda vals: Bag(itertools.chain(f1(vals), f2(vals)))
+            return lambda vals: f1(vals) + f2(vals)
+        elif e.op == "*":
+            return lambda vals: f1(vals) * f2(vals)
+        elif e.op == "-":
+            if isinstance(e.type, TBag) or isinstance(e.type, TSet) or isinstance(e.type, TList):
+                op = (binaryop_sub_lists if isinstance(e.type, TList) else binaryop_sub_bags)(e.type.elem_type)
+                def run_op(vals):
+                    stk = [f1(vals), f2(vals)]
+                    op(stk)
+                    return stk[0]
+                return run_op
+            return lambda vals: f1(vals) - f2(vals)
+        elif e.op == "==":
+            compare = comparator(e1type)
+            return lambda vals: compare(f1(vals), f2(vals)) == EQ
+        elif e.op == "===":
+            compare = comparator(e1type, deep=True)
+            return lambda vals: compare(f1(vals), f2(vals)) == EQ
+        elif e.op == "<":
+            compare = comparator(e1type)
+            return lambda vals: compare(f1(vals), f2(vals)) == LT
+        elif e.op == ">":
+            compare = comparator(e1type)
+            return lambda vals: compare(f1(vals), f2(vals)) == GT
+        elif e.op == "<=":
+            compare = comparator(e1type)
+            return lambda vals: compare(f1(vals), f2(vals)) != GT
+        elif e.op == ">=":
+            compare = comparator(e1type)
+            return lambda vals: compare(f1(vals), f2(vals)) != LT
+        elif e.op == "!=":
+            compare = comparator(e1type)
+            return lambda vals: compare(f1(vals), f2(vals)) != EQ
+        elif e.op == BOp.In:
+            contains = _membership(e1type)
+            return lambda vals: contains(f1(vals), f2(vals))
+        else:
+            raise NotImplementedError(e.op)
+    elif isinstance(e, EListGet):
+        f = _compile_closure(e.e, env)
+        index = _compile_closure(e.index, env)
+        default = mkval(e.type)
+        def list_get(vals):
+            l = f(vals)
+            i = index(vals)
+            return l[i] if i >= 0 and i < len(l) else default
+        return list_get
+    elif isinstance(e, EListSlice):
+        f = _compile_closure(e.e, env)
+        start = _compile_closure(e.start, env)
+        end = _compile_closure(e.end, env)
+        def slice_list(vals):
+            l = f(vals)
+            s = max(start(vals), 0)
+            return l[s:max(end(vals), 0)]
+        return slice_list
+    elif isinstance(e, EDropFront):
+        f = _compile_closure(e.e, env)
+        return lambda vals: f(vals)[1:]
+    elif isinstance(e, EDropBack):
+        f = _compile_closure(e.e, env)
+        return lambda vals: f(vals)[:-1]
+    elif isinstance(e, ESorted):
+        f = _compile_closure(e.e, env)
+        asc = _compile_closure(e.asc, env)
+        def bag_sort(vals):
+            bag = f(vals)
+            return sorted(bag, reverse=not asc(vals))
+        return bag_sort
+    elif isinstance(e, EFilter):
+        f = _compile_closure(e.e, env)
+        box = [None]
+        with extend(env, e.predicate.arg.id, box):
+            pred = _compile_closure(e.predicate.body, env)
+        def do_filter(vals):
+            res = []
+            for x in f(vals):
+                box[0] = x
+                if pred(vals):
+                    res.append(x)
+            return Bag(res)
+        return do_filter
+    elif isinstance(e, EMap) or isinstance(e, EFlatMap):
+        f = _compile_closure(e.e, env)
+        box = [None]
+        with extend(env, e.transform_function.arg.id, box):
+            body = _compile_closure(e.transform_function.body, env)
+        if isinstance(e, EMap):
+            def do_map(vals):
+                res = []
+                for x in f(vals):
+                    box[0] = x
+                    res.append(body(vals))
+                return Bag(res)
+            return do_map
+        def do_flatmap(vals):
+            res = []
+            for x in f(vals):
+                box[0] = x
+                res.extend(body(vals))
+            return Bag(res)
+        return do_flatmap
+    elif isinstance(e, EArgMin) or isinstance(e, EArgMax):
+        f = _compile_closure(e.e, env)
+        box = [None]
+        with extend(env, e.key_function.arg.id, box):
+            key = _compile_closure(e.key_function.body, env)
+        keytype = e.key_function.body.type
+        compare_keys = comparator(keytype)
+        better = LT if isinstance(e, EArgMin) else GT
+        default = mkval(e.type)
+        def argbest(vals):
+            best = default
+            best_key = None
+            first = True
+            for x in f(vals):
+                box[0] = x
+                k = key(vals)
+                if first or compare_keys(k, best_key) == better:
+                    best = x
+                    best_key = k
+                    first = False
+            return best
+        return argbest
+    elif isinstance(e, EMakeMap2):
+        f = _compile_closure(e.e, env)
+        box = [None]
+        with extend(env, e.value_function.arg.id, box):
+            value = _compile_closure(e.value_function.body, env)
+        t = e.type
+        default = mkval(t.v)
+        def make_map(vals):
+            items = []
+            for k in list(f(vals)):
+                box[0] = k
+                items.append((k, value(vals)))
+            return Map(t, default, items)
+        return make_map
+    elif isinstance(e, EMapGet):
+        m = _compile_closure(e.map, env)
+        k = _compile_closure(e.key, env)
+        return lambda vals: m(vals)[k(vals)]
+    elif isinstance(e, EHasKey):
+        m = _compile_closure(e.map, env)
+        k = _compile_closure(e.key, env)
+        return lambda vals: k(vals) in m(vals)
+    elif isinstance(e, EMapKeys):
+        f = _compile_closure(e.e, env)
+        return lambda vals: Bag(f(vals).keys())
+    elif isinstance(e, ECall):
+        func = _compile_closure(EVar(e.func), env)
+        args = tuple(_compile_closure(a, env) for a in e.args)
+        return lambda vals: func(vals)(*[a(vals) for a in args])
+    elif isinstance(e, ELet):
+        f = _compile_closure(e.e, env)
+        box = [None]
+        with extend(env, e.body_function.arg.id, box):
+            body = _compile_closure(e.body_function.body, env)
+        def let(vals):
+            box[0] = f(vals)
+            return body(vals)
+        return let
+    else:
+        from cozy.structures.treemultiset import ETreeMultisetElems
+        h = extension_handler(type(e))
+        if h is not None:
+            if isinstance(e, ETreeMultisetElems) and isinstance(e.e, EVar):
+                # the argument, the Treeset, is sorted already
+                return _compile_closure(e.e, env)
+            return _compile_closure(h.encode(e), env)
+        raise NotImplementedError(type(e))
+
+_COLUMNAR_ARITHMETIC = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul }
+
+_COLUMNAR_COMPARISONS = {
+    "==":  operator.eq,
+    "===": operator.eq,
+    "!=":  operator.ne,
+    "<":   operator.lt,
+    ">":   operator.gt,
+    "<=":  operator.le,
+    ">=":  operator.ge }
+
+def _rows(cols, n):
+    return zip(*cols) if cols else itertools.repeat((), n)
+
+def _compile_columns(e, env):
+    """Compile an expression to run on columns of values.
+
+    The result takes a list of columns (indexed like `env`) and the number of
+    rows, and returns a column of results.  Subexpressions that have no
+    column-wise implementation are evaluated row by row.
+    """
+    return _compile_columns_core(e, env)[0]
+
+def _compile_columns_core(e, env):
+    """Like `_compile_columns`, but returns a pair (f, columnar).
+
+    The flag `columnar` is true if all of `e` is evaluated column-wise.  Such
+    expressions cannot fail on well-typed inputs, so it is safe to evaluate
+    them in environments where their values are not needed.
+    """
+    res = _compile_columnar(e, env)
+    if res is None:
+        f = _compile_closure(e, env)
+        return (lambda cols, n: [f(row) for row in _rows(cols, n)], False)
+    return res
+
+def _compile_columnar(e, env):
+    """Column-wise compilation of the top-level node of `e`.
+
+    Returns None if the node has no column-wise implementation, or a pair
+    (f, columnar) as described in `_compile_columns_core`.  Values of scalar
+    types are Python ints, bools, strings, and Fractions, for which Python's
+    operators agree with `compare_values`.  Conditionals evaluate a branch that
+    might fail only on the rows that select it, as the other backends do.
+    """
+    if isinstance(e, EVar):
+        i = env.get(e.id)
+        if not isinstance(i, int):
+            return None
+        return (lambda cols, n: cols[i], True)
+    elif isinstance(e, EBool) or isinstance(e, ENum) or isinstance(e, EStr) or isinstance(e, EEnumEntry):
+        v = _compile_closure(e, env)(())
+        return (lambda cols, n: [v] * n, True)
+    elif isinstance(e, EStateVar):
+        return _compile_columnar(e.e, env)
+    elif isinstance(e, ECond):
+        cond, c1 = _compile_columns_core(e.cond, env)
+        then_branch, c2 = _compile_columns_core(e.then_branch, env)
+        else_branch, c3 = _compile_columns_core(e.else_branch, env)
+        if c2 and c3:
+            def select(cols, n):
+                return [x if c else y for (c, x, y) in zip(cond(cols, n), then_branch(cols, n), else_branch(cols, n))]
+            return (select, c1)
+        def run_cond(cols, n):
+            c = cond(cols, n)
+            then_rows = [i for (i, x) in enumerate(c) if x]
+            if len(then_rows) == n:
+                return then_branch(cols, n)
+            if not then_rows:
+                return else_branch(cols, n)
+            else_rows = [i for (i, x) in enumerate(c) if not x]
+            res = [None] * n
+            for rows, branch in ((then_rows, then_branch), (else_rows, else_branch)):
+                vals = branch([[col[i] for i in rows] for col in cols], len(rows))
+                for i, v in zip(rows, vals):
+                    res[i] = v
+            return res
+        return (run_cond, False)
+    elif isinstance(e, EUnaryOp):
+        if e.op == UOp.Not:
+            f, c = _compile_columns_core(e.e, env)
+            return (lambda cols, n: [not x for x in f(cols, n)], c)
+        elif e.op == "-" and is_numeric(e.type):
+            f, c = _compile_columns_core(e.e, env)
+            return (lambda cols, n: list(map(operator.neg, f(cols, n))), c)
+    elif isinstance(e, EBinOp):
+        if e.op == BOp.And:
+            return _compile_columnar(ECond(e.e1, e.e2, EFALSE).with_type(BOOL), env)
+        elif e.op == BOp.Or:
+            return _compile_columnar(ECond(e.e1, ETRUE, e.e2).with_type(BOOL), env)
+        elif e.op == "=>":
+            return _compile_columnar(ECond(e.e1, e.e2, ETRUE).with_type(BOOL), env)
+        op = None
+        index = None
+        if e.op in _COLUMNAR_ARITHMETIC and is_numeric(e.type):
+            op = _COLUMNAR_ARITHMETIC[e.op]
+        elif e.op in _COLUMNAR_COMPARISONS:
+            t = e.e1.type
+            if is_numeric(t) or t in (BOOL, STRING):
+                op = _COLUMNAR_COMPARISONS[e.op]
+            elif isinstance(t, TEnum):
+                # enum cases are ordered by their position in the declaration
+                op = _COLUMNAR_COMPARISONS[e.op]
+                index = { case : i for (i, case) in enumerate(t.cases) }
+        if op is None:
+            return None
+        f1, c1 = _compile_columns_core(e.e1, env)
+        f2, c2 = _compile_columns_core(e.e2, env)
+        if index is not None:
+            return (lambda cols, n: list(map(op,
+                [index[x] for x in f1(cols, n)],
+                [index[x] for x in f2(cols, n)])), c1 and c2)
+        return (lambda cols, n: list(map(op, f1(cols, n), f2(cols, n))), c1 and c2)
+    return None
@@ -2,7 +2,10 @@
 
 Important things defined here:
  - Job: an abstract superclass for implementing interruptable tasks
+ - WorkerPool: a set of long-lived processes that can run Jobs without paying
+   for a fresh interpreter start per Job
  - stop_jobs: a function to interrupt some Jobs and wait for them to stop
+ - wait_any: a function to block until a Job finishes or a result arrives
  - SafeQueue: a queue with fewer caveats than multiprocessing.Queue; useful for
    collecting results from many Jobs
 
@@ -22,8 +25,13 @@ the `multiprocessing` module, but its use introduces some caveats:
 """
 
 import os
+import io
+import importlib
 import multiprocessing
-from queue import Queue as PlainQueue, Empty, Full
+from multiprocessing.connection import wait
+from multiprocessing.reduction import ForkingPickler
+import pickle
+from queue import Queue as PlainQueue, Empty
 import threading
 import signal
 
@@ -33,6 +41,14 @@ import cozy.opts as opts
 do_profiling = opts.Option("profile", bool, False, description="Profile Cozy itself")
 
 _interrupted = False
+
+# True in WorkerPool processes; see in_worker_pool.
+_in_worker_pool = False
+
+# Read end of a pipe that becomes readable when SIGINT arrives; see
+# install_graceful_sigint_handler and wait_any.
+_wakeup_fd = None
+
 def _set_interrupt_flag(signal_number, stack_frame):
     global _interrupted
     # print("GOT INTERRUPTED")
@@ -50,8 +66,18 @@ def install_graceful_sigint_handler():
     Job.stop_requested property checks the SIGINT flag in addition to its own
     private flag, giving an additional cross-process way to stop a running job
     gracefully.
+
+    When called from the main thread, this also arranges for SIGINT to wake up
+    any call to `wait_any()`.
     """
+    global _wakeup_fd
     signal.signal(signal.SIGINT, _set_interrupt_flag)
+    if _wakeup_fd is None and threading.current_thread() is threading.main_thread():
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        signal.set_wakeup_fd(w, warn_on_full_buffer=False)
+        _wakeup_fd = r
 
 def was_interrupted():
     """Determine if SIGINT was sent to this process.
@@ -62,6 +88,10 @@ def was_interrupted():
     """
     return _interrupted
 
+def in_worker_pool():
+    """Determine if this process is a WorkerPool worker."""
+    return _in_worker_pool
+
 # This module uses the "spawn" method for multiprocessing interaction.  This is
 # a little bit of forward-compatibility.  The "spawn" context is the default on
 # Windows (always) and MacOS (in Python 3.8+).  It was introduced in Python
@@ -140,25 +170,48 @@ class Job(object):
     # -------------------------------------------------------------------------
 
     def __init__(self):
-        self._thread = multiprocessing_context.Process(target=self._run, daemon=True)
+        self._thread = None
         self._flags = multiprocessing_context.Array("b", [False] * Job._FLAG_COUNT)
 
-    def start(self):
-        """Start the job by invoking its .run() method asynchronously."""
+    def __getstate__(self):
+        # The process handle and the shared flags cannot be pickled; the
+        # process running the job receives its flags separately (see `_run`
+        # and `_worker_main`).
+        d = dict(self.__dict__)
+        d["_thread"] = None
+        d["_flags"] = None
+        return d
+
+    def start(self, pool=None):
+        """Start the job by invoking its .run() method asynchronously.
+
+        If `pool` is None (the default), the job runs in a fresh process.
+        Otherwise `pool` should be a WorkerPool, and the job runs in one of its
+        already-running worker processes.
+        """
         # NOTE: take a snapshot of option values here (as late as possible).
         self._options = opts.snapshot()
-        self._thread.start()
+        if pool is None:
+            self._thread = multiprocessing_context.Process(target=self._run, args=(self._flags,), daemon=True)
+            self._thread.start()
+        else:
+            self._thread = pool._submit(self)
 
     def run(self):
         """Subclasses should override this to implement the Job's behavior."""
         raise NotImplementedError()
 
-    def _run(self):
+    def _run(self, flags):
+        """Private helper that runs the job in a fresh process."""
+        self._flags = flags
+        install_graceful_sigint_handler()
+        self._flags[Job._SIGINT_HANDLER_INSTALLED_FLAG] = True
+        self._execute()
+
+    def _execute(self):
         """Private helper that wraps .run() and sets various exit flags."""
         # NOTE: options are restored from the snapshot taken in self.start().
         opts.restore(self._options)
-        install_graceful_sigint_handler()
-        self._flags[Job._SIGINT_HANDLER_INSTALLED_FLAG] = True
         try:
             if do_profiling.value:
                 import cProfile
@@ -186,7 +239,7 @@ class Job(object):
     @property
     def done(self):
         """True if the job has stopped."""
-        return self._flags[Job._DONE_FLAG] or (self._thread.exitcode is not None)
+        return self._flags[Job._DONE_FLAG] or (self._thread is not None and self._thread.exitcode is not None)
 
     @property
     def successful(self):
@@ -257,7 +310,9 @@ class Job(object):
         """Stop this job forcefully.
 
         This is implemented using the `Process.terminate()` procedure in the
-        `multiprocessing` module.  There are two important caveats:
+        `multiprocessing` module.  If the job is running in a WorkerPool, then
+        its worker process is terminated and the pool will not reuse it.  There
+        are some important caveats:
 
          - Clients should still call .join() afterwards to clean up the Job.
          - If this Job spawned any Jobs of its own that it did not join, then
@@ -270,6 +325,13 @@ class Job(object):
         """
         self._thread.terminate()
 
+    def _sentinels(self):
+        """Objects that become ready (in the sense of
+        `multiprocessing.connection.wait`) when this job finishes."""
+        if isinstance(self._thread, _PooledProcess):
+            return self._thread.sentinels()
+        return [self._thread.sentinel]
+
     @property
     def pid(self):
         """Get the process ID of the process running this Job.
@@ -278,10 +340,251 @@ class Job(object):
         """
         return self._thread.pid
 
+class _SharedObjectPickler(ForkingPickler):
+    """Pickler that replaces a WorkerPool's shared objects with references.
+
+    Objects like multiprocessing queues and Values can only be handed to a
+    process when it is spawned.  A WorkerPool hands its shared objects to each
+    worker at spawn time; this pickler lets Jobs refer to those objects anyway.
+    """
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+    def persistent_id(self, obj):
+        for i, x in enumerate(self.shared):
+            if obj is x:
+                return i
+        return None
+
+class _SharedObjectUnpickler(pickle.Unpickler):
+    """Inverse of _SharedObjectPickler."""
+    def __init__(self, file, shared):
+        super().__init__(file)
+        self.shared = shared
+    def persistent_load(self, pid):
+        return self.shared[pid]
+
+def _worker_main(conn, flags, shared, preload, nice):
+    """Entry point for WorkerPool processes.
+
+    Each message received on `conn` is a pickled Job to run.  An empty message
+    asks the worker to exit.  After each Job, the worker sends an empty message
+    back to indicate that it is ready for more work.
+    """
+    global _interrupted, _in_worker_pool
+    _in_worker_pool = True
+    if nice:
+        os.nice(nice)
+    install_graceful_sigint_handler()
+    flags[Job._SIGINT_HANDLER_INSTALLED_FLAG] = True
+    for module_name in preload:
+        importlib.import_module(module_name)
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except EOFError:
+            return
+        if not data:
+            return
+        job = _SharedObjectUnpickler(io.BytesIO(data), shared).load()
+        # A SIGINT meant for the previous job may have arrived after it
+        # finished.  The parent never reuses a worker before it has joined the
+        # previous job, so it is safe to forget about it here.
+        _interrupted = False
+        job._flags = flags
+        job._execute()
+        del job
+        conn.send_bytes(b"")
+
+class _Worker(object):
+    """A long-lived process owned by a WorkerPool."""
+
+    def __init__(self, shared, preload, nice):
+        self.flags = multiprocessing_context.Array("b", [False] * Job._FLAG_COUNT)
+        self.conn, child_conn = multiprocessing_context.Pipe()
+        self.process = multiprocessing_context.Process(
+            target=_worker_main,
+            args=(child_conn, self.flags, shared, preload, nice),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def shutdown(self):
+        """Ask an idle worker to exit.  Clients should call .join() afterwards."""
+        try:
+            self.conn.send_bytes(b"")
+        except (BrokenPipeError, OSError):
+            pass
+
+    def join(self, timeout=None):
+        self.process.join(timeout=timeout)
+        if self.process.exitcode is not None:
+            self.conn.close()
+
+class _PooledProcess(object):
+    """Stand-in for a multiprocessing.Process when a Job runs in a WorkerPool.
+
+    This class offers the subset of the Process interface that Job uses, but
+    its lifetime is the lifetime of one job rather than of the worker process.
+    """
+
+    def __init__(self, pool, worker, job):
+        self.pool = pool
+        self.worker = worker
+        self.job = job
+        self.finished = False
+
+    @property
+    def pid(self):
+        return self.worker.process.pid
+
+    @property
+    def exitcode(self):
+        if self.finished or self.worker.flags[Job._DONE_FLAG]:
+            return 0
+        return self.worker.process.exitcode
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def terminate(self):
+        self.worker.process.terminate()
+
+    def sentinels(self):
+        # The worker writes to its pipe when the job finishes, and the process
+        # sentinel covers the case where the worker dies mid-job.
+        return [self.worker.conn, self.worker.process.sentinel]
+
+    def join(self, timeout=None):
+        if self.finished:
+            return
+        ready = wait([self.worker.conn, self.worker.process.sentinel], timeout=timeout)
+        if not ready:
+            return
+        if self.worker.conn in ready:
+            try:
+                self.worker.conn.recv_bytes()
+            except EOFError:
+                pass
+        self.finished = True
+        # The worker is about to be reused, so the job needs its own copy of
+        # the final flag values.
+        self.job._flags = list(self.worker.flags)
+        self.pool._release(self.worker)
+
+class WorkerPool(object):
+    """A pool of long-lived processes for running Jobs.
+
+    Starting a Job normally spawns a new Python interpreter, which then has to
+    re-import all of Cozy (and Z3) before doing any useful work.  A WorkerPool
+    spawns its workers ahead of time and reuses them, so a Job started with
+    `job.start(pool=pool)` begins running almost immediately.
+
+    Jobs running in a pool behave exactly like Jobs running in their own
+    processes: clients can check .done, call .request_stop() and .join(), and
+    use stop_jobs.  A worker goes back to the pool once its job has been
+    joined.  If every worker is busy, the pool spawns another one.
+
+    Because objects like multiprocessing queues and Values can only be handed
+    to a process when it is spawned, those objects must be passed to the pool
+    as `shared` objects.  Jobs submitted to the pool may then refer to them
+    freely.
+
+    Proper usage example:
+        with SafeQueue() as q:
+            with WorkerPool(size=4, shared=[q.handle_for_subjobs()]) as pool:
+                job = MyJob(q.handle_for_subjobs())
+                job.start(pool=pool)
+                # get items from q
+                stop_jobs([job])
+    """
+
+    def __init__(self, size : int = 0, shared=(), preload=(), nice : int = 0):
+        """Spawn a new pool.
+
+        Parameters:
+            size - the number of workers to spawn up front
+            shared - queues, Values, and other objects that can only be shared
+                through inheritance
+            preload - names of modules that each worker should import before
+                it receives its first Job
+            nice - an increment to each worker's niceness (see os.nice),
+                applied once when the worker starts
+        """
+        self.shared = tuple(shared)
+        self.preload = tuple(preload)
+        self.nice = nice
+        self._idle = []
+        self._busy = []
+        for i in range(size):
+            self._idle.append(_Worker(self.shared, self.preload, self.nice))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def __len__(self):
+        """Return the number of live worker processes."""
+        return len(self._idle) + len(self._busy)
+
+    def _submit(self, job):
+        """Run `job` on an idle worker and return a _PooledProcess for it."""
+        buf = io.BytesIO()
+        _SharedObjectPickler(buf, self.shared).dump(job)
+
+        worker = None
+        while self._idle:
+            w = self._idle.pop()
+            if w.is_alive():
+                worker = w
+                break
+            w.join()
+        if worker is None:
+            worker = _Worker(self.shared, self.preload, self.nice)
+
+        worker.flags[Job._STOP_REQUESTED_FLAG] = False
+        worker.flags[Job._DONE_FLAG] = False
+        worker.flags[Job._DONE_NORMALLY_FLAG] = False
+        job._flags = worker.flags
+        self._busy.append(worker)
+        worker.conn.send_bytes(buf.getvalue())
+        return _PooledProcess(self, worker, job)
+
+    def _release(self, worker):
+        self._busy.remove(worker)
+        if worker.is_alive():
+            self._idle.append(worker)
+        else:
+            worker.join()
+
+    def close(self):
+        """Stop all workers.
+
+        Clients should stop and join their Jobs before calling this.  Workers
+        that are still running a Job are terminated.
+        """
+        print("Stopping {} pooled workers...".format(len(self)))
+        for w in self._idle:
+            w.shutdown()
+        for w in self._busy:
+            w.process.terminate()
+        for w in self._idle + self._busy:
+            w.join()
+        self._idle = []
+        self._busy = []
+
 def stop_jobs(jobs):
     """Call request_stop() on each job and wait for them to finish.
 
     This procedure also calls .join() on each job to clean up its resources.
+
+    All jobs are asked to stop up front and then waited on together, so
+    stopping many jobs takes about as long as stopping the slowest one.
     """
 
     jobs = list(jobs)
@@ -290,19 +593,46 @@ def stop_jobs(jobs):
 
     while jobs:
 
-        for j in jobs:
-            j.join(timeout=1)
         done_jobs, jobs = partition(jobs, lambda j: j.done)
         for j in done_jobs:
-            # need to do this because they might have finished AFTER the .join
-            # timed out and BEFORE the .done check
             j.join()
 
-        if jobs:
+        if jobs and not wait([s for j in jobs for s in j._sentinels()], timeout=1):
             print("Waiting on {} jobs...".format(len(jobs)))
             for j in jobs:
                 print("  --> {} [pid={}]".format(j, j.pid))
 
+def wait_any(jobs=(), queues=(), timeout=None):
+    """Block until something interesting happens.
+
+    This procedure returns as soon as any of the given jobs finishes, any of
+    the given SafeQueues has items available, SIGINT is delivered (see
+    `install_graceful_sigint_handler`), or `timeout` seconds elapse.  It does
+    not say which of those things happened; callers should check .done on
+    their jobs, drain their queues, and check `was_interrupted()` afterwards.
+
+    Waiting is done with `multiprocessing.connection.wait`, so no time is lost
+    to polling.
+    """
+    if was_interrupted() or any(j.done for j in jobs):
+        return
+    handles = list(queues)
+    for j in jobs:
+        handles.extend(j._sentinels())
+    if _wakeup_fd is not None:
+        handles.append(_wakeup_fd)
+    ready = wait(handles, timeout=timeout)
+    if _wakeup_fd is not None and _wakeup_fd in ready:
+        try:
+            while os.read(_wakeup_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+class _StopCopying(object):
+    """Marker put into a SafeQueue's underlying queue to stop its copy thread."""
+    pass
+
 class SafeQueue(object):
     """A queue for collecting results from Jobs.
 
@@ -314,6 +644,9 @@ class SafeQueue(object):
             > JoinableQueue.cancel_join_thread), then that process will not terminate
             > until all buffered items have been flushed to the pipe.
           This queue uses an auxiliary thread to solve this problem.
+        - Consumers do not need to poll.  A SafeQueue has a .fileno() that
+          becomes readable whenever items are available, so it can be passed to
+          `wait_any` (or `multiprocessing.connection.wait`) along with Jobs.
     However:
         - This queue needs to be closed.
     Proper usage example:
@@ -329,24 +662,34 @@ class SafeQueue(object):
             queue_to_wrap = multiprocessing_context.Queue()
         self.q = queue_to_wrap
         self.sideq = PlainQueue()
-        self.stop_requested = False
+        self._ready_r, self._ready_w = os.pipe()
+        os.set_blocking(self._ready_r, False)
+        os.set_blocking(self._ready_w, False)
     def __enter__(self, *args, **kwargs):
         self.thread = threading.Thread(target=self._copy_items, daemon=True)
         self.thread.start()
         return self
     def __exit__(self, *args, **kwargs):
         print("Stopping SafeQueue...")
-        self.stop_requested = True
+        self.q.put(_StopCopying())
         self.thread.join()
+        os.close(self._ready_r)
+        os.close(self._ready_w)
         print("Done!")
     def _copy_items(self):
-        while not self.stop_requested:
+        while True:
+            item = self.q.get()
+            if isinstance(item, _StopCopying):
+                return
+            self.sideq.put(item)
             try:
-                self.sideq.put(self.q.get(timeout=1), timeout=1)
-            except Empty:
-                pass
-            except Full:
+                os.write(self._ready_w, b"\0")
+            except BlockingIOError:
+                # The pipe is full, so it is already readable.
                 pass
+    def fileno(self):
+        """File descriptor that is readable when items may be available."""
+        return self._ready_r
     def put(self, item, block=False, timeout=None):
         return self.q.put(item, block=block, timeout=timeout)
     def get(self, block=False, timeout=None):
@@ -363,6 +706,13 @@ class SafeQueue(object):
         available. If a timeout is also provided, then a queue.Empty exception
         is raised if no element is available in the given number of seconds.
         """
+        # Consume wakeup notifications before looking at the items, so that a
+        # notification for an item we do not see here is never lost.
+        try:
+            while os.read(self._ready_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
         res = []
         if block:
             res.append(self.get(block=True, timeout=timeout))
@@ -8,25 +8,37 @@ Important functions:
 from collections import defaultdict
 from contextlib import contextmanager
 import datetime
+import threading
 
 from cozy.opts import Option
 
 verbose = Option("verbose", bool, False)
 
 _times = defaultdict(float)
-_task_stack = []
+_times_lock = threading.Lock()
 _begin = datetime.datetime.now()
 
+# Each thread has its own stack of active tasks, so that tasks running
+# concurrently on different threads do not end each other.
+_local = threading.local()
+
+def _task_stack():
+    stk = getattr(_local, "task_stack", None)
+    if stk is None:
+        stk = _local.task_stack = []
+    return stk
+
 def log(string):
     if verbose.value:
         print(string)
 
 def task_begin(name, **kwargs):
     start = datetime.datetime.now()
-    _task_stack.append((name, start))
+    task_stack = _task_stack()
+    task_stack.append((name, start))
     if not verbose.value:
         return
-    indent = "  " * (len(_task_stack) - 1)
+    indent = "  " * (len(task_stack) - 1)
     log("{indent}{name}{maybe_kwargs}...".format(
         indent = indent,
         name   = name,
@@ -34,13 +46,15 @@ def task_begin(name, **kwargs):
 
 def task_end(success=True):
     end = datetime.datetime.now()
-    key = tuple(name for name, start in _task_stack)
-    name, start = _task_stack.pop()
+    task_stack = _task_stack()
+    key = tuple(name for name, start in task_stack)
+    name, start = task_stack.pop()
     duration = (end-start).total_seconds()
-    _times[key] += duration
+    with _times_lock:
+        _times[key] += duration
     if not verbose.value:
         return
-    indent = "  " * len(_task_stack)
+    indent = "  " * len(task_stack)
     message = "Finished" if success else "FAILED"
     log("{indent}{msg} {name} [duration={duration:.3}s]".format(indent=indent, msg=message, name=name, duration=duration))
 
@@ -56,14 +70,14 @@ def task(name, **kwargs):
 def event(name):
     if not verbose.value:
         return
-    indent = "  " * len(_task_stack)
+    indent = "  " * len(_task_stack())
     log("{indent}{name}".format(indent=indent, name=name))
 
 def dump_profile():
     duration = (datetime.datetime.now() - _begin).total_seconds()
     with open("/tmp/cozy.profile", "w") as f:
         f.write("Total duration: {:.3} seconds\n".format(duration))
-        f.write("Currently in: {}\n\n".format(", ".join(name for (name, start) in _task_stack)))
+        f.write("Currently in: {}\n\n".format(", ".join(name for (name, start) in _task_stack())))
         for k in sorted(_times.keys(), key=_times.get, reverse=True):
             f.write("{:16.3}".format(_times[k]))
             f.write(" ")
@@ -21,6 +21,7 @@ from cozy import synthesis
 from cozy.structures import rewriting
 from cozy import opts
 from cozy import jobs
+from cozy.solver_cache import solver_cache
 
 save_failed_codegen_inputs = opts.Option("save-failed-codegen-inputs", str, "/tmp/failed_codegen.py", metavar="PATH")
 checkpoint_prefix = opts.Option("checkpoint-prefix", str, "")
@@ -210,3 +211,6 @@ def run():
         raise
 
     print("Number of improvements done: {}".format(improve_count.value))
+    cache = solver_cache()
+    if cache is not None:
+        print(cache.report())
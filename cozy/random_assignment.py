@@ -1,13 +1,23 @@
+from fractions import Fraction
 import random
 import string
-from itertools import product
+from itertools import product, combinations, combinations_with_replacement, islice
 
-from cozy.common import FrozenDict
+from cozy.common import FrozenDict, never_stop
 from cozy.syntax import *
 from cozy.syntax_tools import free_vars, strip_EStateVar
-from cozy.evaluation import eval, mkval
+from cozy.evaluation import eval, eval_bulk, mkval
 from cozy.target_syntax import EFlatMap, EFilter, EMap, EStateVar
-from cozy.value_types import Bag
+from cozy.value_types import Bag, Map, Handle
+from cozy.opts import Option
+
+falsifier_samples = Option("falsifier-samples", int, 256,
+    description="Number of small assignments to try on each candidate "
+        + "improvement before asking the solver for a counterexample.  "
+        + "0 disables the search.")
+
+# How many values of each type small_values produces at most
+_SMALL_VALUES_LIMIT = 12
 
 
 def random_value(t):
@@ -39,7 +49,66 @@ def random_value(t):
         for vs in product(*iterables):
             yield FrozenDict({field[0]: v for v, field in zip(vs, t.fields)})
     else:
-        raise Exception("Unknown type for random value construction: {}".format(t))
+        yield from small_values(t)
+
+def small_values(t : Type) -> list:
+    """
+    A short list of small values in type t, starting with mkval(t)
+    """
+    if isinstance(t, TInt) or isinstance(t, TLong):
+        return [0, 1, -1, 2]
+    if isinstance(t, TFloat):
+        return [Fraction(0), Fraction(1), Fraction(-1), Fraction(1, 2)]
+    if isinstance(t, TBool):
+        return [False, True]
+    if isinstance(t, TString):
+        # the solver models strings by their length, so stick to "a"s
+        return ["", "a", "aa"]
+    if isinstance(t, TNative):
+        return [(t.name, i) for i in range(3)]
+    if isinstance(t, TEnum):
+        return list(t.cases)
+    if isinstance(t, THandle):
+        # a handle's address determines its value
+        values = small_values(t.value_type)
+        return [Handle(i, values[i % len(values)]) for i in range(3)]
+    if isinstance(t, TTuple):
+        return _vary_each([small_values(tt) for tt in t.ts], tuple)
+    if isinstance(t, TRecord):
+        return _vary_each([small_values(tt) for (f, tt) in t.fields],
+            lambda vs: FrozenDict({ f : v for ((f, tt), v) in zip(t.fields, vs) }))
+    if isinstance(t, TList) or isinstance(t, TBag) or isinstance(t, TSet):
+        elems = small_values(t.elem_type)[:3]
+        if isinstance(t, TList):
+            pairs = product(elems, repeat=2)
+        elif isinstance(t, TSet):
+            pairs = combinations(elems, 2)
+        else:
+            pairs = combinations_with_replacement(elems, 2)
+        contents = [()] + [(x,) for x in elems] + list(pairs)
+        mk = tuple if isinstance(t, TList) else Bag
+        return [mk(c) for c in contents[:_SMALL_VALUES_LIMIT]]
+    if isinstance(t, TMap):
+        keys = small_values(t.k)[:3]
+        values = small_values(t.v)
+        default = values[0]
+        res = [Map(t, default)]
+        res += [Map(t, default, [(k, v)]) for k in keys for v in values[1:2]]
+        res += [Map(t, default, [(k, v) for k in keys[:2]]) for v in values[1:2]]
+        return res[:_SMALL_VALUES_LIMIT]
+    # e.g. extension types, whose values the evaluator represents in its own way
+    return [mkval(t)]
+
+def _vary_each(choices : [list], mk) -> list:
+    """
+    The combination of the first choices, then the combinations that differ
+    from it in one position.
+    """
+    res = [mk([c[0] for c in choices])]
+    for i, c in enumerate(choices):
+        for x in c[1:]:
+            res.append(mk([c[0] for c in choices[:i]] + [x] + [c[0] for c in choices[i+1:]]))
+    return res[:_SMALL_VALUES_LIMIT]
 
 def extract_listcomp(e):
     """
@@ -105,11 +174,12 @@ def unsatisfiable(e):
     return None
 
 
-def _satisfy(e, solver, assumptions):
+def _satisfy(e, solver, assumptions, stop_callback=never_stop):
     """
     :param e: expression to test sat
-    :param solver: the default solver
+    :param solver: the default solver, or None to skip the solver-backed shortcut
     :param assumptions: a list of expressions that are assumed true
+    :param stop_callback: called between assignments; the search gives up (returning None) when it returns True
     Heuristic to decide whether e is satisfiable quickly.
     it is a partial procedure: the possible outputs are a satisfying assignment or None (indicating unknown)
     it is allowed to indicate unknown with an arbitrary exception
@@ -119,7 +189,7 @@ def _satisfy(e, solver, assumptions):
     if isinstance(e, EUnaryOp) and e.op == "not" and isinstance(e.e, EBinOp) and e.e.op == "==":
         e1 = e.e.e1
         e2 = e.e.e2
-        if isinstance(e1, EFlatMap) and isinstance(e2, EFlatMap):
+        if solver is not None and isinstance(e1, EFlatMap) and isinstance(e2, EFlatMap):
             lc1 = extract_listcomp(e1)
             lc2 = extract_listcomp(e2)
             if lc1 is not None and lc2 is not None:
@@ -135,6 +205,8 @@ def _satisfy(e, solver, assumptions):
     iterables = [random_value(v.type) for v in free_vars(e)]
     ids = [v.id for v in free_vars(e)]
     for vs in product(*iterables):
+        if stop_callback():
+            return None
         assignments = {}
         for id_, val in zip(ids, vs):
             assignments[id_] = val
@@ -144,10 +216,104 @@ def _satisfy(e, solver, assumptions):
     return None
 
 
-def satisfy(e, solver, assumptions):
-    assignments = _satisfy(e, solver, assumptions)
+def satisfy(e, solver, assumptions, stop_callback=never_stop, vars=None):
+    """
+    Heuristic search for a model of e (see _satisfy).  Variables that the
+    search does not assign get default values; they are taken from `vars`,
+    or from `solver.vars` when `vars` is None.
+    """
+    assignments = _satisfy(e, solver, assumptions, stop_callback)
     if assignments is not None:
-        for v in solver.vars:
+        for v in (solver.vars if vars is None else vars):
             if v.id not in assignments:
                 assignments[v.id] = mkval(v.type)
     return assignments
+
+
+class Falsifier(object):
+    """
+    A search for small models that runs before the solver is asked.
+
+    Every variable and extern function is given values from `small_values`.
+    If there are at most `samples` combinations the search is exhaustive;
+    otherwise `samples` combinations are drawn at random (always including
+    the one where every variable has its default value).  The formula is
+    evaluated on many assignments at once with `eval_bulk`.
+
+    `satisfy` only ever answers with a model; when it returns None the
+    formula might still be satisfiable.  The counters record how often the
+    search paid off.
+    """
+
+    BATCH_SIZE = 64
+
+    def __init__(self, vars : [EVar], funcs : {str:TFunc}, assumptions : Exp = ETRUE, samples : int = None, stop_callback = never_stop):
+        if samples is None:
+            samples = falsifier_samples.value
+        self.vars = list(vars)
+        self.funcs = dict(funcs)
+        self.assumptions = assumptions
+        self.samples = samples
+        self.stop_callback = stop_callback
+        self.calls = 0
+        self.hits = 0
+        self.errors = 0
+        self.assignments_tried = 0
+
+    def _choices(self, e : Exp):
+        from cozy.solver import ExtractedFunc
+        mentioned = set(v.id for v in free_vars(e)) | set(v.id for v in free_vars(self.assumptions))
+        names = []
+        choices = []
+        for v in self.vars:
+            names.append(v.id)
+            choices.append(small_values(v.type) if v.id in mentioned else [mkval(v.type)])
+        for f, t in self.funcs.items():
+            names.append(f)
+            choices.append([ExtractedFunc({}, x) for x in small_values(t.ret_type)[:2]])
+        return names, choices
+
+    def _assignments(self, choices):
+        total = 1
+        for c in choices:
+            total *= len(c)
+        if total <= self.samples:
+            yield from product(*choices)
+            return
+        rng = random.Random(0)
+        yield tuple(c[0] for c in choices)
+        for _ in range(self.samples - 1):
+            yield tuple(rng.choice(c) for c in choices)
+
+    def satisfy(self, e : Exp):
+        """
+        Find an assignment to all variables and functions that satisfies e
+        and the assumptions, or return None.
+        """
+        self.calls += 1
+        if self.samples <= 0:
+            return None
+        formula = EAll([e, self.assumptions])
+        names, choices = self._choices(e)
+        assignments = self._assignments(choices)
+        while not self.stop_callback():
+            batch = [dict(zip(names, vs)) for vs in islice(assignments, self.BATCH_SIZE)]
+            if not batch:
+                break
+            self.assignments_tried += len(batch)
+            try:
+                results = eval_bulk(formula, batch)
+            except Exception:
+                # e.g. an operation that the evaluator cannot do on these
+                # values; let the solver handle this formula
+                self.errors += 1
+                return None
+            for env, res in zip(batch, results):
+                if res is True:
+                    self.hits += 1
+                    return env
+        return None
+
+    def report(self) -> str:
+        return "falsifier: {} hits / {} calls ({:.1%}), {} assignments tried, {} errors".format(
+            self.hits, self.calls, (self.hits / self.calls) if self.calls else 0, self.assignments_tried, self.errors)
@@ -6,12 +6,21 @@ Important functions and classes:
  - valid: check whether an expression is valid for all small models
  - IncrementalSolver: a class to efficiently check assertions incrementally
  - ModelCachingSolver: a class that saves models between satisfiability checks
+ - SolverPortfolio: a class that races several solver configurations
+ - solver_for_context: get a reusable ModelCachingSolver from `solver_pool`
+
+Each IncrementalSolver owns a separate Z3 context.  Different solvers can be
+used concurrently from different threads; each solver serializes the calls
+made to it.
 """
 
 from collections import defaultdict, OrderedDict
 from datetime import datetime, timedelta
-from functools import lru_cache
+from fractions import Fraction
+import queue
 import threading
+import time
+import weakref
 from typing import Callable
 
 import z3
@@ -19,16 +28,39 @@ import z3
 from cozy.target_syntax import *
 from cozy.syntax_tools import BottomUpExplorer, pprint, free_vars, free_funcs, cse, all_exps, purify
 from cozy.typecheck import is_collection, is_numeric
-from cozy.common import declare_case, fresh_name, Visitor, FrozenDict, typechecked, extend, OrderedSet, make_random_access, StopException, never_stop
+from cozy.common import ADT, declare_case, fresh_name, Visitor, FrozenDict, typechecked, extend, OrderedSet, make_random_access, StopException, never_stop
 from cozy import evaluation
+from cozy import random_assignment
 from cozy.opts import Option
 from cozy.structures import extension_handler
 from cozy.logging import task
-from cozy.value_types import Map, Bag, Handle
+from cozy.value_types import Map, Bag, Handle, approximate_size
 from cozy.evaluation import eval_bulk
 from cozy.contexts import Context
+from cozy.solver_cache import solver_cache, query_key
 
 collection_depth_opt = Option("collection-depth", int, 4, metavar="N", description="Bound for bounded verification")
+solver_memory_limit = Option("solver-memory-limit", int, 1024,
+    metavar="MB",
+    description="Approximate memory budget for the solvers that "
+        + "solver_for_context keeps for reuse.  When it is exceeded, the least "
+        + "recently used solvers are dropped.  0 means no limit.")
+deepening_opt = Option("solver-deepening", bool, False,
+    description="Look for small models first: try collections of at most 1 "
+        + "element, then 2, and so on up to --collection-depth.  This finds "
+        + "small counterexamples faster, but unsatisfiable formulas are "
+        + "checked once per depth.")
+portfolio_opt = Option("solver-portfolio", bool, False,
+    description="Verify candidate improvements by racing several solver "
+        + "configurations in parallel and using the first definitive answer.")
+encoding_cache_size = Option("solver-encoding-cache-size", int, 10000,
+    description="Number of encoded subformulas that each solver remembers, so "
+        + "that subformulas shared between queries are translated to Z3 only "
+        + "once.  0 disables the cache.")
+max_solver_examples = Option("max-solver-examples", int, 512,
+    description="Maximum number of models that each ModelCachingSolver keeps "
+        + "to answer later queries without calling Z3.  The models that have "
+        + "answered the fewest queries are dropped first.  0 means no limit.")
 
 class SolverReportedUnknown(Exception):
     pass
@@ -224,8 +256,11 @@ def ite(ty : Type, cond : z3.AstRef, then_branch, else_branch):
 def grid(rows, cols):
     return [[None for c in range(cols)] for r in range(rows)]
 
+# Expressions that are cheaper to encode than to look up in the encoding cache
+_UNCACHED_EXPS = (EVar, ELambda, EBool, ENum, EStr, EEnumEntry, EEmptyList)
+
 class ToZ3(Visitor):
-    def __init__(self, z3ctx, z3solver, stop_callback : Callable[[], bool]):
+    def __init__(self, z3ctx, z3solver, stop_callback : Callable[[], bool], cache_size : int = None):
         """Create a "ToZ3" object that can convert ASTs to Z3 queries.
 
         :param z3ctx:         A Z3 context object to use.
@@ -233,9 +268,22 @@ class ToZ3(Visitor):
         :param stop_callback: A zero-argument function that will be checked
                               periodically.  The solver will raise a
                               StopException when the callback returns True.
+        :param cache_size:    The number of encoded subexpressions to keep
+                              (see `encode`).  Defaults to
+                              --solver-encoding-cache-size.
         """
+        if cache_size is None:
+            cache_size = encoding_cache_size.value
         self.ctx = z3ctx
         self.solver = z3solver
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # (shape, ids of bound values) -> (encoding, bound values)
+        self.cache_scopes = []     # keys added to the cache since each push_scope
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._shapes = { }         # shape description -> shape id
+        self._shape_counter = 0
+        self._index = None         # id(exp) -> (exp, (shape id, free names) or None)
         self.int_zero = z3.IntVal(0, self.ctx)
         self.int_one  = z3.IntVal(1, self.ctx)
         self.true = z3.BoolVal(True, self.ctx)
@@ -454,6 +502,8 @@ class ToZ3(Visitor):
         return z3.IntSort(self.ctx)
     def visit_TBool(self, t):
         return z3.BoolSort(self.ctx)
+    def visit_TEnum(self, t):
+        return z3.IntSort(self.ctx)
     def visit_Type(self, t):
         raise NotImplementedError(t)
     def visit_EVar(self, v, env):
@@ -480,7 +530,11 @@ class ToZ3(Visitor):
         return (self.false, self.mkval(e.type.elem_type))
     def visit_ECall(self, call, env):
         args = [self.visit(x, env) for x in call.args]
-        return env[call.func](*args)
+        res = env[call.func](*args)
+        if isinstance(call.type, TEnum):
+            # like the enum variables made by mkvar
+            self.solver.add(self.all(res >= 0, res < len(call.type.cases)))
+        return res
     def visit_EEnumEntry(self, e, env):
         return z3.IntVal(e.type.cases.index(e.name), self.ctx)
     def visit_ENative(self, e, env):
@@ -843,9 +897,125 @@ class ToZ3(Visitor):
         return e
     def visit_bool(self, e, env):
         return z3.BoolVal(e, self.ctx)
+    def encode(self, e : Exp, env):
+        """Encode `e` in the given environment, reusing earlier encodings.
+
+        Subexpressions are looked up in a cache by their shape and the values
+        that `env` (or an enclosing binder) gives their free variables, so a
+        subexpression that appears in many formulas is only encoded once per
+        binding.  Shapes ignore the names of variables, which lets the cache
+        work across the different fresh names chosen by `cse`.
+        """
+        if self.cache_size <= 0:
+            return self.visit(e, env)
+        self._index = { }
+        try:
+            return self.visit(e, env)
+        finally:
+            self._index = None
+
+    def push_scope(self):
+        """Start a scope; encodings made in it are forgotten at pop_scope.
+
+        This must follow the Z3 solver's push and pop, since some encodings
+        (e.g. of ESorted) add assertions to the solver.
+        """
+        self.cache_scopes.append([])
+
+    def pop_scope(self):
+        for key in self.cache_scopes.pop():
+            self.cache.pop(key, None)
+
+    def _intern(self, description):
+        """Get the shape id for a description, or None if it is unhashable."""
+        try:
+            n = self._shapes.get(description)
+        except TypeError:
+            # e.g. a TEnum built with a list of cases
+            return None
+        if n is None:
+            if len(self._shapes) > 4 * self.cache_size:
+                # Shape ids are never reused, so the entries that used the
+                # forgotten shapes are simply never hit again.
+                self._shapes.clear()
+            self._shape_counter += 1
+            n = self._shapes[description] = self._shape_counter
+        return n
+
+    def _shape(self, x):
+        """Compute the shape of `x`.
+
+        Returns a pair (shape id, free names) or None if `x` contains syntax
+        that the cache does not understand.  The free names are listed in
+        order of first occurrence; equal shapes mean equal encodings when the
+        free names have the same values.
+        """
+        entry = self._index.get(id(x))
+        if entry is not None and entry[0] is x:
+            return entry[1]
+        if isinstance(x, EVar):
+            shape_id = self._intern(("EVar", getattr(x, "type", None)))
+            res = None if shape_id is None else (shape_id, (x.id,))
+        elif isinstance(x, ELambda):
+            res = self._combine(("ELambda", x.arg.type), [x.body], bound=x.arg.id)
+        elif isinstance(x, ECall):
+            res = self._combine(("ECall", x.type), [EVar(x.func)] + list(x.args))
+        else:
+            res = self._combine((type(x).__name__, getattr(x, "type", None)), x.children())
+        self._index[id(x)] = (x, res)
+        return res
+
+    def _combine(self, tag, children, bound=None):
+        positions = OrderedDict()
+        description = [tag]
+        for c in children:
+            if isinstance(c, (Exp, tuple, list)):
+                shape = self._shape(c) if isinstance(c, Exp) else self._combine("tuple", c)
+                if shape is None:
+                    return None
+                child_shape, names = shape
+                description.append((child_shape, tuple(
+                    -1 if n == bound else positions.setdefault(n, len(positions))
+                    for n in names)))
+            elif isinstance(c, z3.AstRef) or (isinstance(c, ADT) and not isinstance(c, Type)):
+                # e.g. the clauses of EListComprehension, which bind names
+                return None
+            else:
+                description.append(c)
+        shape_id = self._intern(tuple(description))
+        return None if shape_id is None else (shape_id, tuple(positions))
+
     def visit(self, e, *args):
         if self.stop_callback():
             raise StopException("interrupted while encoding {}".format(pprint(e)))
+        if self._index is not None and isinstance(e, Exp) and not isinstance(e, _UNCACHED_EXPS):
+            shape = self._shape(e)
+            if shape is not None:
+                return self._visit_cached(e, args[0], *shape)
+        return self._visit(e, *args)
+
+    def _visit_cached(self, e, env, shape_id, names):
+        if not all(n in env for n in names):
+            return self._visit(e, env)
+        bound_values = tuple(env[n] for n in names)
+        key = (shape_id, tuple(id(v) for v in bound_values))
+        hit = self.cache.get(key)
+        if hit is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return hit[0]
+        self.cache_misses += 1
+        res = self._visit(e, env)
+        # The bound values are kept alive with the entry so that their ids
+        # stay meaningful.
+        self.cache[key] = (res, bound_values)
+        if self.cache_scopes:
+            self.cache_scopes[-1].append(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return res
+
+    def _visit(self, e, *args):
         try:
             return super().visit(e, *args)
         except KeyboardInterrupt:
@@ -978,38 +1148,211 @@ DECIDABLE_TYPES = set([TInt, TLong, TBool, TString, TEnum, TNative, TReal, TFloa
 def decideable(t : Type):
     return type(t) in DECIDABLE_TYPES
 
-_start = None
+_timer = threading.local()
 _debug_duration = timedelta(seconds=5)
 def _tick():
-    global _start
-    _start = datetime.now()
+    _timer.start = datetime.now()
 
 def _tock(e, event):
-    global _start
     now = datetime.now()
-    elapsed = now - _start
-    _start = now
+    elapsed = now - _timer.start
+    _timer.start = now
     if elapsed > _debug_duration:
         print("WARNING: took {elapsed}s to {event}".format(event=event, elapsed=elapsed.total_seconds()))
 
-_LOCK = threading.RLock()
+# Creating a Z3 context reads and writes Z3's global configuration, which is
+# not thread-safe.  Everything else about a context belongs to one solver.
+_CONTEXT_LOCK = threading.Lock()
+
+# Rough memory cost of a Z3 context and solver, and of each Z3 term that
+# encodes a variable.  (Measured with Z3 4.8 on 64-bit Linux.)
+_Z3_CONTEXT_BYTES = 16 * 2**20
+_Z3_TERM_BYTES = 2 * 2**10
 
 class ExtractedFunc(object):
-    def __init__(self, cases, default):
+    """An extern function from a model, as a pure-Python object.
+
+    Calls with arguments in `cases` return the corresponding result.  Other
+    calls return `default`, or, if `otherwise` is given, the value of that
+    term (see `_z3_term_to_python`) for the arguments.  Unlike Z3 models,
+    these are small and can be pickled.
+
+    If `arg_types` is given, the keys of `cases` and the arguments of
+    `otherwise` are the numbers that Z3 uses for the arguments (see
+    `_scalar_to_number`), so e.g. all strings of the same length are the
+    same argument.
+    """
+    def __init__(self, cases, default, otherwise=None, arg_types=(), out_type=None):
         self.cases = cases
         self.default = default
+        self.otherwise = otherwise
+        self.arg_types = tuple(arg_types)
+        self.out_type = out_type
     def __repr__(self):
-        return "ExtractedFunc(cases={!r}, default={!r})".format(self.cases, self.default)
+        res = "ExtractedFunc(cases={!r}, default={!r}".format(self.cases, self.default)
+        if self.otherwise is not None:
+            res += ", otherwise={!r}".format(self.otherwise)
+        if self.arg_types:
+            res += ", arg_types={!r}, out_type={!r}".format(self.arg_types, self.out_type)
+        return res + ")"
     def __str__(self):
         return repr(self)
     def __call__(self, *args):
-        return self.cases.get(args, self.default)
+        if self.arg_types:
+            args = tuple(_scalar_to_number(a, t) for (a, t) in zip(args, self.arg_types))
+        res = self.cases.get(args, _MISSING)
+        if res is not _MISSING:
+            return res
+        if self.otherwise is None:
+            return self.default
+        return _number_to_scalar(_eval_python_term(self.otherwise, args), self.out_type)
+
+_MISSING = object()
+
+def _scalar_to_number(value, ty : Type):
+    """Convert a value of a type that Z3 encodes as a number to that number.
+
+    This follows ToZ3.unreconstruct.
+    """
+    if isinstance(ty, TString):
+        return len(value)
+    if isinstance(ty, TNative):
+        return value[1]
+    if isinstance(ty, TEnum):
+        return ty.cases.index(value)
+    return value
+
+def _z3_value_to_number(v : z3.ExprRef):
+    if z3.is_int_value(v):
+        return v.as_long()
+    if z3.is_rational_value(v):
+        return v.as_fraction()
+    if z3.is_true(v) or z3.is_false(v):
+        return z3.is_true(v)
+    raise NotImplementedError(v)
+
+def _number_to_scalar(x, ty : Type):
+    """Inverse of _scalar_to_number (with the same conventions as reconstruct)."""
+    if ty == INT or ty == LONG:
+        return int(x)
+    if ty == REAL or ty == FLOAT:
+        return Fraction(x)
+    if isinstance(ty, TString):
+        return "a" * int(x)
+    if isinstance(ty, TNative):
+        return (ty.name, int(x))
+    if isinstance(ty, TBool):
+        return bool(x)
+    if isinstance(ty, TEnum):
+        # Z3 may pick anything at arguments that no formula looked at
+        i = int(x)
+        return ty.cases[i] if 0 <= i < len(ty.cases) else ty.cases[0]
+    raise NotImplementedError(ty)
+
+_Z3_TERM_OPS = {
+    z3.Z3_OP_ITE: "ite",
+    z3.Z3_OP_EQ: "==",
+    z3.Z3_OP_DISTINCT: "!=",
+    z3.Z3_OP_AND: "and",
+    z3.Z3_OP_OR: "or",
+    z3.Z3_OP_NOT: "not",
+    z3.Z3_OP_LE: "<=",
+    z3.Z3_OP_LT: "<",
+    z3.Z3_OP_GE: ">=",
+    z3.Z3_OP_GT: ">",
+    z3.Z3_OP_ADD: "+",
+    z3.Z3_OP_SUB: "-",
+    z3.Z3_OP_MUL: "*",
+    z3.Z3_OP_UMINUS: "neg",
+    z3.Z3_OP_TO_REAL: "id",
+    z3.Z3_OP_TO_INT: "floor" }
+
+def _z3_term_to_python(t : z3.ExprRef):
+    """Convert a term from a Z3 function interpretation to nested tuples.
+
+    The terms are those that Z3 uses for the "else" case of a function; the
+    term Var(i) stands for the i-th argument.  Raises NotImplementedError
+    for terms that use other operators.
+    """
+    if z3.is_var(t):
+        return ("var", z3.get_var_index(t))
+    if z3.is_int_value(t):
+        return ("const", t.as_long())
+    if z3.is_rational_value(t):
+        return ("const", t.as_fraction())
+    if z3.is_true(t):
+        return ("const", True)
+    if z3.is_false(t):
+        return ("const", False)
+    op = _Z3_TERM_OPS.get(t.decl().kind()) if z3.is_app(t) else None
+    if op is None:
+        raise NotImplementedError(t)
+    return (op,) + tuple(_z3_term_to_python(c) for c in t.children())
+
+def _eval_python_term(term, args):
+    op = term[0]
+    if op == "var":
+        return args[term[1]]
+    if op == "const":
+        return term[1]
+    if op == "ite":
+        return _eval_python_term(term[2] if _eval_python_term(term[1], args) else term[3], args)
+    xs = [_eval_python_term(c, args) for c in term[1:]]
+    if op == "==":
+        return all(x == xs[0] for x in xs)
+    if op == "!=":
+        return len(set(xs)) == len(xs)
+    if op == "and":
+        return all(xs)
+    if op == "or":
+        return any(xs)
+    if op == "not":
+        return not xs[0]
+    if op in ("<=", "<", ">=", ">"):
+        cmp = {"<=": lambda a, b: a <= b, "<": lambda a, b: a < b, ">=": lambda a, b: a >= b, ">": lambda a, b: a > b}[op]
+        return all(cmp(a, b) for (a, b) in zip(xs, xs[1:]))
+    if op == "+":
+        return sum(xs)
+    if op == "-":
+        return xs[0] - sum(xs[1:])
+    if op == "*":
+        res = 1
+        for x in xs:
+            res *= x
+        return res
+    if op == "neg":
+        return -xs[0]
+    if op == "id":
+        return xs[0]
+    if op == "floor":
+        return int(Fraction(xs[0]) // 1)
+    raise NotImplementedError(op)
+
+def _has_vars(t : z3.ExprRef) -> bool:
+    return z3.is_var(t) or any(_has_vars(c) for c in t.children())
+
+def _count_terms(x) -> int:
+    """Count the Z3 terms in a symbolic value built by ToZ3.mkvar."""
+    terms = 0
+    stk = [x]
+    while stk:
+        x = stk.pop()
+        if isinstance(x, dict):
+            stk.extend(x.values())
+        elif isinstance(x, (tuple, list)):
+            stk.extend(x)
+        else:
+            terms += 1
+    return terms
 
 class IncrementalSolver(object):
     SAVE_PROPS = [
         "vars",
         "funcs",
-        "_env"]
+        "assumptions",
+        "_env",
+        "_env_terms",
+        "_masks"]
 
     def __init__(self,
             vars = None,
@@ -1021,10 +1364,13 @@ class IncrementalSolver(object):
             logic : str = None,
             timeout : float = None,
             do_cse : bool = True,
+            deepening : bool = None,
             stop_callback : Callable[[], bool] = never_stop):
 
         if collection_depth is None:
             collection_depth = collection_depth_opt.value
+        if deepening is None:
+            deepening = deepening_opt.value
 
         self.vars = OrderedSet()
         self.funcs = OrderedDict()
@@ -1034,11 +1380,27 @@ class IncrementalSolver(object):
         self.model_callback = model_callback
         self.stop_callback = stop_callback
         self._env = OrderedDict()
+        # The number of Z3 terms in _env, for approximate_memory
+        self._env_terms = 0
+        # The symbolic "is present" flags of every collection in _env, one
+        # list per collection.  Used to restrict collection sizes when
+        # deepening.
+        self._masks = []
+        self.deepening = deepening
+        self.assumptions = []
         self.stk = []
         self.do_cse = do_cse
+        # Seconds spent translating formulas to Z3 and in Z3 itself
+        self.encode_time = 0.0
+        self.solve_time = 0.0
+
+        # Guards the Z3 context and everything built in it.  Z3 contexts must
+        # not be used from two threads at once.
+        self._lock = threading.RLock()
 
-        with _LOCK:
+        with _CONTEXT_LOCK:
             ctx = z3.Context()
+        with self._lock:
             solver = z3.Solver(ctx=ctx) if logic is None else z3.SolverFor(logic, ctx=ctx)
             if timeout is not None:
                 solver.set("timeout", int(timeout * 1000))
@@ -1050,46 +1412,107 @@ class IncrementalSolver(object):
             self._create_vars(vars=vars or (), funcs=funcs or {})
 
     def push(self):
-        self.stk.append(tuple(type(getattr(self, p))(getattr(self, p)) for p in IncrementalSolver.SAVE_PROPS))
-        self.z3_solver.push()
+        with self._lock:
+            self.stk.append(tuple(type(getattr(self, p))(getattr(self, p)) for p in IncrementalSolver.SAVE_PROPS))
+            self.z3_solver.push()
+            self.visitor.push_scope()
 
     def pop(self):
-        x = self.stk.pop()
-        for v, p in zip(x, IncrementalSolver.SAVE_PROPS):
-            setattr(self, p, v)
-        self.z3_solver.pop()
+        with self._lock:
+            x = self.stk.pop()
+            for v, p in zip(x, IncrementalSolver.SAVE_PROPS):
+                setattr(self, p, v)
+            self.z3_solver.pop()
+            self.visitor.pop_scope()
 
     def _create_vars(self, vars, funcs):
         for f, t in funcs.items():
             if f not in self._env:
                 self._env[f] = self.visitor.mkvar(self.collection_depth, t, min_collection_depth=self.min_collection_depth)
+                self._env_terms += _count_terms(self._env[f])
                 self.funcs[f] = t
         for v in vars:
             if v.id not in self._env:
                 self._env[v.id] = self.visitor.mkvar(self.collection_depth, v.type, min_collection_depth=self.min_collection_depth)
+                self._env_terms += _count_terms(self._env[v.id])
                 self.vars.add(v)
+                self._collect_masks(self._env[v.id], v.type)
+
+    def _collect_masks(self, value, ty):
+        h = extension_handler(type(ty))
+        if h is not None:
+            self._collect_masks(value, h.encoding_type(ty))
+        elif isinstance(ty, TBag) or isinstance(ty, TSet) or isinstance(ty, TList):
+            mask, elems = value
+            self._masks.append([m for m in mask if not z3.is_true(m)])
+            for x in elems:
+                self._collect_masks(x, ty.elem_type)
+        elif isinstance(ty, TMap):
+            self._masks.append([m for (m, k, v) in value["mapping"]])
+            for (m, k, v) in value["mapping"]:
+                self._collect_masks(k, ty.k)
+                self._collect_masks(v, ty.v)
+        elif isinstance(ty, TRecord):
+            for (f, t) in ty.fields:
+                self._collect_masks(value[f], t)
+        elif isinstance(ty, TTuple):
+            for (v, t) in zip(value, ty.ts):
+                self._collect_masks(v, t)
+        elif isinstance(ty, THandle):
+            self._collect_masks(value[1], ty.value_type)
+
+    def _check(self):
+        """Check the assertions in the Z3 solver.
+
+        With deepening, this first looks for models whose collections have at
+        most 1 element, then at most 2, and so on.  Each step is a check of the
+        same assertions under extra assumptions, so Z3 can reuse its work
+        between steps.  Only the final check (at full depth) can answer unsat
+        or unknown.
+        """
+        solver = self.z3_solver
+        if self.deepening:
+            # Symmetry breaking puts the present elements of each collection
+            # last, so clearing all but the last d flags allows at most d
+            # elements.
+            for d in range(1, self.collection_depth):
+                limits = [z3.Not(m) for masks in self._masks for m in masks[:len(masks)-d]]
+                if not limits:
+                    break
+                with task("invoke Z3", depth=d):
+                    res = solver.check(*limits)
+                if res == z3.sat:
+                    return res
+                if self.stop_callback():
+                    return res
+        with task("invoke Z3"):
+            return solver.check()
 
     def _convert(self, e):
         _tick()
         orig_e = e
+        start = time.perf_counter()
         try:
             e = purify(e)
             if self.do_cse:
                 orig_size = e.size()
                 e = cse(e, verify=False)
                 _tock(e, "cse (size: {} --> {})".format(orig_size, e.size()))
-            with _LOCK:
+            with self._lock:
                 self._create_vars(vars=free_vars(orig_e), funcs=free_funcs(orig_e))
                 with task("encode formula", size=e.size()):
-                    return self.visitor.visit(e, self._env)
+                    return self.visitor.encode(e, self._env)
         except:
             print("conversion failed for: {!r}".format(orig_e))
             raise
+        finally:
+            self.encode_time += time.perf_counter() - start
 
     def add_assumption(self, e):
         try:
-            with _LOCK:
+            with self._lock:
                 self.z3_solver.add(self._convert(e))
+                self.assumptions.append(e)
         except Exception:
             print(" ---> to reproduce: satisfy({e!r}, vars={vars!r}, collection_depth={collection_depth!r}, validate_model={validate_model!r})".format(
                 e=e,
@@ -1107,9 +1530,17 @@ class IncrementalSolver(object):
         if self.validate_model:
             model_extraction = True
 
-        with _LOCK:
+        with self._lock:
             _tick()
 
+            cache = solver_cache()
+            if cache is not None:
+                self._create_vars(vars=free_vars(e), funcs=free_funcs(e))
+                cache_key, cache_names = query_key(e, self.assumptions, self.vars, self.funcs, self.collection_depth, self.min_collection_depth)
+                found, res = self._lookup_cached(cache, cache_key, cache_names, e, model_extraction)
+                if found:
+                    return res
+
             builtin_type = type
             def reconstruct(model, value, type):
                 if type == INT or type == LONG:
@@ -1134,15 +1565,15 @@ class IncrementalSolver(object):
                     return Bag(real_val)
                 elif isinstance(type, TMap):
                     default = reconstruct(model, value["default"], type.v)
-                    res = Map(type, default)
+                    items = []
                     for (mask, k, v) in value["mapping"]:
                         # K/V pairs appearing earlier in value["mapping"] have precedence
                         if reconstruct(model, mask, BOOL):
                             k = reconstruct(model, k, type.k)
-                            if k not in res.keys():
+                            if not any(k == kk for (kk, vv) in items):
                                 v = reconstruct(model, v, type.v)
-                                res[k] = v
-                    return res
+                                items.append((k, v))
+                    return Map(type, default, items)
                 elif isinstance(type, TEnum):
                     val = model.eval(value, model_completion=True).as_long()
                     return type.cases[val]
@@ -1169,8 +1600,11 @@ class IncrementalSolver(object):
             solver.add(a)
 
             _tock(e, "encode")
-            with task("invoke Z3"):
-                res = solver.check()
+            start = time.perf_counter()
+            try:
+                res = self._check()
+            finally:
+                self.solve_time += time.perf_counter() - start
             _tock(e, "solve")
 
             if self.stop_callback():
@@ -1179,6 +1613,8 @@ class IncrementalSolver(object):
 
             if res == z3.unsat:
                 solver.pop()
+                if cache is not None:
+                    cache.store(cache_key, None)
                 return None
             elif res == z3.unknown:
                 solver.pop()
@@ -1187,18 +1623,32 @@ class IncrementalSolver(object):
                 res = { }
                 if model_extraction:
                     def mkfunc(f, arg_types, out_type):
-                        z3_func = model[f]
                         if not arg_types:
                             default = reconstruct(model, f(), out_type)
                             return ExtractedFunc({}, default)
-                        if z3_func is None:
+                        z3_func = model[f]
+                        if z3_func is None or f not in model.decls():
+                            # Z3 left the function unconstrained
                             return ExtractedFunc({}, evaluation.mkval(out_type))
-                        *z3_entries, z3_default = z3_func.as_list()
-                        # TODO: this lambda captures the whole model and
-                        # Z3 context, resulting in a surprising amount of
-                        # memory being preserved.  Someday it would be nice to
-                        # extract Z3 functions to pure Python objects.
-                        return lambda *args: reconstruct(model, f(*(self.visitor.unreconstruct(a, t) for a, t in zip(args, arg_types))), out_type)
+                        def result(value):
+                            return _number_to_scalar(_z3_value_to_number(model.eval(value, model_completion=True)), out_type)
+                        cases = { }
+                        for i in range(z3_func.num_entries()):
+                            entry = z3_func.entry(i)
+                            args = tuple(_z3_value_to_number(entry.arg_value(j)) for j in range(len(arg_types)))
+                            cases.setdefault(args, result(entry.value()))
+                        z3_default = z3_func.else_value()
+                        if z3_default is None:
+                            return ExtractedFunc(cases, evaluation.mkval(out_type), arg_types=arg_types, out_type=out_type)
+                        if not _has_vars(z3_default):
+                            return ExtractedFunc(cases, result(z3_default), arg_types=arg_types, out_type=out_type)
+                        try:
+                            otherwise = _z3_term_to_python(z3_default)
+                        except NotImplementedError:
+                            # Rare: this lambda captures the whole model and
+                            # Z3 context and cannot be pickled.
+                            return lambda *args: reconstruct(model, f(*(self.visitor.unreconstruct(a, t) for a, t in zip(args, arg_types))), out_type)
+                        return ExtractedFunc(cases, evaluation.mkval(out_type), otherwise, arg_types, out_type)
                     model = solver.model()
                     for name, t in self.funcs.items():
                         f = _env[name]
@@ -1262,14 +1712,66 @@ class IncrementalSolver(object):
                             raise ModelValidationError("model validation failed")
                     _tock(e, "extract model")
                 solver.pop()
+                if cache is not None:
+                    renamed = { "v{}".format(i) : name for (i, name) in enumerate(cache_names) }
+                    cache.store(cache_key, { n : res[name] for (n, name) in renamed.items() if name in res })
                 return res
 
+    def _lookup_cached(self, cache, key, names, e, model_extraction):
+        """Look for the result of `satisfy(e)` in the solver cache.
+
+        Returns (found, result).  Stored models only mention the variables and
+        functions in the query; the others get default values.
+        """
+        found, model = cache.lookup(key, need_model=model_extraction)
+        if not found or model is None:
+            return (found, None)
+        res = { }
+        if model_extraction:
+            for (n, value) in model.items():
+                res[names[int(n[1:])]] = value
+            for (name, t) in self.funcs.items():
+                if name not in res:
+                    res[name] = ExtractedFunc({}, evaluation.mkval(t.ret_type))
+            for v in self.vars:
+                if v.id not in res:
+                    res[v.id] = evaluation.mkval(v.type)
+            if self.validate_model and evaluation.eval(e, res) is not True:
+                # not a model after all; ask Z3 again
+                return (False, None)
+            if self.model_callback is not None:
+                self.model_callback(res)
+        return (True, res)
+
+    def interrupt(self):
+        """Ask a Z3 call in progress on another thread to give up.
+
+        The interrupted call raises SolverReportedUnknown.  Interrupting an
+        idle solver has no effect.
+        """
+        try:
+            self.visitor.ctx.interrupt()
+        except z3.Z3Exception:
+            # Z3 reports the interrupted call's own error (e.g. "push
+            # canceled") here as well; that call raises it too.
+            pass
+
     def satisfiable(self, e):
         return self.satisfy(e, model_extraction=False) is not None
 
     def valid(self, e):
         return not self.satisfiable(ENot(e))
 
+    def report(self) -> str:
+        hits = self.visitor.cache_hits
+        lookups = hits + self.visitor.cache_misses
+        return "encode {:.2f}s, solve {:.2f}s; encoding cache: {} hits / {} lookups ({:.1%})".format(
+            self.encode_time, self.solve_time, hits, lookups, (hits / lookups) if lookups else 0)
+
+    def approximate_memory(self) -> int:
+        """Estimate the number of bytes used by this solver's Z3 context."""
+        return _Z3_CONTEXT_BYTES + _Z3_TERM_BYTES * (self._env_terms + len(self.visitor.cache))
+
 def satisfy(e, **opts):
     s = IncrementalSolver(**opts)
     return s.satisfy(e)
@@ -1294,20 +1796,55 @@ class ModelCachingSolver(object):
         self.funcs = OrderedDict(funcs)
         self.calls = 0
         self.hits = 0
-        self.examples = list(examples)
+        self.examples = []
+        self.example_hits = [] # parallel to self.examples: queries answered by each
+        self.example_sizes = [] # parallel to self.examples: approximate_size of each
+        self.examples_size = 0 # sum of self.example_sizes
+        self.evicted_examples = 0
+        for x in examples:
+            self.add_example(x)
         self.solver = IncrementalSolver(vars=vars, funcs=funcs, **kwargs)
         self.solver.add_assumption(assumptions)
 
-    def satisfy(self, e):
+    def add_example(self, x : dict):
+        """Remember a model to try on later queries.
+
+        At most `max_solver_examples` models are kept.  When there are too
+        many, the one that has answered the fewest queries is dropped; among
+        equally useful models, the oldest goes first.
+        """
+        size = approximate_size(x)
+        self.examples.append(x)
+        self.example_hits.append(0)
+        self.example_sizes.append(size)
+        self.examples_size += size
+        limit = max_solver_examples.value
+        if limit > 0 and len(self.examples) > limit:
+            # never drop the model that was just added
+            i = min(range(len(self.examples) - 1), key=self.example_hits.__getitem__)
+            self.examples_size -= self.example_sizes[i]
+            del self.examples[i]
+            del self.example_hits[i]
+            del self.example_sizes[i]
+            self.evicted_examples += 1
+
+    def satisfy(self, e, fallback=None):
+        """Find a model of e, trying the cached models first.
+
+        If none of them works, ask `fallback` (any object with a `satisfy`
+        method, such as a SolverPortfolio) or, by default, this object's own
+        solver.  A new model is cached either way.
+        """
         self.calls += 1
         eval_results = eval_bulk(e, self.examples, use_default_values_for_undefined_vars=True)
-        for x, res in zip(self.examples, eval_results):
+        for i, (x, res) in enumerate(zip(self.examples, eval_results)):
             if res:
                 self.hits += 1
+                self.example_hits[i] += 1
                 return x
-        x = self.solver.satisfy(e)
+        x = (self.solver if fallback is None else fallback).satisfy(e)
         if x is not None:
-            self.examples.append(x)
+            self.add_example(x)
         return x
 
     def satisfiable(self, e):
@@ -1316,10 +1853,294 @@ class ModelCachingSolver(object):
     def valid(self, e):
         return not self.satisfiable(ENot(e))
 
-@lru_cache()
+    def approximate_memory(self) -> int:
+        """Estimate the number of bytes used by this solver and its models.
+
+        This is cheap: the sizes of the models are tracked as they are added
+        and dropped.
+        """
+        return self.solver.approximate_memory() + self.examples_size
+
+class PortfolioMember(object):
+    """One configuration raced by a SolverPortfolio.
+
+    `solver_args` are keyword arguments for IncrementalSolver, or None for the
+    random-assignment falsifier (see cozy.random_assignment).  Members that
+    are not `complete` look at only some of the models; their "unsat" answers
+    are ignored.
+    """
+
+    def __init__(self, name : str, solver_args : dict = None, complete : bool = True):
+        self.name = name
+        self.solver_args = solver_args
+        self.complete = complete
+
+    def __repr__(self):
+        return "PortfolioMember({!r}, {!r}, complete={!r})".format(self.name, self.solver_args, self.complete)
+
+def default_portfolio(collection_depth : int = None, falsifier : bool = True) -> [PortfolioMember]:
+    if collection_depth is None:
+        collection_depth = collection_depth_opt.value
+    members = [
+        PortfolioMember("default", {"deepening": False}),
+        PortfolioMember("no-cse", {"deepening": False, "do_cse": False}),
+        PortfolioMember("deepening", {"deepening": True}),
+        PortfolioMember("QF_UFLIRA", {"deepening": False, "logic": "QF_UFLIRA"})]
+    if collection_depth > 1:
+        members.append(PortfolioMember("shallow", {"deepening": False, "collection_depth": collection_depth // 2}, complete=False))
+    if falsifier:
+        members.append(PortfolioMember("random", None, complete=False))
+    return members
+
+def _portfolio_worker(requests : queue.Queue, run_member):
+    # The body of a SolverPortfolio member's thread.  It holds only a weak
+    # reference to the portfolio, so that an abandoned portfolio can be
+    # collected (at which point its finalizer stops the thread).
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        run = run_member()
+        if run is None:
+            return
+        run(*request)
+        del run
+
+def _stop_portfolio_workers(requests : [queue.Queue]):
+    for q in requests:
+        q.put(None)
+
+class SolverPortfolio(object):
+    """
+    A solver that races several configurations on every query.
+
+    Each member gets its own IncrementalSolver (and so its own Z3 context)
+    and its own long-lived thread.  Z3 releases the GIL while it works, so
+    the members really do run in parallel.  The first definitive answer wins:
+    a model from any member, or "unsat" from a complete member.  The other
+    members are then interrupted.  Call close() to stop the threads early.
+
+    The `wins` dictionary records how many queries each member answered.
+    """
+
+    def __init__(self,
+            vars        : [EVar],
+            funcs       : { str : TFunc },
+            assumptions : Exp = ETRUE,
+            members     : [PortfolioMember] = None,
+            stop_callback : Callable[[], bool] = never_stop,
+            **kwargs):
+        self.vars = list(vars)
+        self.funcs = OrderedDict(funcs)
+        self.assumptions = assumptions
+        if members is None:
+            members = default_portfolio(kwargs.get("collection_depth"))
+        self.members = list(members)
+        self.stop_callback = stop_callback
+        self.kwargs = kwargs
+        self.solvers = [None] * len(self.members)
+        self.calls = 0
+        self.wins = OrderedDict((m.name, 0) for m in self.members)
+        self._cancelled = False
+        self._lock = threading.RLock()
+        self._requests = [queue.Queue() for m in self.members]
+        self._results = queue.Queue()
+        self._threads = None
+        self.close = weakref.finalize(self, _stop_portfolio_workers, self._requests)
+
+    def _should_stop(self):
+        return self._cancelled or self.stop_callback()
+
+    def _solver(self, i) -> IncrementalSolver:
+        # Created on the member's own thread the first time it runs, so that
+        # the members set up their Z3 contexts in parallel.
+        solver = self.solvers[i]
+        if solver is None:
+            args = dict(self.kwargs)
+            args.update(self.members[i].solver_args or { })
+            solver = IncrementalSolver(vars=self.vars, funcs=self.funcs, stop_callback=self._should_stop, **args)
+            solver.add_assumption(self.assumptions)
+            self.solvers[i] = solver
+        return solver
+
+    def _run_member(self, i, e):
+        member = self.members[i]
+        try:
+            if member.solver_args is None:
+                res = random_assignment.satisfy(e, None, [self.assumptions], stop_callback=self._should_stop, vars=self.vars)
+                status = "unknown" if res is None else "sat"
+            else:
+                res = self._solver(i).satisfy(e)
+                status = "unsat" if res is None else "sat"
+        except (SolverReportedUnknown, StopException):
+            status, res = "unknown", None
+        except Exception as exc:
+            status, res = "error", exc
+        if status != "sat" and status != "unsat":
+            # The call may have been stopped halfway through a push or pop;
+            # start over with a fresh solver next time.
+            self.solvers[i] = None
+        self._results.put((i, status, res))
+
+    def _start_threads(self):
+        run_member = weakref.WeakMethod(self._run_member)
+        self._threads = [threading.Thread(target=_portfolio_worker, args=(q, run_member), daemon=True)
+            for q in self._requests]
+        for t in self._threads:
+            t.start()
+
+    def satisfy(self, e):
+        with self._lock:
+            if not self.close.alive:
+                raise ValueError("solver portfolio is closed")
+            if self._threads is None:
+                self._start_threads()
+            self.calls += 1
+            self._cancelled = False
+            for i, q in enumerate(self._requests):
+                q.put((i, e))
+
+            answered = False
+            answer = None
+            errors = { }
+            pending = set(range(len(self.members)))
+            while pending and not answered:
+                try:
+                    i, status, res = self._results.get(timeout=0.1)
+                except queue.Empty:
+                    if self.stop_callback():
+                        break
+                    continue
+                pending.discard(i)
+                if status == "sat" or (status == "unsat" and self.members[i].complete):
+                    answered = True
+                    answer = res
+                    self.wins[self.members[i].name] += 1
+                elif status == "error":
+                    errors[i] = res
+
+            # Cancel the losers.  A member might be between encoding and
+            # calling Z3 (where interrupts are ignored), so keep interrupting
+            # until it reports back.
+            self._cancelled = True
+            while pending:
+                for i in pending:
+                    solver = self.solvers[i]
+                    if solver is not None:
+                        solver.interrupt()
+                try:
+                    i, status, res = self._results.get(timeout=0.01)
+                    pending.discard(i)
+                except queue.Empty:
+                    pass
+
+            if answered:
+                return answer
+            if self.stop_callback():
+                raise StopException("stop requested during solver portfolio")
+            if 0 in errors:
+                raise errors[0]
+            raise SolverReportedUnknown("no member of the solver portfolio reached a definitive answer")
+
+    def satisfiable(self, e):
+        return self.satisfy(e) is not None
+
+    def valid(self, e):
+        return not self.satisfiable(ENot(e))
+
+    def report(self) -> str:
+        return "solver portfolio: {} queries; wins: {}".format(
+            self.calls,
+            ", ".join("{}={}".format(name, n) for (name, n) in self.wins.items()))
+
+class SolverPool(object):
+    """The solvers that `solver_for_context` keeps for reuse.
+
+    Each solver holds a Z3 context, which is expensive, so the pool is
+    bounded by `solver_memory_limit`.  Solvers are dropped in least recently
+    used order when the estimated memory use of the pool exceeds it.  The
+    `hits`, `misses`, and `evictions` counters record how the pool is doing.
+    """
+
+    def __init__(self):
+        self.solvers = OrderedDict() # key -> ModelCachingSolver
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, make : Callable[[], ModelCachingSolver]) -> ModelCachingSolver:
+        with self.lock:
+            solver = self.solvers.get(key)
+            if solver is not None:
+                self.hits += 1
+                self.solvers.move_to_end(key)
+                return solver
+            self.misses += 1
+        solver = make()
+        with self.lock:
+            solver = self.solvers.setdefault(key, solver)
+            self.solvers.move_to_end(key)
+            self._enforce_memory_limit()
+        return solver
+
+    def _enforce_memory_limit(self):
+        limit = solver_memory_limit.value * 2**20
+        if limit <= 0:
+            return
+        sizes = [s.approximate_memory() for s in self.solvers.values()]
+        total = sum(sizes)
+        # never drop the most recently used solver
+        for key, size in zip(list(self.solvers.keys())[:-1], sizes):
+            if total <= limit:
+                break
+            del self.solvers[key]
+            total -= size
+            self.evictions += 1
+
+    def approximate_memory(self) -> int:
+        with self.lock:
+            return sum(s.approximate_memory() for s in self.solvers.values())
+
+    def clear(self):
+        with self.lock:
+            self.solvers.clear()
+
+    def __len__(self):
+        return len(self.solvers)
+
+    def report(self) -> str:
+        with self.lock:
+            solvers = list(self.solvers.values())
+        cache_hits = sum(s.solver.visitor.cache_hits for s in solvers)
+        cache_lookups = cache_hits + sum(s.solver.visitor.cache_misses for s in solvers)
+        return "solver pool: {} solvers (~{:.1f} MB), {} hits, {} misses, {} evictions; {} examples kept, {} dropped; {}/{} queries answered by examples; encode {:.2f}s, solve {:.2f}s; encoding cache {}/{} hits".format(
+            len(solvers),
+            sum(s.approximate_memory() for s in solvers) / 2**20,
+            self.hits,
+            self.misses,
+            self.evictions,
+            sum(len(s.examples) for s in solvers),
+            sum(s.evicted_examples for s in solvers),
+            sum(s.hits for s in solvers),
+            sum(s.calls for s in solvers),
+            sum(s.solver.encode_time for s in solvers),
+            sum(s.solver.solve_time for s in solvers),
+            cache_hits,
+            cache_lookups)
+
+solver_pool = SolverPool()
+
 def solver_for_context(context : Context, assumptions : Exp = ETRUE, **kwargs):
-    return ModelCachingSolver(
-        vars        = [v for v, _ in context.vars()],
-        funcs       = context.funcs(),
-        assumptions = assumptions,
-        **kwargs)
+    """Get a ModelCachingSolver for the given context and assumptions.
+
+    Solvers are kept in `solver_pool`, so calling this again with the same
+    arguments usually returns the same solver.
+    """
+    return solver_pool.get(
+        (context, assumptions, tuple(sorted(kwargs.items()))),
+        lambda: ModelCachingSolver(
+            vars        = [v for v, _ in context.vars()],
+            funcs       = context.funcs(),
+            assumptions = assumptions,
+            **kwargs))
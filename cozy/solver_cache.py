@@ -0,0 +1,207 @@
+"""Persistent cache of solver results.
+
+Synthesis asks the solver many of the same questions every time it runs on
+the same specification.  With --solver-cache=FILE, `IncrementalSolver`
+remembers its answers in an SQLite database so that later runs (and other
+processes in the same run) can skip the call to Z3.
+
+Important functions and classes:
+ - query_key: a content-addressed key for one solver query
+ - SolverCache: the on-disk table of results
+ - solver_cache: the SolverCache for the current process, if one is enabled
+
+Queries are keyed by their formula and assumptions with every variable and
+function renamed according to its position, so queries that differ only in
+the names of their variables share an entry.  Models are stored under the
+renamed variables as well and translated back on a hit.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from cozy.syntax import Exp, EVar, ELambda, ECall
+from cozy.common import ADT, extend
+from cozy.opts import Option
+
+solver_cache_path = Option("solver-cache", str, "",
+    metavar="FILE",
+    description="SQLite database in which to remember the results of solver "
+        + "queries between runs.  Empty means no cache.")
+solver_cache_size = Option("solver-cache-size", int, 100000,
+    description="Maximum number of results to keep in the solver cache.  "
+        + "The least recently used results are dropped first.")
+
+# Bump this if the way keys or models are computed changes, so that stale
+# databases are ignored rather than misread.
+_FORMAT_VERSION = 1
+
+# How many stores happen between checks of the size limit
+_PRUNE_INTERVAL = 64
+
+def query_key(
+        formula         : Exp,
+        assumptions     : [Exp],
+        vars            : [EVar],
+        funcs           : {str:object},
+        collection_depth     : int,
+        min_collection_depth : int) -> (str, [str]):
+    """Compute the cache key for a solver query.
+
+    Returns (key, names) where `key` is a hex digest and `names` lists the
+    original names of the variables and functions that the query mentions, in
+    the order in which they were renamed.  Variables in `vars` and functions
+    in `funcs` that the formula and assumptions do not mention are not part of
+    the key.
+    """
+    names = { }
+    binders = { }
+    var_types = { v.id : v.type for v in vars }
+
+    def rename(name):
+        n = names.get(name)
+        if n is None:
+            n = "v{}".format(len(names))
+            names[name] = n
+        return n
+
+    def key(x, depth):
+        if isinstance(x, EVar):
+            t = key(getattr(x, "type", None), depth)
+            if x.id in binders:
+                return ("bound", binders[x.id], t)
+            return ("free", rename(x.id), t)
+        if isinstance(x, ELambda):
+            with extend(binders, x.arg.id, depth):
+                return ("lambda", key(x.arg.type, depth), key(x.body, depth + 1))
+        if isinstance(x, ECall):
+            return ("call", rename(x.func), key(x.type, depth), key(x.args, depth))
+        if isinstance(x, ADT):
+            return (type(x).__name__, key(getattr(x, "type", None), depth)) + tuple(key(c, depth) for c in x.children())
+        if isinstance(x, (tuple, list)):
+            return tuple(key(c, depth) for c in x)
+        return x
+
+    formula_keys = tuple(key(e, 0) for e in tuple(assumptions) + (formula,))
+    signature = tuple(
+        (n, key(var_types[name], 0) if name in var_types else key(funcs.get(name), 0))
+        for (name, n) in names.items())
+    text = repr((_FORMAT_VERSION, formula_keys, signature, collection_depth, min_collection_depth))
+    return (hashlib.sha256(text.encode("utf-8")).hexdigest(), list(names.keys()))
+
+class SolverCache(object):
+    """A table of solver results stored in an SQLite database.
+
+    Each entry records whether a query was satisfiable and, if the model was
+    extracted and can be pickled, the model itself.  Many processes may share
+    one database; errors from SQLite (e.g. a database that stays locked) are
+    treated as cache misses.
+
+    The `hits`, `misses`, and `stores` counters record how well the cache is
+    doing in this process.
+    """
+
+    def __init__(self, path : str, max_entries : int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads or carried
+        # across a fork, so each thread of each process opens its own.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, sat INTEGER, model BLOB, last_used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def lookup(self, key : str, need_model : bool):
+        """Look up a query by its key.
+
+        Returns a pair (found, model).  If `found` is false, the result is not
+        known (or `need_model` is true but no model was stored).  Otherwise
+        `model` is None for an unsatisfiable query, or the stored model---a
+        dictionary from renamed variables to values---for a satisfiable one.
+        """
+        found = False
+        model = None
+        try:
+            conn = self._connection()
+            row = conn.execute("SELECT sat, model FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and not (row[0] and need_model and row[1] is None):
+                sat, blob = row
+                if sat:
+                    model = pickle.loads(blob) if blob is not None else { }
+                found = True
+                conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            self.errors += 1
+            found = False
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return (found, model)
+
+    def store(self, key : str, model):
+        """Record the result of a query.
+
+        `model` should be None for an unsatisfiable query, or the model (with
+        renamed variables) for a satisfiable one.  Pass an empty dictionary for
+        a satisfiable query whose model was not extracted.
+        """
+        blob = None
+        if model:
+            try:
+                blob = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # e.g. functions that still refer to a Z3 model
+                pass
+        try:
+            conn = self._connection()
+            # Do not replace a stored model with a bare "satisfiable".
+            verb = "INSERT OR IGNORE" if (model is not None and blob is None) else "INSERT OR REPLACE"
+            conn.execute(verb + " INTO results (key, sat, model, last_used) VALUES (?, ?, ?, ?)",
+                (key, 0 if model is None else 1, blob, time.time()))
+            conn.commit()
+            self.stores += 1
+            if self.stores % _PRUNE_INTERVAL == 0:
+                self._prune(conn)
+        except sqlite3.Error:
+            self.errors += 1
+
+    def _prune(self, conn):
+        (count,) = conn.execute("SELECT COUNT(*) FROM results").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (excess,))
+            conn.commit()
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        return "solver cache: {} hits / {} lookups ({:.1%}), {} stores, {} errors".format(
+            self.hits, lookups, (self.hits / lookups) if lookups else 0, self.stores, self.errors)
+
+_caches = { } # path -> SolverCache
+
+def solver_cache():
+    """Get the SolverCache selected by --solver-cache, or None if there is none."""
+    path = solver_cache_path.value
+    if not path:
+        return None
+    cache = _caches.get(path)
+    if cache is None:
+        cache = _caches.setdefault(path, SolverCache(path, solver_cache_size.value))
+    return cache
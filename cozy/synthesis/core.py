@@ -32,7 +32,7 @@ from cozy.typecheck import is_collection, is_scalar
 from cozy.syntax_tools import subst, pprint, free_vars, fresh_var, alpha_equivalent, strip_EStateVar, freshen_binders, wrap_naked_statevars, break_conj, inline_lets
 from cozy.wf import exp_wf
 from cozy.common import No, unique, OrderedSet, StopException, never_stop
-from cozy.solver import valid, solver_for_context, ModelCachingSolver
+from cozy.solver import valid, solver_for_context, ModelCachingSolver, SolverPortfolio, default_portfolio, portfolio_opt
 from cozy.evaluation import construct_value
 from cozy.cost_model import CostModel, Order, LINEAR_TIME_UOPS
 from cozy.opts import Option
@@ -43,6 +43,7 @@ from cozy.structures import extension_handler
 
 from .acceleration import try_optimize
 from .enumeration import Enumerator, Fingerprint, retention_policy
+from .shared_examples import SharedExamples
 
 eliminate_vars = Option("eliminate-vars", bool, False)
 enable_blacklist = Option("enable-blacklist", bool, False,
@@ -59,6 +60,11 @@ cost_pruning = Option("prune-using-cost", bool, False,
         + "than the current best. This makes Cozy faster since it caches "
         + "fewer expressions, but also makes Cozy slower since it needs to do "
         + "more work when it sees each one for the first time.")
+incremental_enumeration = Option("incremental-enumeration", bool, True,
+    description="When a candidate improvement turns out to be wrong, add the "
+        + "counterexample to the existing enumerator instead of starting a "
+        + "fresh one.  Cached expressions keep their work and only the "
+        + "equivalence classes that the new example splits are revisited.")
 
 # Options that control `possibly_useful`
 allow_conditional_state = Option("allow-conditional-state", bool, True,
@@ -109,7 +115,8 @@ def improve(
         examples      : [{str:object}]     = (),
         cost_model    : CostModel          = None,
         ops           : [Op]               = (),
-        improve_count : Value              = None):
+        improve_count : Value              = None,
+        shared_examples : SharedExamples   = None):
     """Improve the target expression using enumerative synthesis.
 
     This function is a generator that yields increasingly better and better
@@ -130,6 +137,10 @@ def improve(
         - ops: update operations.  This function may make different choices
           about what expressions are state expressions based on what changes
           can happen to that state.
+        - shared_examples: a connection to an example store shared with other
+          improvement jobs.  Counterexamples found here are published to it,
+          and examples published by other jobs are picked up whenever the
+          search restarts.
 
     Key differences from "regular" enumerative synthesis:
         - Expressions are either "state" expressions or "runtime" expressions,
@@ -153,7 +164,8 @@ def improve(
         hints={hints!r},
         examples={examples!r},
         cost_model={cost_model!r},
-        ops={ops!r})""".format(
+        ops={ops!r},
+        shared_examples={shared_examples!r})""".format(
             target=target,
             context=context,
             assumptions=assumptions,
@@ -161,7 +173,8 @@ def improve(
             hints=hints,
             examples=examples,
             cost_model=cost_model,
-            ops=ops))
+            ops=ops,
+            shared_examples=shared_examples))
 
     target = inline_lets(target)
     target = freshen_binders(target, context)
@@ -203,6 +216,21 @@ def improve(
         yield construct_value(target.type)
         return
 
+    falsifier = random_assignment.Falsifier(
+        vars=vars,
+        funcs=funcs,
+        assumptions=assumptions,
+        stop_callback=stop_callback)
+
+    portfolio = None
+    if portfolio_opt.value:
+        portfolio = SolverPortfolio(
+            vars=vars,
+            funcs=funcs,
+            assumptions=assumptions,
+            members=default_portfolio(falsifier=allow_random_assignment_heuristic.value),
+            stop_callback=stop_callback)
+
     is_good = possibly_useful(solver, target, context)
     assert is_good, "WARNING: this target is already a bad idea\n is_good = {}, target = {}".format(is_good, target)
 
@@ -214,6 +242,10 @@ def improve(
     watched_targets = [target]
     blacklist = {}
 
+    # Reused across restarts caused by counterexamples; rebuilt whenever
+    # `watched_targets` changes.
+    enumerator = None
+
     while True:
 
         # 0. check whether we are allowed to keep working
@@ -230,8 +262,32 @@ def improve(
                 # improvements being actively worked on.
                 improve_count.value += 1
 
+        # 0.5. pick up counterexamples discovered by other jobs
+        if shared_examples is not None:
+            with task("receiving shared examples"):
+                new_examples = shared_examples.receive(context, assumptions)
+                for ex in new_examples:
+                    examples.append(ex)
+                    solver.add_example(ex)
+                    cost_model.solver.add_example(ex)
+                    if enumerator is not None:
+                        enumerator.add_example(ex)
+                if new_examples:
+                    print("received {} shared examples; now using {} examples".format(len(new_examples), len(examples)))
+
         # 1. find any potential improvement to any sub-exp of target
-        for new_target in search_for_improvements(
+        if enumerator is None:
+            enumerator = make_enumerator(
+                targets=watched_targets,
+                wf_solver=solver,
+                context=context,
+                examples=examples,
+                cost_model=cost_model,
+                stop_callback=stop_callback,
+                hints=hints,
+                ops=ops,
+                incremental=incremental_enumeration.value)
+        search = search_for_improvements(
                 targets=watched_targets,
                 wf_solver=solver,
                 context=context,
@@ -240,27 +296,39 @@ def improve(
                 stop_callback=stop_callback,
                 hints=hints,
                 ops=ops,
-                blacklist=blacklist):
+                blacklist=blacklist,
+                enumerator=enumerator)
+        for new_target in search:
             print("Found candidate improvement: {}".format(pprint(new_target)))
 
             # 2. check
             with task("verifying candidate"):
                 # try heuristic based solving first
                 e = ENot(EEq(target, new_target))
-                if allow_random_assignment_heuristic.value:
-                    if random_assignment.unsatisfiable(e):
-                        counterexample = None
-                    else:
-                        try:
-                            counterexample = random_assignment.satisfy(e, solver, assumptions)
-                        except Exception:
+                counterexample = falsifier.satisfy(e)
+                event(falsifier.report())
+                if counterexample is None:
+                    if portfolio is not None:
+                        # the portfolio races the heuristic against Z3
+                        if allow_random_assignment_heuristic.value and random_assignment.unsatisfiable(e):
                             counterexample = None
-                        if counterexample is None:
-                            event("failed assignmnents: for %s\n" % e)
-                            counterexample = solver.satisfy(e)
-                            event("counter-example: for %s\n" % counterexample)
-                else:
-                    counterexample = solver.satisfy(e)
+                        else:
+                            counterexample = solver.satisfy(e, fallback=portfolio)
+                            event(portfolio.report())
+                    elif allow_random_assignment_heuristic.value:
+                        if random_assignment.unsatisfiable(e):
+                            counterexample = None
+                        else:
+                            try:
+                                counterexample = random_assignment.satisfy(e, solver, assumptions)
+                            except Exception:
+                                counterexample = None
+                            if counterexample is None:
+                                event("failed assignmnents: for %s\n" % e)
+                                counterexample = solver.satisfy(e)
+                                event("counter-example: for %s\n" % counterexample)
+                    else:
+                        counterexample = solver.satisfy(e)
 
             if counterexample is not None:
                 if counterexample in examples:
@@ -272,6 +340,13 @@ def improve(
                 # a. if incorrect: add example, restart
                 examples.append(counterexample)
                 print("new example: {!r}".format(counterexample))
+                if shared_examples is not None:
+                    shared_examples.publish(context, counterexample)
+                search.close()
+                if incremental_enumeration.value:
+                    enumerator.add_example(counterexample)
+                else:
+                    enumerator = None
                 print("wrong; restarting with {} examples".format(len(examples)))
                 break
             else:
@@ -309,6 +384,7 @@ def improve(
 
                 watched_targets.append(new_target)
                 print("Now watching {} targets".format(len(watched_targets)))
+                enumerator = None
                 break
 
 SearchInfo = namedtuple("SearchInfo", (
@@ -320,7 +396,7 @@ SearchInfo = namedtuple("SearchInfo", (
     "cost_model",
     "blacklist"))
 
-def search_for_improvements(
+def make_enumerator(
         targets       : [Exp],
         wf_solver     : ModelCachingSolver,
         context       : Context,
@@ -329,14 +405,11 @@ def search_for_improvements(
         stop_callback : Callable[[], bool],
         hints         : [Exp],
         ops           : [Op],
-        blacklist     : {(Exp, Context, Pool, Exp) : str}):
-    """Search for potential improvements to any of the target expressions.
+        incremental   : bool = False) -> Enumerator:
+    """Construct the Enumerator that search_for_improvements uses.
 
-    This function yields expressions that look like improvements (or are
-    ambiguous with respect to some target).  The expressions are only
-    guaranteed to be correct on the given examples.
-
-    This function may add new items to the given blacklist.
+    The enumerator depends on the targets (through its hints and pruning), so
+    it can only be reused for as long as the targets do not change.
     """
 
     root_ctx = context
@@ -357,14 +430,53 @@ def search_for_improvements(
             *[all_subexpressions_with_context_information(t, root_ctx) for t in targets],
             *[all_subexpressions_with_context_information(h, root_ctx) for h in hints])))
         frags.sort(key=hint_order)
-        enum = Enumerator(
+        return Enumerator(
             examples=examples,
             cost_model=cost_model,
             check_wf=check_wf,
             hints=frags,
             heuristics=try_optimize,
             stop_callback=stop_callback,
-            do_eviction=enable_eviction.value)
+            do_eviction=enable_eviction.value,
+            incremental=incremental)
+
+def search_for_improvements(
+        targets       : [Exp],
+        wf_solver     : ModelCachingSolver,
+        context       : Context,
+        examples      : [{str:object}],
+        cost_model    : CostModel,
+        stop_callback : Callable[[], bool],
+        hints         : [Exp],
+        ops           : [Op],
+        blacklist     : {(Exp, Context, Pool, Exp) : str},
+        enumerator    : Enumerator = None):
+    """Search for potential improvements to any of the target expressions.
+
+    This function yields expressions that look like improvements (or are
+    ambiguous with respect to some target).  The expressions are only
+    guaranteed to be correct on the given examples.
+
+    If provided, `enumerator` should come from `make_enumerator` with the same
+    targets and examples; reusing it across calls avoids re-enumerating
+    expressions that were already seen.
+
+    This function may add new items to the given blacklist.
+    """
+
+    root_ctx = context
+    enum = enumerator
+    if enum is None:
+        enum = make_enumerator(
+            targets=targets,
+            wf_solver=wf_solver,
+            context=context,
+            examples=examples,
+            cost_model=cost_model,
+            stop_callback=stop_callback,
+            hints=hints,
+            ops=ops)
+    check_wf = enum.check_wf
 
     target_fp = Fingerprint.of(targets[0], examples)
 
@@ -378,12 +490,16 @@ def search_for_improvements(
                     watches_by_context[ctx] = l
                 l.append((target, e, pool))
 
+        # Candidates are matched to watched expressions by normal equality
+        # on their fingerprints (see Fingerprint.equal_to), so the watches are
+        # indexed by the normalized fingerprint.  This makes matching a
+        # dictionary lookup.
         watches = OrderedDict()
         for ctx, exprs in watches_by_context.items():
             exs = ctx.instantiate_examples(examples)
             for target, e, pool in exprs:
                 fp = Fingerprint.of(e, exs)
-                k = (fp, ctx, pool)
+                k = (ctx, pool, fp.normalized())
                 l = watches.get(k)
                 if l is None:
                     l = []
@@ -413,23 +529,16 @@ def search_for_improvements(
                 for info in enum.enumerate_with_info(size=size, context=ctx, pool=pool):
                     with task("searching for obvious substitution", expression=pprint(info.e)):
                         fp = info.fingerprint
-                        for ((fpx, cc, pp), reses) in watches.items():
-                            if cc != ctx or pp != pool:
-                                continue
+                        for target, watched_e in watches.get((ctx, pool, fp.normalized()), ()):
+                            replacement = info.e
+                            event("possible substitution: {} ---> {}".format(pprint(watched_e), pprint(replacement)))
+                            event("replacement locations: {}".format(pprint(replace(target, root_ctx, RUNTIME_POOL, watched_e, ctx, pool, EVar("___")))))
 
-                            if not fpx.equal_to(fp):
+                            if alpha_equivalent(watched_e, replacement):
+                                event("no change")
                                 continue
 
-                            for target, watched_e in reses:
-                                replacement = info.e
-                                event("possible substitution: {} ---> {}".format(pprint(watched_e), pprint(replacement)))
-                                event("replacement locations: {}".format(pprint(replace(target, root_ctx, RUNTIME_POOL, watched_e, ctx, pool, EVar("___")))))
-
-                                if alpha_equivalent(watched_e, replacement):
-                                    event("no change")
-                                    continue
-
-                                yield from _consider_replacement(target, watched_e, ctx, pool, replacement, search_info)
+                            yield from _consider_replacement(target, watched_e, ctx, pool, replacement, search_info)
 
         if check_blind_substitutions.value:
             print("Guessing at substitutions...")
@@ -19,6 +19,12 @@ from collections import namedtuple, defaultdict, OrderedDict
 import datetime
 import itertools
 import functools
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import weakref
 
 from cozy.common import pick_to_sum, OrderedSet, unique, make_random_access, StopException, Periodically
 from cozy.syntax import (
@@ -37,7 +43,9 @@ from cozy.target_syntax import (
     TMap, EMakeMap2, EMapKeys, EMapGet, EHasKey)
 from cozy.structures import all_extension_handlers
 from cozy.syntax_tools import pprint, fresh_var, free_vars, freshen_binders, alpha_equivalent, all_types
-from cozy.evaluation import eval_bulk, construct_value, values_equal
+from cozy.evaluation import eval_bulk, construct_value, MemoizingEvaluator
+from cozy.value_types import comparator, equality_key, EQ
+from cozy import value_types
 from cozy.typecheck import is_numeric, is_collection, is_ordered, is_hashable
 from cozy.cost_model import CostModel, Order
 from cozy.pools import Pool, RUNTIME_POOL, STATE_POOL, pool_name
@@ -50,6 +58,26 @@ do_enumerate = Option("enumeration", bool, True,
         + "Disabling this option cripples Cozy, but makes the effect of the "
         + "acceleration rules more apparent.")
 
+compositional_fingerprints = Option("compositional-fingerprints", bool, True,
+    description="Compute the fingerprint of each enumerated expression from "
+        + "the remembered outputs of its subexpressions instead of evaluating "
+        + "the whole expression on every example.")
+
+cache_memory_limit = Option("enumerator-memory-limit", int, 0,
+    metavar="MB",
+    description="Approximate memory budget for each enumerator's expression "
+        + "cache.  When the cache grows past the budget, the least recently "
+        + "used groups of same-size expressions are evicted and re-enumerated "
+        + "if they are needed again.  Re-enumeration is not guaranteed to "
+        + "find exactly the same expressions, since the cache has changed in "
+        + "the meantime.  0 means no limit.")
+
+cache_spill_dir = Option("enumerator-spill-dir", str, "",
+    metavar="DIR",
+    description="Write expressions evicted from the enumerator's cache to "
+        + "this directory instead of discarding them.  Only has an effect "
+        + "with --enumerator-memory-limit.")
+
 @functools.total_ordering
 class Fingerprint(object):
     """A summary of an expression's behavior on some inputs.
@@ -64,15 +92,16 @@ class Fingerprint(object):
     equivalence classes.  It uses fingerprints as keys into a map to quickly
     determine whether a semantically-equivalent version of an expression
     exists.  While fingerprints derived from different example inputs might have
-    different sizes, the behavior here is safe since the set of examples is
-    fixed at construction time for any one Enumerator class.
+    different sizes, the behavior here is safe since the Enumerator extends
+    every fingerprint it has cached whenever it is given a new example (see
+    Enumerator.add_example).
 
     External clients need to be more careful about how they use Fingerprints:
     comparisons between two Fingerprints are meaningless if they were derived
     from different inputs.  Clients also need to be aware that fingerprint
     equality does not imply full semantic equivalence between expressions.
     """
-    __slots__ = ("type", "outputs")
+    __slots__ = ("type", "outputs", "_normalized")
 
     @staticmethod
     def of(e : Exp, inputs : [{str:object}]):
@@ -82,6 +111,7 @@ class Fingerprint(object):
     def __init__(self, type : Type, outputs : [object]):
         self.type = type
         self.outputs = tuple(outputs)
+        self._normalized = None
 
     def _as_tuple(self):
         return (self.type, self.outputs)
@@ -112,6 +142,12 @@ class Fingerprint(object):
         """Returns the number of examples used to compute this fingerprint."""
         return len(self.outputs)
 
+    def extend(self, e : Exp, inputs : [{str:object}]):
+        """Compute the fingerprint of `e` over this fingerprint's inputs plus the given inputs.
+
+        This fingerprint must have been computed for `e`."""
+        return Fingerprint(self.type, self.outputs + tuple(eval_bulk(e, inputs)))
+
     def __repr__(self):
         return "Fingerprint{!r}".format(self._as_tuple())
 
@@ -133,10 +169,22 @@ class Fingerprint(object):
         compare_values in value_types.py.
         """
         self._require_comparable_to(other)
-        return (
-            self.type == other.type
-            and len(self.outputs) == len(other.outputs)
-            and all(values_equal(self.type, v1, v2) for (v1, v2) in zip(self.outputs, other.outputs)))
+        if self.type != other.type or len(self.outputs) != len(other.outputs):
+            return False
+        compare = comparator(self.type)
+        return all(compare(v1, v2) == EQ for (v1, v2) in zip(self.outputs, other.outputs))
+
+    def normalized(self):
+        """A hashable key for normal equality.
+
+        For fingerprints computed from the same inputs,
+        `fp1.equal_to(fp2)` is true exactly when
+        `fp1.normalized() == fp2.normalized()`.  Clients can use this to look
+        up normally-equal fingerprints in a dictionary.
+        """
+        if self._normalized is None:
+            self._normalized = (self.type, tuple(equality_key(self.type, v) for v in self.outputs))
+        return self._normalized
 
     def subset_of(self, other) -> bool:
         """Test for subset inclusion.
@@ -165,11 +213,12 @@ EnumeratedExp = namedtuple("EnumeratedExp", [
 
 LITERALS = (ETRUE, EFALSE, ZERO, ONE)
 
-def of_type(exps : [Exp], t : Type):
-    """Filter `exps` to expressions of the given type."""
+def group_by_type(exps : [Exp]) -> {Type : [Exp]}:
+    """Group `exps` by type, keeping their order within each type."""
+    res = OrderedDict()
     for e in exps:
-        if e.type == t:
-            yield e
+        res.setdefault(e.type, []).append(e)
+    return res
 
 def collections(exps : [Exp]):
     """Filter `exps` to collection-type expressions."""
@@ -243,6 +292,18 @@ def retention_policy(new_exp : Exp, new_ctx : Context, old_exp : Exp, old_ctx :
     if ordering == Order.AMBIGUOUS: return [new_exp, old_exp]
     raise ValueError(ordering)
 
+def approximate_size(x) -> int:
+    """Estimate the number of bytes of memory used by `x`.
+
+    This is `value_types.approximate_size`, extended to look inside
+    fingerprints and cache entries.
+    """
+    if isinstance(x, Fingerprint):
+        return sys.getsizeof(x) + value_types.approximate_size(x.outputs)
+    if isinstance(x, EnumeratedExp):
+        return sys.getsizeof(x) + sum(approximate_size(y) for y in x)
+    return value_types.approximate_size(x)
+
 class ExpCache(object):
     """Cache for expressions used by Enumerator instances.
 
@@ -252,15 +313,46 @@ class ExpCache(object):
      - find all unique contexts (all_contexts)
      - find all expressions of a given size (find_expressions_of_size)
      - find all expressions with a given fingerprint (find_equivalent_expressions)
+
+    The cache also keeps track of the approximate memory used by each "level"
+    (the expressions of one size in one context and pool) and when each level
+    was last used.  If the cache was built with a memory limit, clients can
+    ask for `levels_to_evict` and then drop those levels with `evict_level`.
+    If the cache was built with a spill directory, evicted levels are written
+    to disk instead and read back the next time they are looked up by size or
+    might contain an expression with a fingerprint being looked up.
     """
 
-    def __init__(self):
-        """Construct an empty cache."""
+    def __init__(self, memory_limit : int = 0, spill_directory : str = None):
+        """Construct an empty cache.
+
+        Parameters:
+         - memory_limit: approximate number of bytes the cache may use, or 0
+           for no limit
+         - spill_directory: directory for evicted levels, or None to discard
+           them
+        """
         self.data = OrderedDict() # (Pool, Context) -> (size -> [EnumeratedExp], Fingerprint -> [EnumeratedExp])
+        self.count = 0
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+        self.level_bytes = defaultdict(int) # (Pool, Context, size) -> bytes
+        self.last_used = OrderedDict()      # (Pool, Context, size) -> None, least recently used first
+        self.spill_directory = spill_directory
+        self._spill_files = { }             # (Pool, Context, size) -> path
+        self._spilled_fingerprints = { }    # (Pool, Context, hash of Fingerprint) -> {size}
+        self._spill_tempdir = None
+
+        # Totals for `report`
+        self.evicted_levels = 0
+        self.evicted_exps = 0
+        self.evicted_bytes = 0
+        self.spilled_levels = 0
+        self.reloaded_levels = 0
 
     def __len__(self):
         """Return the total number of cached expressions across all contexts and pools."""
-        return sum(sum(len(l) for l in d.values()) for d, _ in self.data.values())
+        return self.count
 
     def add(self, context : Context, pool : Pool, enumerated_exp : EnumeratedExp):
         """Insert an expression into the cache for a given context and pool.
@@ -276,6 +368,8 @@ class ExpCache(object):
         by_size, by_fingerprint = storage
         by_size[enumerated_exp.size].append(enumerated_exp)
         by_fingerprint[enumerated_exp.fingerprint].append(enumerated_exp)
+        self.count += 1
+        self._account(pool, context, enumerated_exp, 1)
 
     def remove(self, context : Context, pool : Pool, enumerated_exp : EnumeratedExp):
         """Remove an expression from the cache for a given context and pool.
@@ -289,6 +383,123 @@ class ExpCache(object):
         by_size, by_fingerprint = self.data[key]
         by_size[enumerated_exp.size].remove(enumerated_exp)
         by_fingerprint[enumerated_exp.fingerprint].remove(enumerated_exp)
+        self.count -= 1
+        self._account(pool, context, enumerated_exp, -1)
+
+    def _account(self, pool, context, enumerated_exp, sign):
+        if not self.memory_limit:
+            return
+        nbytes = sign * approximate_size(enumerated_exp)
+        self.level_bytes[(pool, context, enumerated_exp.size)] += nbytes
+        self.memory_used += nbytes
+
+    def touch(self, context : Context, pool : Pool, size : int):
+        """Record that the expressions of the given size were just used."""
+        level = (pool, context, size)
+        self.last_used.pop(level, None)
+        self.last_used[level] = None
+
+    def over_budget(self) -> bool:
+        """Determine whether the cache is using more memory than its limit."""
+        return bool(self.memory_limit) and self.memory_used > self.memory_limit
+
+    def levels_to_evict(self) -> [(Context, Pool, int)]:
+        """Iterate over the (context, pool, size) levels in eviction order.
+
+        The least recently used levels come first; among levels that were last
+        used at the same time, larger sizes come first since they are rarely
+        needed to build other expressions.  Only levels that hold expressions
+        in memory are returned.
+        """
+        order = { level : i for (i, level) in enumerate(self.last_used) }
+        levels = [level for level, nbytes in self.level_bytes.items() if nbytes > 0]
+        levels.sort(key=lambda level: (order.get(level, -1), -level[2]))
+        for (pool, context, size) in levels:
+            yield (context, pool, size)
+
+    def evict_level(self, context : Context, pool : Pool, size : int) -> bool:
+        """Remove all expressions of the given size in the given context and pool.
+
+        If the cache has a spill directory, the expressions are written to disk
+        and will be read back when they are looked up again.  Returns True if
+        the expressions were spilled and False if they were discarded.
+
+        Callers that are iterating over the level while it is evicted will
+        still see all of its expressions.
+        """
+        key = (pool, context)
+        level = (pool, context, size)
+        by_size, by_fingerprint = self.data.get(key, ({}, {}))
+        if size not in by_size:
+            return False
+        entries = by_size.pop(size)
+        for fp in unique(entry.fingerprint for entry in entries):
+            # NOTE: build new lists rather than editing the old ones, in case
+            # a caller is iterating over them.
+            remaining = [entry for entry in by_fingerprint[fp] if entry.size != size]
+            if remaining:
+                by_fingerprint[fp] = remaining
+            else:
+                del by_fingerprint[fp]
+        nbytes = self.level_bytes.pop(level, 0)
+        self.memory_used -= nbytes
+        self.count -= len(entries)
+        self.last_used.pop(level, None)
+
+        self.evicted_levels += 1
+        self.evicted_exps += len(entries)
+        self.evicted_bytes += nbytes
+
+        if self.spill_directory is None or not entries:
+            return False
+        if self._spill_tempdir is None:
+            self._spill_tempdir = tempfile.mkdtemp(prefix="cozy-cache-", dir=self.spill_directory)
+            weakref.finalize(self, shutil.rmtree, self._spill_tempdir, True)
+        fd, path = tempfile.mkstemp(suffix=".pickle", dir=self._spill_tempdir)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(entries, f)
+        self._spill_files[level] = path
+        for entry in entries:
+            self._spilled_fingerprints.setdefault((pool, context, hash(entry.fingerprint)), set()).add(size)
+        self.spilled_levels += 1
+        return True
+
+    def is_spilled(self, context : Context, pool : Pool, size : int) -> bool:
+        """Determine whether the given level is on disk."""
+        return (pool, context, size) in self._spill_files
+
+    def _reload(self, context, pool, size):
+        path = self._spill_files.pop((pool, context, size), None)
+        if path is None:
+            return
+        with open(path, "rb") as f:
+            entries = pickle.load(f)
+        os.remove(path)
+        for entry in entries:
+            k = (pool, context, hash(entry.fingerprint))
+            sizes = self._spilled_fingerprints.get(k)
+            if sizes is not None:
+                sizes.discard(size)
+                if not sizes:
+                    del self._spilled_fingerprints[k]
+            self.add(context, pool, entry)
+        self.reloaded_levels += 1
+
+    def reload_all(self):
+        """Read every spilled level back into memory."""
+        for (pool, context, size) in list(self._spill_files):
+            self._reload(context, pool, size)
+
+    def report(self) -> str:
+        """Describe the memory use of the cache and what has been evicted."""
+        return "|cache|={} (~{} KiB); evicted {} exps in {} levels (~{} KiB); spilled {} levels, reloaded {}".format(
+            self.count,
+            self.memory_used // 1024,
+            self.evicted_exps,
+            self.evicted_levels,
+            self.evicted_bytes // 1024,
+            self.spilled_levels,
+            self.reloaded_levels)
 
     def all_contexts(self) -> [Context]:
         """Iterate over the unique contexts that the cache has seen."""
@@ -296,11 +507,17 @@ class ExpCache(object):
 
     def find_expressions_of_size(self, context : Context, pool : Pool, size : int) -> [EnumeratedExp]:
         """Iterate over all expressions of the given size in the given context and pool."""
+        self._reload(context, pool, size)
         key = (pool, context)
         yield from self.data.get(key, ({}, {}))[0].get(size, ())
 
     def find_equivalent_expressions(self, context : Context, pool : Pool, fingerprint : Fingerprint) -> [EnumeratedExp]:
         """Iterate over all expressions with the given fingerprint in the given context and pool."""
+        # Spilled levels that might have expressions with this fingerprint
+        # have to be read back in.  Only the hashes of their fingerprints are
+        # kept in memory.
+        for size in list(self._spilled_fingerprints.get((pool, context, hash(fingerprint)), ())):
+            self._reload(context, pool, size)
         key = (pool, context)
         yield from self.data.get(key, ({}, {}))[1].get(fingerprint, ())
 
@@ -314,9 +531,11 @@ class Enumerator(object):
      - if two expressions behave the same on all examples, only the better one
        is kept in the cache (although clients might still see the worse one if
        it gets discovered first)
+     - if constructed with incremental=True, new examples can be added with
+       `add_example` without throwing away the cache
     """
 
-    def __init__(self, examples, cost_model : CostModel, check_wf=None, hints=None, heuristics=None, stop_callback=None, do_eviction=True):
+    def __init__(self, examples, cost_model : CostModel, check_wf=None, hints=None, heuristics=None, stop_callback=None, do_eviction=True, incremental=False):
         """Set up a fresh enumerator.
 
         Parameters:
@@ -331,10 +550,28 @@ class Enumerator(object):
            enumeration
          - do_eviction: boolean. if true, this class spends time
            trying to evict older, slower versions of expressions from its cache
+         - incremental: boolean. if true, this class remembers the expressions
+           it drops in favor of fingerprint-equivalent ones so that
+           `add_example` can bring them back.  This costs memory.
         """
         self.examples = list(examples)
         self.cost_model = cost_model
-        self.cache = ExpCache()
+        self.cache = self._new_cache()
+
+        # (pool, context) -> [EnumeratedExp].  Expressions that were skipped
+        # or evicted because a fingerprint-equivalent expression was
+        # preferred.  Only maintained when `incremental` is true.
+        self.incremental = incremental
+        self.shadowed = OrderedDict()
+
+        # Context.canonical_key() -> [Context].  The contexts that have been
+        # used as canonical representatives (see `canonical_context`).
+        self.canonical_contexts = { }
+
+        # Context -> MemoizingEvaluator.  Computes fingerprints in each
+        # context, sharing the outputs of common subexpressions between the
+        # expressions enumerated there.
+        self.evaluators = { }
 
         # Set of (pool, size, context) tuples that are currently being
         # enumerated.  This is used to catch infinite recursion bugs, since
@@ -366,12 +603,110 @@ class Enumerator(object):
         self.do_eviction = do_eviction
         self.stat_timer = Periodically(self.print_stats, timespan=datetime.timedelta(seconds=2))
 
+    def _evaluator(self, context : Context) -> MemoizingEvaluator:
+        evaluator = self.evaluators.get(context)
+        if evaluator is None:
+            evaluator = MemoizingEvaluator(context.instantiate_examples(self.examples))
+            self.evaluators[context] = evaluator
+        return evaluator
+
+    def _new_cache(self):
+        return ExpCache(
+            memory_limit=cache_memory_limit.value * 2**20,
+            spill_directory=cache_spill_dir.value or None)
+
     def print_stats(self):
-        print("  |cache|={}".format(self.cache_size()))
+        print("  {}".format(self.cache.report()))
 
     def cache_size(self):
         return len(self.cache)
 
+    def _shadow(self, context : Context, pool : Pool, entry : EnumeratedExp):
+        if self.incremental:
+            self.shadowed.setdefault((pool, context), []).append(entry)
+
+    def _abandon_incomplete(self):
+        """Forget the results of enumerations that were interrupted.
+
+        Clients may stop consuming `enumerate` partway through.  The partial
+        results are dropped so that those sizes can be enumerated again."""
+        for (pool, size, context) in self.in_progress:
+            for entry in list(self.cache.find_expressions_of_size(context, pool, size)):
+                self.cache.remove(context, pool, entry)
+            l = self.shadowed.get((pool, context))
+            if l:
+                l[:] = [entry for entry in l if entry.size != size]
+        self.in_progress.clear()
+
+    def add_example(self, example : {str:object}):
+        """Add a new example input without starting over.
+
+        Every cached fingerprint is extended with the output on the new
+        example, and equivalence classes that the new example splits are
+        re-formed from the expressions that were dropped from them.  If that
+        brings back an expression of size N, then expressions larger than N
+        may have been built from it and are enumerated again on demand; the
+        work for sizes up to N is kept.
+
+        The Enumerator must have been constructed with incremental=True.  Any
+        enumeration that was in progress is abandoned.
+        """
+        if not self.incremental:
+            raise ValueError("add_example requires an incremental Enumerator")
+
+        self._abandon_incomplete()
+        self.examples.append(example)
+
+        old_cache = self.cache
+        old_cache.reload_all()
+        old_shadowed = self.shadowed
+        self.cache = self._new_cache()
+        self.shadowed = OrderedDict()
+        self.evaluators = { }
+        promoted_sizes = []
+
+        # Context -> MemoizingEvaluator for just the new example, so that
+        # subexpressions shared by many cached expressions are evaluated on
+        # it once.
+        new_evaluators = { }
+        def extend(entry, context):
+            new_evaluator = new_evaluators.get(context)
+            if new_evaluator is None:
+                new_evaluator = MemoizingEvaluator(context.instantiate_examples([example]))
+                new_evaluators[context] = new_evaluator
+            fp = Fingerprint(entry.fingerprint.type, entry.fingerprint.outputs + new_evaluator.eval(entry.e))
+            if compositional_fingerprints.value:
+                self._evaluator(context).remember(entry.e, fp.outputs)
+            return entry._replace(fingerprint=fp)
+
+        with task("adding example", cache_size=len(old_cache)):
+            for key in unique(itertools.chain(old_cache.data.keys(), old_shadowed.keys())):
+                pool, context = key
+                by_size = old_cache.data.get(key, ({}, {}))[0]
+                for entries in by_size.values():
+                    for entry in entries:
+                        self.cache.add(context, pool, extend(entry, context))
+                for entry in sorted(old_shadowed.get(key, ()), key=lambda entry: entry.size):
+                    entry = extend(entry, context)
+                    if any(True for _ in self.cache.find_equivalent_expressions(context, pool, entry.fingerprint)):
+                        self._shadow(context, pool, entry)
+                    else:
+                        self.cache.add(context, pool, entry)
+                        promoted_sizes.append(entry.size)
+
+        if promoted_sizes:
+            # Expressions larger than the smallest promoted expression might
+            # have been built from it; they need to be enumerated again.
+            max_valid_size = min(promoted_sizes)
+            print("new example split classes at size {}; re-enumerating larger sizes".format(max_valid_size))
+            for (pool, context), (by_size, _) in list(self.cache.data.items()):
+                for size in [sz for sz in by_size.keys() if sz > max_valid_size]:
+                    for entry in list(by_size[size]):
+                        self.cache.remove(context, pool, entry)
+            for l in self.shadowed.values():
+                l[:] = [entry for entry in l if entry.size <= max_valid_size]
+            self.complete = set(k for k in self.complete if k[1] <= max_valid_size)
+
     def _enumerate_core(self, context : Context, size : int, pool : Pool) -> [Exp]:
         """Build new expressions of the given size.
 
@@ -426,6 +761,12 @@ class Enumerator(object):
         # cache[S] contains expressions of size S in this context and pool.
         cache = [list(self.enumerate(context, sz, pool)) for sz in range(size)]
 
+        # by_type[S][T] contains the expressions of size S and type T,
+        # in the same order as cache[S].  Most pairs of expressions have
+        # incompatible types, so the productions below look up their operands
+        # here instead of filtering cache[S].
+        by_type = [group_by_type(es) for es in cache]
+
         # Enable use of a state-pool expression at runtime
         if pool == RUNTIME_POOL:
             for e in self.enumerate(context.root(), size-1, STATE_POOL):
@@ -483,19 +824,19 @@ class Enumerator(object):
                 t = e1.type
 
                 if is_numeric(t):
-                    for a2 in of_type(cache[sz2], t):
+                    for a2 in by_type[sz2].get(t, ()):
                         yield EBinOp(e1, "+", a2).with_type(t)
                         yield EBinOp(e1, "-", a2).with_type(t)
 
                 if is_ordered(t):
-                    for a2 in of_type(cache[sz2], t):
+                    for a2 in by_type[sz2].get(t, ()):
                         yield EBinOp(e1, ">", a2).with_type(BOOL)
                         yield EBinOp(e1, "<", a2).with_type(BOOL)
                         yield EBinOp(e1, ">=", a2).with_type(BOOL)
                         yield EBinOp(e1, "<=", a2).with_type(BOOL)
 
                 if t == BOOL:
-                    for a2 in of_type(cache[sz2], BOOL):
+                    for a2 in by_type[sz2].get(BOOL, ()):
                         yield EBinOp(e1, BOp.And, a2).with_type(BOOL)
                         yield EBinOp(e1, BOp.Or, a2).with_type(BOOL)
                         # Cozy supports the implication operator "=>", but this
@@ -506,25 +847,25 @@ class Enumerator(object):
                         #    desugar it to ((not a) or b) anyway.
 
                 if not isinstance(t, TMap):
-                    for a2 in of_type(cache[sz2], t):
+                    for a2 in by_type[sz2].get(t, ()):
                         yield EEq(e1, a2)
                         yield EBinOp(e1, "!=", a2).with_type(BOOL)
 
                 if isinstance(t, TMap):
-                    for k in of_type(cache[sz2], t.k):
+                    for k in by_type[sz2].get(t.k, ()):
                         yield EMapGet(e1, k).with_type(t.v)
                         yield EHasKey(e1, k).with_type(BOOL)
 
                 if isinstance(t, TList):
-                    for i in of_type(cache[sz2], INT):
+                    for i in by_type[sz2].get(INT, ()):
                         yield EListGet(e1, i).with_type(e1.type.elem_type)
 
                 if is_collection(t):
                     elem_type = t.elem_type
-                    for e2 in of_type(cache[sz2], t):
+                    for e2 in by_type[sz2].get(t, ()):
                         yield EBinOp(e1, "+", e2).with_type(t)
                         yield EBinOp(e1, "-", e2).with_type(t)
-                    for e2 in of_type(cache[sz2], elem_type):
+                    for e2 in by_type[sz2].get(elem_type, ()):
                         yield EBinOp(e2, BOp.In, e1).with_type(BOOL)
                     for f in build_lambdas(e1, pool, sz2):
                         body_type = f.body.type
@@ -551,11 +892,11 @@ class Enumerator(object):
                 if e1.type == BOOL:
                     cond = e1
                     for then_branch in cache[sz2]:
-                        for else_branch in of_type(cache[sz3], then_branch.type):
+                        for else_branch in by_type[sz3].get(then_branch.type, ()):
                             yield ECond(cond, then_branch, else_branch).with_type(then_branch.type)
                 if isinstance(e1.type, TList):
-                    for start in of_type(cache[sz2], INT):
-                        for end in of_type(cache[sz3], INT):
+                    for start in by_type[sz2].get(INT, ()):
+                        for end in by_type[sz3].get(INT, ()):
                             yield EListSlice(e1, start, end).with_type(e1.type)
                             # It is not necessary to create slice expressions of
                             # the form a[:i] or a[i:].  Those are desugared
@@ -588,9 +929,17 @@ class Enumerator(object):
         This canonical representative is the one used in the cache.
         """
         # TODO: deduplicate based on examples, not alpha equivalence
-        for ctx in self.cache.all_contexts():
-            if ctx != context and ctx.alpha_equivalent(context):
+        key = context.canonical_key()
+        candidates = self.canonical_contexts.get(key)
+        if candidates is None:
+            candidates = []
+            self.canonical_contexts[key] = candidates
+        for ctx in candidates:
+            if ctx == context:
+                return context
+            if ctx.alpha_equivalent(context):
                 return ctx
+        candidates.append(context)
         return context
 
     def enumerate_with_info(self, context : Context, size : int, pool : Pool) -> [EnumeratedExp]:
@@ -614,6 +963,7 @@ class Enumerator(object):
 
         k = (pool, size, context)
         cache = self.cache
+        cache.touch(context, pool, size)
 
         if k in self.complete:
             yield from cache.find_expressions_of_size(context, pool, size)
@@ -623,6 +973,40 @@ class Enumerator(object):
             yield from self._enumerate_with_info(context, size, pool)
             self.in_progress.remove(k)
             self.complete.add(k)
+            self._enforce_memory_limit(keep=k)
+
+    def _enforce_memory_limit(self, keep):
+        """Evict levels from the cache until it is within its memory limit.
+
+        Only fully-enumerated levels are evicted, and never the level `keep`.
+
+        Levels that the cache discards (rather than spills to disk) are marked
+        incomplete so that they will be enumerated again if needed.  Since
+        the deduplication of larger expressions in the same context and pool
+        depended on the discarded ones, the larger levels are discarded along
+        with them; re-enumeration then produces the same results as before.
+        """
+        cache = self.cache
+        if not cache.over_budget():
+            return
+        spill = cache.spill_directory is not None
+        with task("evicting cold levels", memory_used=cache.memory_used, memory_limit=cache.memory_limit):
+            for (context, pool, size) in list(cache.levels_to_evict()):
+                if not cache.over_budget():
+                    break
+                k = (pool, size, context)
+                if k == keep or k not in self.complete:
+                    continue
+                if spill:
+                    cache.evict_level(context, pool, size)
+                    continue
+                if any(p == pool and c == context and sz >= size for (p, sz, c) in itertools.chain(self.in_progress, [keep])):
+                    continue
+                doomed = [kk for kk in self.complete if kk[0] == pool and kk[2] == context and kk[1] >= size]
+                for kk in doomed:
+                    cache.evict_level(context, pool, kk[1])
+                    self.complete.discard(kk)
+            event(cache.report())
 
     def _enumerate_with_info(self, context : Context, size : int, pool : Pool) -> [EnumeratedExp]:
         """Helper for enumerate_with_info that bypasses the cache.
@@ -638,6 +1022,10 @@ class Enumerator(object):
         queue = self._enumerate_core(context, size, pool)
         cost_model = self.cost_model
 
+        # All pools in a context share the same example inputs, so they share
+        # an evaluator too.
+        evaluator = self._evaluator(context)
+
         while True:
             if self.stop_callback():
                 raise StopException()
@@ -660,7 +1048,10 @@ class Enumerator(object):
                 _skip(e, size, context, pool, "wf={}".format(wf))
                 continue
 
-            fp = Fingerprint.of(e, examples)
+            if compositional_fingerprints.value:
+                fp = Fingerprint(e.type, evaluator.eval(e))
+            else:
+                fp = Fingerprint.of(e, examples)
 
             # Collect all expressions from parent contexts that are
             # fingerprint-equivalent to this one.  There might be more than one
@@ -682,6 +1073,7 @@ class Enumerator(object):
                             to_keep = retention_policy(e, context, prev_exp, context, pool, cost_model)
                             if e not in to_keep:
                                 _skip(e, size, context, pool, "preferring {}".format(pprint(prev_exp)))
+                                self._shadow(context, pool, EnumeratedExp(e=e, fingerprint=fp, size=size))
                                 should_keep = False
                                 break
                             if prev_exp not in to_keep:
@@ -696,6 +1088,7 @@ class Enumerator(object):
                         for entry in to_evict:
                             _evict(entry.e, entry.size, context, pool, e, size)
                             cache.remove(context, pool, entry)
+                            self._shadow(context, pool, entry)
 
                 _accept(e, size, context, pool, fp)
                 info = EnumeratedExp(
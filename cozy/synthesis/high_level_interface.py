@@ -11,21 +11,23 @@ from typing import Callable, Any
 import sys
 import os
 import pickle
-from queue import Empty
 from multiprocessing import Value
 
 from cozy.common import typechecked, OrderedSet, LINE_BUFFER_MODE
-from cozy.syntax import Query, Op, Exp, EVar, EAll
+from cozy.syntax import Query, Op, Exp, EVar, EAll, Visibility
 from cozy.target_syntax import EStateVar
 from cozy.syntax_tools import pprint, unpack_representation, shallow_copy, wrap_naked_statevars
 from cozy.timeouts import Timeout
 from cozy import jobs
 from cozy.contexts import Context
 from cozy.opts import Option
-from cozy.cost_model import CostModel
+from cozy.cost_model import CostModel, asymptotic_runtime
+from cozy.solver import solver_pool
+from cozy.solver_cache import solver_cache
 
 from . import core
 from .impls import Implementation
+from .shared_examples import SharedExamples, start_example_store
 
 nice_children = Option("nice-children", bool, False,
     description='Apply a high Unix "niceness" value to child processes. '
@@ -35,6 +37,48 @@ nice_children = Option("nice-children", bool, False,
 log_dir = Option("log-dir", str, "/tmp",
     description="Location to place log files for child processes.")
 
+use_worker_pool = Option("worker-pool", bool, True,
+    description="Run improvement jobs in a pool of reusable worker processes "
+        + "instead of spawning a fresh process for every job.  Reusing "
+        + "workers avoids paying for interpreter startup and module imports "
+        + "each time Cozy starts working on a new query.")
+
+share_examples = Option("share-examples", bool, True,
+    description="Let improvement jobs share the counterexamples they get "
+        + "from the solver, so that each job does not have to rediscover "
+        + "them through its own solver calls.")
+
+max_jobs = Option("max-jobs", int, 0, metavar="N",
+    description="Maximum number of improvement jobs to run at once.  When "
+        + "there are more queries than this, the extra queries wait for a "
+        + "free slot.  0 means no limit (one job per query).")
+
+job_time_slice = Option("job-time-slice", int, 60, metavar="SECONDS",
+    description="When --max-jobs is in effect and queries are waiting, an "
+        + "improvement job that has run for this long is stopped to make room "
+        + "for a waiting query and is resumed later from its best solution.  "
+        + "0 means jobs are never preempted.")
+
+def query_priority(impl : Implementation, q : Query):
+    """Sort key for deciding which queries get to run first.
+
+    Public queries come before private ones, since only public queries are
+    visible to clients of the data structure.  Within each group, queries
+    whose current implementation is the most expensive according to the
+    cost model's asymptotic runtime (and then size) come first, since those
+    have the most to gain from further synthesis.
+
+    The full CostModel comparison is not used here because it may need the
+    solver and is only defined between expressions in the same context.
+    """
+    ret = impl.query_impls[q.name].ret if q.name in impl.query_impls else q.ret
+    runtime = asymptotic_runtime(ret)
+    return (
+        q.visibility != Visibility.Public,
+        -runtime.exponent,
+        -runtime.multiplier,
+        -ret.size())
+
 class ImproveQueryJob(jobs.Job):
     @typechecked
     def __init__(self,
@@ -46,7 +90,9 @@ class ImproveQueryJob(jobs.Job):
             hints       : [Exp]     = [],
             freebies    : [Exp]     = [],
             ops         : [Op]      = [],
-            improve_count             = None):
+            improve_count             = None,
+            example_store             = None,
+            resumed     : bool      = False):
         super().__init__()
         self.state = state
         self.assumptions = assumptions
@@ -59,6 +105,10 @@ class ImproveQueryJob(jobs.Job):
         self.ops = ops
         self.solutions_q = solutions_q
         self.improve_count = improve_count
+        self.example_store = example_store
+        # True if q.ret is a solution the parent already has (so the job
+        # should not report it again)
+        self.resumed = resumed
     def __str__(self):
         return "ImproveQueryJob[{}]".format(self.q.name)
     def run(self):
@@ -66,16 +116,21 @@ class ImproveQueryJob(jobs.Job):
         with open(os.path.join(log_dir.value, "{}.log".format(self.q.name)), "w", buffering=LINE_BUFFER_MODE) as f:
             original_stdout = sys.stdout
             sys.stdout = f
+            shared_examples = None
 
             try:
                 print("STARTING IMPROVEMENT JOB {}".format(self.q.name))
                 print(pprint(self.q))
 
-                if nice_children.value:
+                # (pooled workers are reniced once, when they start)
+                if nice_children.value and not jobs.in_worker_pool():
                     os.nice(20)
 
                 stop_callback = lambda: self.stop_requested
 
+                if self.example_store is not None:
+                    shared_examples = SharedExamples(self.example_store)
+
                 cost_model = CostModel(
                         funcs=self.context.funcs(),
                         assumptions=EAll(self.assumptions),
@@ -83,7 +138,7 @@ class ImproveQueryJob(jobs.Job):
                         ops=self.ops,
                         solver_args={"stop_callback": stop_callback})
 
-                for expr in itertools.chain((self.q.ret,), core.improve(
+                for expr in itertools.chain(() if self.resumed else (self.q.ret,), core.improve(
                         target=self.q.ret,
                         assumptions=EAll(self.assumptions),
                         context=self.context,
@@ -91,7 +146,8 @@ class ImproveQueryJob(jobs.Job):
                         stop_callback=stop_callback,
                         cost_model=cost_model,
                         ops=self.ops,
-                        improve_count=self.improve_count)):
+                        improve_count=self.improve_count,
+                        shared_examples=shared_examples)):
 
                     self.solutions_q.put((self.q, expr))
 
@@ -100,6 +156,12 @@ class ImproveQueryJob(jobs.Job):
                 print("stopping synthesis of {}".format(self.q.name))
                 return
             finally:
+                if shared_examples is not None:
+                    print("shared {} examples with other jobs; received {}".format(shared_examples.sent, shared_examples.received))
+                print(solver_pool.report())
+                cache = solver_cache()
+                if cache is not None:
+                    print(cache.report())
                 # Restore the original stdout handle.  Python multiprocessing does
                 # some stream flushing as the process exits, and if we leave stdout
                 # unchanged then it will refer to a closed file when that happens.
@@ -130,140 +192,233 @@ def improve_implementation(
     # we statefully modify `impl`, so let's make a defensive copy which we will modify instead
     impl = impl.safe_copy()
 
-    # worker threads ("jobs"), one per query
+    # worker threads ("jobs"), at most one per query
     improvement_jobs = []
 
+    # bookkeeping for the --max-jobs scheduler
+    budget = max_jobs.value if max_jobs.value > 0 else None
+    waiting = []            # names of queries that need a job but do not have one
+    slices_used = { }       # query name -> number of times a job was started for it
+    job_start_times = { }   # job -> time when it was started
+    best_solutions = { }    # query name -> best packed expression so far
+    failed_jobs = set()     # jobs that stopped with an exception (reported once)
+
+    # counterexamples shared between the jobs
+    example_manager, example_store = None, None
+    if share_examples.value:
+        example_manager, example_store = start_example_store()
+
     with jobs.SafeQueue() as solutions_q:
 
+        # warm worker processes to run the jobs
+        pool = None
+        if use_worker_pool.value:
+            pool = jobs.WorkerPool(
+                size=len(impl.query_specs) if budget is None else min(budget, len(impl.query_specs)),
+                shared=[x for x in (solutions_q.handle_for_subjobs(), improve_count) if x is not None],
+                preload=[__name__],
+                nice=20 if nice_children.value else 0)
+
         def stop_jobs(js):
             """Stop the given jobs and remove them from `improvement_jobs`."""
             js = list(js)
             jobs.stop_jobs(js)
             for j in js:
                 improvement_jobs.remove(j)
+                job_start_times.pop(j, None)
+
+        def start_job(q):
+            """Start an improvement job for `q`.
+
+            If an earlier job for `q` was preempted, the new job resumes from
+            the best solution found so far rather than from the specification.
+            """
+            states_maintained_by_q = impl.states_maintained_by(q)
+            print("STARTING IMPROVEMENT JOB {}".format(q.name))
+            resumed = q.name in best_solutions
+            if resumed:
+                q = shallow_copy(q)
+                q.ret = best_solutions[q.name]
+            j = ImproveQueryJob(
+                impl.abstract_state,
+                list(impl.spec.assumptions) + list(q.assumptions),
+                q,
+                context=impl.context_for_method(q),
+                solutions_q=solutions_q.handle_for_subjobs(),
+                hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()],
+                freebies=[e for (v, e) in impl.concretization_functions.items() if EVar(v) in states_maintained_by_q],
+                ops=impl.op_specs,
+                improve_count=improve_count,
+                example_store=example_store,
+                resumed=resumed)
+            j.start(pool=pool)
+            improvement_jobs.append(j)
+            job_start_times[j] = datetime.datetime.now()
+            slices_used[q.name] = slices_used.get(q.name, 0) + 1
+
+        def schedule_jobs():
+            """Hand out free job slots to waiting queries.
+
+            Waiting queries are served round-robin by the number of time
+            slices they have had so far, and by `query_priority` within a
+            round.  If no slot is free, jobs that have used up their time
+            slice are preempted to make room."""
+
+            if not waiting:
+                return
+
+            queries_by_name = OrderedDict((q.name, q) for q in impl.query_specs)
+            waiting.sort(key=lambda name: (slices_used.get(name, 0), query_priority(impl, queries_by_name[name])))
+
+            running = [j for j in improvement_jobs if not j.done]
+            free_slots = len(waiting) if budget is None else budget - len(running)
+
+            if free_slots < len(waiting) and job_time_slice.value > 0:
+                now = datetime.datetime.now()
+                expired = [j for j in running if (now - job_start_times[j]).total_seconds() >= job_time_slice.value]
+                expired.sort(key=lambda j: query_priority(impl, queries_by_name[j.q.name]), reverse=True)
+                preempted = expired[:len(waiting) - max(free_slots, 0)]
+                if preempted:
+                    print("preempting {} jobs: {}".format(len(preempted), ", ".join(j.q.name for j in preempted)))
+                    stop_jobs(preempted)
+                    free_slots += len(preempted)
+                    waiting.extend(j.q.name for j in preempted)
+
+            to_start = waiting[:max(free_slots, 0)]
+            del waiting[:len(to_start)]
+            for name in to_start:
+                start_job(queries_by_name[name])
 
         def reconcile_jobs():
             """Sync up the current set of jobs and the set of queries.
 
-            This function spawns new jobs for new queries and cleans up old
+            This function queues new queries for improvement and cleans up old
             jobs whose queries have been dead-code-eliminated."""
 
-            # figure out what new jobs we need
-            job_query_names  = set(j.q.name for j in improvement_jobs)
-            new = []
-            for q in impl.query_specs:
-                if q.name not in job_query_names:
-                    states_maintained_by_q = impl.states_maintained_by(q)
-                    print("STARTING IMPROVEMENT JOB {}".format(q.name))
-                    new.append(ImproveQueryJob(
-                        impl.abstract_state,
-                        list(impl.spec.assumptions) + list(q.assumptions),
-                        q,
-                        context=impl.context_for_method(q),
-                        solutions_q=solutions_q.handle_for_subjobs(),
-                        hints=[EStateVar(c).with_type(c.type) for c in impl.concretization_functions.values()],
-                        freebies=[e for (v, e) in impl.concretization_functions.items() if EVar(v) in states_maintained_by_q],
-                        ops=impl.op_specs,
-                        improve_count=improve_count))
+            impl_query_names = set(q.name for q in impl.query_specs)
 
             # figure out what old jobs we can stop
-            impl_query_names = set(q.name for q in impl.query_specs)
             old = [j for j in improvement_jobs if j.q.name not in impl_query_names]
+            stop_jobs(old)
+            waiting[:] = [name for name in waiting if name in impl_query_names]
+
+            # figure out what new jobs we need
+            job_query_names = set(j.q.name for j in improvement_jobs)
+            for q in impl.query_specs:
+                if q.name not in job_query_names and q.name not in waiting:
+                    waiting.append(q.name)
 
             # make it so
-            stop_jobs(old)
-            for j in new:
-                j.start()
-            improvement_jobs.extend(new)
-
-        # start jobs
-        reconcile_jobs()
-
-        # wait for results
-        timeout = Timeout(timeout)
-        done = False
-        while not done and not timeout.is_timed_out() and not jobs.was_interrupted():
-            for j in improvement_jobs:
-                if j.done:
-                    if j.successful:
+            schedule_jobs()
+
+        try:
+            # start jobs
+            reconcile_jobs()
+
+            # wait for results
+            timeout = Timeout(timeout)
+            done = False
+            while not done and not timeout.is_timed_out() and not jobs.was_interrupted():
+                for j in improvement_jobs:
+                    if j.done:
+                        # join failed jobs too, so pooled workers go back to
+                        # the pool
                         j.join()
-                    else:
-                        print("failed job: {}".format(j), file=sys.stderr)
-                        # raise Exception("failed job: {}".format(j))
+                        if not j.successful and j not in failed_jobs:
+                            failed_jobs.add(j)
+                            print("failed job: {}".format(j), file=sys.stderr)
+                            # raise Exception("failed job: {}".format(j))
+
+                schedule_jobs()
+                done = not waiting and all(j.done for j in improvement_jobs)
+
+                if not done:
+                    # sleep until a solution arrives, a job finishes, the next
+                    # time slice expires, or we run out of time
+                    wake_up = [timeout.remaining().total_seconds()]
+                    running = [j for j in improvement_jobs if not j.done]
+                    if waiting and job_time_slice.value > 0:
+                        now = datetime.datetime.now()
+                        wake_up.extend(job_time_slice.value - (now - job_start_times[j]).total_seconds() for j in running)
+                    jobs.wait_any(running, queues=[solutions_q], timeout=max(0, min(wake_up)))
 
-            done = all(j.done for j in improvement_jobs)
-
-            try:
                 # list of (Query, packed_expr) objects
-                results = solutions_q.drain(block=True, timeout=0.5)
-            except Empty:
-                continue
-
-            # group by query name, favoring later (i.e. better) solutions
-            print("updating with {} new solutions".format(len(results)))
-            improved_queries_by_name = OrderedDict()
-            killed = 0
-            for r in results:
-                q, packed_expr = r
-                if q.name in improved_queries_by_name:
-                    killed += 1
-                improved_queries_by_name[q.name] = r
-            if killed:
-                print(" --> dropped {} worse solutions".format(killed))
-
-            improvements = list(improved_queries_by_name.values())
-            def index_of(l, p):
-                if not isinstance(l, list):
-                    l = list(l)
-                for i in range(len(l)):
-                    if p(l[i]):
-                        return i
-                return -1
-            improvements.sort(key = lambda i: index_of(impl.query_specs, lambda qq: qq.name == i[0].name))
-            print("update order:")
-            for (q, _) in improvements:
-                print("  --> {}".format(q.name))
-
-            # update query implementations
-            i = 1
-            for (q, packed_expr) in improvements:
-                if timeout.is_timed_out():
-                    break
-
-                print("considering update {}/{}...".format(i, len(improvements)))
-                i += 1
-                # The guard on the next line might be false!
-                # It might so happen that:
-                #   - a job found a better version for q
-                #   - a different job found a better version of some other query X
-                #   - both improvements were in the `results` list pulled from the queue
-                #   - we visited the improvement for X first
-                #   - after cleanup, q is no longer needed and was removed
-                if q.name in [qq.name for qq in impl.query_specs]:
-                    new_rep, new_ret = unpack_representation(packed_expr)
-                    elapsed = datetime.datetime.now() - start_time
-                    print("SOLUTION FOR {} AT {} [size={}]".format(q.name, elapsed, new_ret.size() + sum(proj.size() for (v, proj) in new_rep)))
-                    print("-" * 40)
-                    for (sv, proj) in new_rep:
-                        print("  {} : {} = {}".format(sv.id, pprint(sv.type), pprint(proj)))
-                    print("  return {}".format(pprint(new_ret)))
-                    print("-" * 40)
-                    impl.set_impl(q, new_rep, new_ret)
-
-                    # clean up
-                    impl.cleanup()
-                    if progress_callback is not None:
-                        progress_callback(impl)
-                    reconcile_jobs()
-                else:
-                    print("  (skipped; {} was aleady cleaned up)".format(q.name))
-
-        if dump_synthesized_in_file is not None:
-            with open(dump_synthesized_in_file, "wb") as f:
-                pickle.dump(impl, f)
-                print("Dumped implementation to file {}".format(dump_synthesized_in_file))
-
-        # stop jobs
-        print("Stopping jobs")
-        stop_jobs(list(improvement_jobs))
-        return impl
+                results = solutions_q.drain()
+                if not results:
+                    continue
+
+                # group by query name, favoring later (i.e. better) solutions
+                print("updating with {} new solutions".format(len(results)))
+                improved_queries_by_name = OrderedDict()
+                killed = 0
+                for r in results:
+                    q, packed_expr = r
+                    if q.name in improved_queries_by_name:
+                        killed += 1
+                    improved_queries_by_name[q.name] = r
+                if killed:
+                    print(" --> dropped {} worse solutions".format(killed))
+
+                improvements = list(improved_queries_by_name.values())
+                def index_of(l, p):
+                    if not isinstance(l, list):
+                        l = list(l)
+                    for i in range(len(l)):
+                        if p(l[i]):
+                            return i
+                    return -1
+                improvements.sort(key = lambda i: index_of(impl.query_specs, lambda qq: qq.name == i[0].name))
+                print("update order:")
+                for (q, _) in improvements:
+                    print("  --> {}".format(q.name))
+
+                # update query implementations
+                i = 1
+                for (q, packed_expr) in improvements:
+                    if timeout.is_timed_out():
+                        break
+
+                    print("considering update {}/{}...".format(i, len(improvements)))
+                    i += 1
+                    # The guard on the next line might be false!
+                    # It might so happen that:
+                    #   - a job found a better version for q
+                    #   - a different job found a better version of some other query X
+                    #   - both improvements were in the `results` list pulled from the queue
+                    #   - we visited the improvement for X first
+                    #   - after cleanup, q is no longer needed and was removed
+                    if q.name in [qq.name for qq in impl.query_specs]:
+                        new_rep, new_ret = unpack_representation(packed_expr)
+                        elapsed = datetime.datetime.now() - start_time
+                        print("SOLUTION FOR {} AT {} [size={}]".format(q.name, elapsed, new_ret.size() + sum(proj.size() for (v, proj) in new_rep)))
+                        print("-" * 40)
+                        for (sv, proj) in new_rep:
+                            print("  {} : {} = {}".format(sv.id, pprint(sv.type), pprint(proj)))
+                        print("  return {}".format(pprint(new_ret)))
+                        print("-" * 40)
+                        impl.set_impl(q, new_rep, new_ret)
+                        best_solutions[q.name] = packed_expr
+
+                        # clean up
+                        impl.cleanup()
+                        if progress_callback is not None:
+                            progress_callback(impl)
+                        reconcile_jobs()
+                    else:
+                        print("  (skipped; {} was aleady cleaned up)".format(q.name))
+
+            if dump_synthesized_in_file is not None:
+                with open(dump_synthesized_in_file, "wb") as f:
+                    pickle.dump(impl, f)
+                    print("Dumped implementation to file {}".format(dump_synthesized_in_file))
+
+            return impl
+        finally:
+            # stop jobs, even if something above went wrong
+            print("Stopping jobs")
+            stop_jobs(list(improvement_jobs))
+            if pool is not None:
+                pool.close()
+            if example_manager is not None:
+                print("Jobs shared {} distinct examples".format(len(example_store)))
+                example_manager.shutdown()
@@ -0,0 +1,139 @@
+"""Sharing of counterexamples between improvement jobs.
+
+Every improvement job for an implementation works over the same abstract
+state, so a counterexample that one job gets from the solver is very often
+useful to the others as well: it tends to split equivalence classes during
+enumeration and it can answer cost-model and well-formedness queries without a
+solver call.
+
+The important things defined here are:
+ - ExampleStore: a deduplicated, append-only log of examples, keyed by the
+   signature of the abstract state they were drawn from
+ - start_example_store: runs an ExampleStore in a server process so that jobs
+   in other processes can use it
+ - SharedExamples: the per-job view of a store; it publishes new
+   counterexamples and adapts examples published by other jobs to the job's
+   own context
+
+Only the values of state variables are shared.  Arguments and extern
+functions differ from query to query, so a job receiving a shared example
+fills them in with default values and discards the example if it violates the
+job's assumptions.
+"""
+
+from multiprocessing.managers import BaseManager
+import signal
+
+from cozy.syntax import Exp
+from cozy.contexts import Context
+from cozy.pools import STATE_POOL
+from cozy.evaluation import eval, mkval
+from cozy.solver import ExtractedFunc
+from cozy import jobs
+
+class ExampleStore(object):
+    """A deduplicated log of examples for each abstract-state signature.
+
+    An example here is a tuple of state variable values, in the order given by
+    the signature.
+    """
+
+    def __init__(self):
+        self.logs = { }   # signature -> [example]
+        self.seen = { }   # signature -> {example}
+
+    def publish(self, signature, example) -> bool:
+        """Add an example to the log; return False if it was already there."""
+        seen = self.seen.setdefault(signature, set())
+        if example in seen:
+            return False
+        seen.add(example)
+        self.logs.setdefault(signature, []).append(example)
+        return True
+
+    def fetch(self, signature, start : int = 0) -> list:
+        """Return all examples for `signature` from index `start` onwards."""
+        return self.logs.get(signature, [])[start:]
+
+    def __len__(self):
+        return sum(len(log) for log in self.logs.values())
+
+class _ExampleStoreManager(BaseManager):
+    pass
+
+_ExampleStoreManager.register("ExampleStore", ExampleStore, exposed=("publish", "fetch", "__len__"))
+
+def start_example_store():
+    """Start an ExampleStore in a new server process.
+
+    Returns a (manager, store) pair.  The store is a proxy that can be passed
+    to Jobs; the caller must call `manager.shutdown()` when all Jobs using the
+    store have stopped.
+    """
+    manager = _ExampleStoreManager(ctx=jobs.multiprocessing_context)
+    # The store has to outlive the jobs that use it, so it must not die when
+    # the user interrupts Cozy.
+    manager.start(initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    return manager, manager.ExampleStore()
+
+def state_signature(context : Context) -> str:
+    """The signature of the abstract state visible in `context`."""
+    return repr(sorted((v.id, v.type) for (v, p) in context.vars() if p == STATE_POOL))
+
+class SharedExamples(object):
+    """One job's connection to an ExampleStore.
+
+    The store may be a plain ExampleStore or a proxy returned by
+    `start_example_store`.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.cursors = { }      # signature -> number of examples fetched so far
+        self.published = set()  # examples this job published itself
+        self.sent = 0
+        self.received = 0
+
+    def _state_vars(self, context):
+        return sorted((v for (v, p) in context.vars() if p == STATE_POOL), key=lambda v: v.id)
+
+    def publish(self, context : Context, example : dict) -> bool:
+        """Publish the state portion of `example` to the store.
+
+        Returns True if other jobs had not seen it yet."""
+        key = tuple(example[v.id] for v in self._state_vars(context))
+        try:
+            hash(key)
+        except TypeError:
+            return False
+        self.published.add(key)
+        if self.store.publish(state_signature(context), key):
+            self.sent += 1
+            return True
+        return False
+
+    def receive(self, context : Context, assumptions : Exp) -> [dict]:
+        """Fetch examples published by other jobs since the last call.
+
+        The examples are completed with default values for the arguments and
+        functions in `context`; ones that do not satisfy `assumptions` are
+        dropped.
+        """
+        signature = state_signature(context)
+        start = self.cursors.get(signature, 0)
+        new = self.store.fetch(signature, start)
+        self.cursors[signature] = start + len(new)
+        state_vars = self._state_vars(context)
+        res = []
+        for key in new:
+            if key in self.published:
+                continue
+            example = { v.id : mkval(v.type) for (v, p) in context.vars() }
+            for name, t in context.funcs().items():
+                example[name] = ExtractedFunc({}, mkval(t.ret_type))
+            for v, val in zip(state_vars, key):
+                example[v.id] = val
+            if eval(assumptions, example) is True:
+                res.append(example)
+        self.received += len(res)
+        return res
@@ -19,13 +19,21 @@ Python types:
 
 Important functions:
  - compare_values: compare two Cozy values
+ - comparator: a fast comparison function specialized to one type
+ - equality_key: a hashable stand-in for a Cozy value under normal or deep
+   equality
+ - has_native_equality: whether Python's == already implements normal
+   equality for a type
+ - approximate_size: estimate the memory used by a value
 """
 
 from collections import namedtuple
 from functools import total_ordering
+import sys
 
 from cozy.syntax import (
     Type, THandle, INT, TEnum, TBag, TSet, TMap, TTuple, TList, TRecord)
+from cozy.common import ADT
 from cozy.structures import extension_handler
 
 @total_ordering
@@ -35,29 +43,38 @@ class Map(object):
     This class is immutable, hashable, comparable, and has a deterministic
     iteration order.  It implements identical map semantics to those in the
     solver module.
+
+    A map is built from a sequence of key-value pairs.  Keys are compared by
+    normal equality (see `compare_values`); if several keys are equal, the
+    map keeps the first key and the last value.  Iteration order is the order
+    in which keys first appear.
     """
 
     def __init__(self, type, default, items=()):
         self.type = type
         self.default = default
-        self._items = []
+        self._native = has_native_equality(type.k)
+        entries = { } # equality key -> (k, v)
         for (k, v) in items:
-            self[k] = v
-    def __setitem__(self, k, v):
-        for i in range(len(self._items)):
-            (kk, vv) = self._items[i]
-            if values_equal(self.type.k, k, kk):
-                self._items[i] = (kk, v)
-                return
-        self._items.append((k, v))
+            key = self._key(k)
+            old = entries.get(key)
+            entries[key] = (k, v) if old is None else (old[0], v)
+        self._entries = entries
+        self._sorted = None
+        self._hash = None
+    def _key(self, k):
+        return k if self._native else equality_key(self.type.k, k)
     def __getitem__(self, k):
-        for i in range(len(self._items)):
-            (kk, vv) = self._items[i]
-            if values_equal(self.type.k, k, kk):
-                return vv
-        return self.default
+        entry = self._entries.get(self._key(k))
+        if entry is None:
+            return self.default
+        return entry[1]
+    def __contains__(self, k):
+        return self._key(k) in self._entries
+    def __len__(self):
+        return len(self._entries)
     def items(self):
-        yield from self._items
+        return iter(self._entries.values())
     def keys(self):
         for (k, v) in self.items():
             yield k
@@ -65,17 +82,25 @@ class Map(object):
         for (k, v) in self.items():
             yield v
     def _hashable(self):
-        return (self.default,) + tuple(sorted(self._items))
+        if self._sorted is None:
+            self._sorted = (self.default,) + tuple(sorted(self._entries.values()))
+        return self._sorted
     def __hash__(self):
-        return hash(self._hashable())
+        if self._hash is None:
+            self._hash = hash(self._hashable())
+        return self._hash
+    def __reduce__(self):
+        # The cached hash depends on the Python process, so pickle only the
+        # contents.
+        return (Map, (self.type, self.default, list(self.items())))
     def __repr__(self):
-        return "Map({}, {}, {})".format(repr(self.type), repr(self.default), repr(self._items))
+        return "Map({}, {}, {})".format(repr(self.type), repr(self.default), repr(list(self.items())))
     def __str__(self):
         return repr(self)
     def __lt__(self, other):
         return self._hashable() < other._hashable()
     def __eq__(self, other):
-        return self._hashable() == other._hashable()
+        return self is other or self._hashable() == other._hashable()
 
 def _elems(thing):
     if isinstance(thing, Bag):
@@ -116,6 +141,21 @@ class Bag(object):
         return x in self.elems
     def __iter__(self):
         return iter(self.elems)
+    def __getstate__(self):
+        # leave out the remembered key set
+        return {"elems": self.elems}
+    def key_set(self, t : Type) -> frozenset:
+        """The `equality_key`s of this bag's elements, which have type t.
+
+        The set is built on the first call and remembered, so testing many
+        values for membership in the same bag only scans it once.
+        """
+        remembered = self.__dict__.get("_key_set")
+        if remembered is not None and remembered[0] == t:
+            return remembered[1]
+        keys = frozenset(equality_key(t, x) for x in self.elems)
+        self._key_set = (t, keys)
+        return keys
 
 Handle = namedtuple("Handle", ["address", "value"])
 
@@ -169,64 +209,232 @@ def compare_values(t : Type, v1, v2, deep : bool = False) -> int:
     v1 and v2 are large collections.
     """
 
-    # For performance, this function uses a work-stack algorithm rather than
-    # recursive calls to itself.  The stack holds (type, value1, value2, deep)
-    # tuples to compare.  If the values on the head of the stack differ, then
-    # this function can abort immediately with LT or GT.  Otherwise it
-    # continues to the next stack item.
-    stk = [(t, v1, v2, deep)]
+    return comparator(t, deep)(v1, v2)
 
-    while stk:
-        # The code in this loop looks backwards since the "top" of the stack
-        # is the last elment in the list.  Thus, the next item to be compared
-        # needs to be pushed LAST.  As a result, we append sequences to the
-        # stack in reversed order and we append more-important elements later.
-        (t, v1, v2, deep) = stk.pop()
-
-        h = extension_handler(type(t))
-        if h is not None:
-            stk.append((h.encoding_type(t), v1, v2, deep))
-            continue
-
-        if isinstance(t, THandle):
-            if deep:
-                stk.append((t.value_type, v1.value, v2.value, deep))
-            stk.append((INT, v1.address, v2.address, deep))
-        elif isinstance(t, TEnum):
-            i1 = t.cases.index(v1)
-            i2 = t.cases.index(v2)
-            if i1 == i2: continue
-            if i1 <  i2: return LT
-            else:        return GT
-        elif isinstance(t, TBag) or isinstance(t, TSet):
+_comparators = { } # (type, deep) -> comparison function
+
+def comparator(t : Type, deep : bool = False):
+    """Get a comparison function for values of type t.
+
+    The result f satisfies
+
+        f(v1, v2) == compare_values(t, v1, v2, deep)
+
+    but it is specialized to t: it does not have to inspect the type again
+    for each element of a collection.  Comparators are cached, so calling
+    this function repeatedly for the same type is cheap.
+    """
+    key = (t, deep)
+    try:
+        return _comparators[key]
+    except KeyError:
+        f = _make_comparator(t, deep)
+        _comparators[key] = f
+        return f
+    except TypeError:
+        # some types (e.g. enums whose cases are a list) are not hashable
+        return _make_comparator(t, deep)
+
+def _is_natively_ordered(t : Type) -> bool:
+    """Python's == and < agree with compare_values on type t."""
+    return has_native_equality(t) and not isinstance(t, TEnum)
+
+def _compare_native(v1, v2):
+    if   v1 == v2: return EQ
+    elif v1 <  v2: return LT
+    else:          return GT
+
+def _make_comparator(t : Type, deep : bool):
+    h = extension_handler(type(t))
+    if h is not None:
+        return comparator(h.encoding_type(t), deep)
+
+    if isinstance(t, THandle):
+        if deep:
+            compare_value = comparator(t.value_type, deep)
+            def compare_handles_deep(v1, v2):
+                a1 = v1.address
+                a2 = v2.address
+                if a1 != a2:
+                    return LT if a1 < a2 else GT
+                return compare_value(v1.value, v2.value)
+            return compare_handles_deep
+        def compare_handles(v1, v2):
+            a1 = v1.address
+            a2 = v2.address
+            if a1 == a2:
+                return EQ
+            return LT if a1 < a2 else GT
+        return compare_handles
+    elif isinstance(t, TEnum):
+        index = { }
+        for i, case in enumerate(t.cases):
+            index.setdefault(case, i)
+        def compare_enums(v1, v2):
+            return _compare_native(index[v1], index[v2])
+        return compare_enums
+    elif isinstance(t, TBag) or isinstance(t, TSet):
+        native = _is_natively_ordered(t.elem_type)
+        addresses = isinstance(t.elem_type, THandle) and not deep
+        compare_elems = comparator(t.elem_type, deep)
+        def compare_bags(v1, v2):
+            n1 = len(v1)
+            n2 = len(v2)
+            if n1 != n2:
+                return LT if n1 < n2 else GT
+            if addresses:
+                # Sorting the handles sorts their addresses, and addresses
+                # are all that normal equality looks at.
+                return _compare_native(
+                    sorted([h.address for h in v1]),
+                    sorted([h.address for h in v2]))
             if deep:
-                elems1 = list(v1)
-                elems2 = list(v2)
+                elems1 = tuple(v1)
+                elems2 = tuple(v2)
             else:
-                elems1 = list(sorted(v1))
-                elems2 = list(sorted(v2))
-            if len(elems1) < len(elems2): return LT
-            if len(elems1) > len(elems2): return GT
-            stk.extend(reversed([(t.elem_type, x, y, deep) for (x, y) in zip(elems1, elems2)]))
-        elif isinstance(t, TMap):
+                elems1 = sorted(v1)
+                elems2 = sorted(v2)
+            if native:
+                # sequences compare element-by-element, just like compare_elems
+                return _compare_native(elems1, elems2)
+            for x, y in zip(elems1, elems2):
+                res = compare_elems(x, y)
+                if res != EQ:
+                    return res
+            return EQ
+        return compare_bags
+    elif isinstance(t, TMap):
+        compare_vals = comparator(t.v, deep)
+        compare_keys = comparator(TSet(t.k), False)
+        def compare_maps(v1, v2):
+            res = compare_vals(v1.default, v2.default)
+            if res != EQ:
+                return res
             keys1 = Bag(v1.keys())
-            keys2 = Bag(v2.keys())
-            stk.extend(reversed([(t.v, v1[k], v2[k], deep) for k in sorted(keys1)]))
-            stk.append((TSet(t.k), keys1, keys2, False))
-            stk.append((t.v, v1.default, v2.default, deep))
-        elif isinstance(t, TTuple):
-            stk.extend(reversed([(tt, vv1, vv2, deep) for (tt, vv1, vv2) in zip(t.ts, v1, v2)]))
-        elif isinstance(t, TList):
-            stk.extend(reversed([(t.elem_type, vv1, vv2, deep) for (vv1, vv2) in zip(v1, v2)]))
-            stk.append((INT, len(v1), len(v2), deep))
-        elif isinstance(t, TRecord):
-            stk.extend(reversed([(ft, v1[f], v2[f], deep) for (f, ft) in t.fields]))
-        else:
-            if   v1 == v2: continue
-            elif v1 <  v2: return LT
-            else:          return GT
-    return EQ
+            res = compare_keys(keys1, Bag(v2.keys()))
+            if res != EQ:
+                return res
+            for k in sorted(keys1):
+                res = compare_vals(v1[k], v2[k])
+                if res != EQ:
+                    return res
+            return EQ
+        return compare_maps
+    elif isinstance(t, TTuple):
+        compare_elems = tuple(comparator(tt, deep) for tt in t.ts)
+        def compare_tuples(v1, v2):
+            for f, x, y in zip(compare_elems, v1, v2):
+                res = f(x, y)
+                if res != EQ:
+                    return res
+            return EQ
+        return compare_tuples
+    elif isinstance(t, TList):
+        native = _is_natively_ordered(t.elem_type)
+        compare_elems = comparator(t.elem_type, deep)
+        def compare_lists(v1, v2):
+            n1 = len(v1)
+            n2 = len(v2)
+            if n1 != n2:
+                return LT if n1 < n2 else GT
+            if native:
+                return _compare_native(tuple(v1), tuple(v2))
+            for x, y in zip(v1, v2):
+                res = compare_elems(x, y)
+                if res != EQ:
+                    return res
+            return EQ
+        return compare_lists
+    elif isinstance(t, TRecord):
+        compare_fields = tuple((f, comparator(ft, deep)) for (f, ft) in t.fields)
+        def compare_records(v1, v2):
+            for f, compare_field in compare_fields:
+                res = compare_field(v1[f], v2[f])
+                if res != EQ:
+                    return res
+            return EQ
+        return compare_records
+    else:
+        return _compare_native
 
 def values_equal(t : Type, v1, v2) -> bool:
     """Shorthand for `compare_values(t, v1, v2) == EQ`."""
     return compare_values(t, v1, v2) == EQ
+
+def equality_key(t : Type, v, deep : bool = False):
+    """Compute a hashable key that captures a Cozy value up to equality.
+
+    For values v1 and v2 of type t,
+
+        equality_key(t, v1, deep) == equality_key(t, v2, deep)
+
+    exactly when
+
+        compare_values(t, v1, v2, deep) == EQ.
+
+    This lets clients put values in dictionaries and sets while still
+    respecting normal equality, e.g. to group values that are == without
+    comparing every pair of them.  (Python's == on Cozy values is deep
+    equality, so with deep=True the value itself would do, but the key is
+    consistent with compare_values either way.)
+    """
+    h = extension_handler(type(t))
+    if h is not None:
+        return equality_key(h.encoding_type(t), v, deep)
+
+    if isinstance(t, THandle):
+        if deep:
+            return (equality_key(INT, v.address, deep), equality_key(t.value_type, v.value, deep))
+        return equality_key(INT, v.address, deep)
+    elif isinstance(t, TBag) or isinstance(t, TSet):
+        elems = list(v) if deep else sorted(v)
+        return tuple(equality_key(t.elem_type, x, deep) for x in elems)
+    elif isinstance(t, TMap):
+        keys = Bag(v.keys())
+        return (
+            equality_key(t.v, v.default, deep),
+            equality_key(TSet(t.k), keys, False),
+            tuple(equality_key(t.v, v[k], deep) for k in sorted(keys)))
+    elif isinstance(t, TTuple):
+        return tuple(equality_key(tt, vv, deep) for (tt, vv) in zip(t.ts, v))
+    elif isinstance(t, TList):
+        return tuple(equality_key(t.elem_type, vv, deep) for vv in v)
+    elif isinstance(t, TRecord):
+        return tuple(equality_key(ft, v[f], deep) for (f, ft) in t.fields)
+    else:
+        return v
+
+def has_native_equality(t : Type) -> bool:
+    """Determine whether Python's == implements normal equality on type t.
+
+    This is true for numbers, booleans, strings, enums, and other types whose
+    values compare directly in `compare_values`.  For such types
+    `equality_key(t, v) == v`, so clients can put the values themselves in
+    sets and dictionaries.
+    """
+    return extension_handler(type(t)) is None and not isinstance(t, (
+        THandle, TBag, TSet, TMap, TTuple, TList, TRecord))
+
+def approximate_size(x) -> int:
+    """Estimate the number of bytes of memory used by `x`.
+
+    This walks ASTs, Cozy values, and the built-in containers they are made
+    of, adding up `sys.getsizeof` for every object.  Objects that are shared
+    between several structures are counted once per structure, so the result
+    is an overestimate.
+    """
+    total = 0
+    stk = [x]
+    while stk:
+        x = stk.pop()
+        total += sys.getsizeof(x)
+        if isinstance(x, ADT):
+            stk.extend(x.children())
+        elif isinstance(x, Map):
+            stk.append(x.default)
+            stk.extend(x.items())
+        elif isinstance(x, dict):
+            stk.extend(x.values())
+        elif isinstance(x, (tuple, list, frozenset, set)):
+            stk.extend(x)
+    return total
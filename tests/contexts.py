@@ -108,6 +108,24 @@ class TestContexts(unittest.TestCase):
         assert c1 != c2
         assert not c1.alpha_equivalent(c2)
 
+    def test_canonical_key(self):
+        root = RootCtx(args=[x, int_bag], state_vars=[])
+        ctx1 = UnderBinder(root, y, int_bag, RUNTIME_POOL)
+        ctx2 = UnderBinder(root, z, int_bag, RUNTIME_POOL)
+        assert ctx1 != ctx2
+        assert ctx1.alpha_equivalent(ctx2)
+        assert ctx1.canonical_key() == ctx2.canonical_key()
+        assert hash(ctx1.canonical_key()) == hash(ctx2.canonical_key())
+
+        inner1 = UnderBinder(ctx1, z, ESingleton(y).with_type(INT_BAG), RUNTIME_POOL)
+        inner2 = UnderBinder(ctx2, y, ESingleton(z).with_type(INT_BAG), RUNTIME_POOL)
+        inner3 = UnderBinder(ctx2, y, ESingleton(x).with_type(INT_BAG), RUNTIME_POOL)
+        assert inner1.alpha_equivalent(inner2)
+        assert inner1.canonical_key() == inner2.canonical_key()
+        assert inner1.canonical_key() != inner3.canonical_key()
+
+        assert UnderBinder(root, y, int_bag, STATE_POOL).canonical_key() != ctx1.canonical_key()
+
     def test_let(self):
         e1 = ELet(ZERO, ELambda(x, x))
         root_ctx = RootCtx(args=(), state_vars=())
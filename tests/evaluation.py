@@ -2,10 +2,14 @@ import unittest
 
 from cozy.target_syntax import *
 from cozy.syntax_tools import *
-from cozy.value_types import Bag, Map, Handle, compare_values, values_equal, EQ
+from cozy.value_types import Bag, Map, Handle, compare_values, comparator, values_equal, equality_key, LT, EQ, GT
 from cozy.structures.heaps import TMinHeap
-from cozy.evaluation import eval, uneval
+from cozy.evaluation import eval, eval_bulk, compile_columns, uneval, stack_evaluator, compiled_programs, MemoizingEvaluator
 from cozy.typecheck import retypecheck
+from cozy.common import FrozenDict, save_property
+from cozy.contexts import RootCtx
+from cozy.cost_model import CostModel
+from cozy.pools import RUNTIME_POOL, STATE_POOL
 
 zero = ENum(0).with_type(INT)
 one  = ENum(1).with_type(INT)
@@ -49,6 +53,44 @@ class TestEvaluation(unittest.TestCase):
         assert b1 != b2
         assert values_equal(TBag(t), b1, b2)
 
+    def test_equality_key(self):
+        t = THandle("H", INT)
+        h1 = Handle(address=0, value=0)
+        h2 = Handle(address=0, value=1)
+        h3 = Handle(address=1, value=0)
+        b1 = Bag((h1, h3, h3))
+        b2 = Bag((h3, h2, h3))
+        b3 = Bag((h3, h1))
+        m1 = Map(TMap(INT, TBag(t)), Bag(), [(0, b1), (1, b3)])
+        m2 = Map(TMap(INT, TBag(t)), Bag(), [(1, b3), (0, b2)])
+        m3 = Map(TMap(INT, TBag(t)), Bag(), [(0, b1)])
+        cases = [
+            (t, [h1, h2, h3]),
+            (TBag(t), [b1, b2, b3, Bag()]),
+            (TList(t), [b1, b2, b3]),
+            (TTuple((INT, TBag(t))), [(0, b1), (0, b2), (1, b1)]),
+            (TMap(INT, TBag(t)), [m1, m2, m3])]
+        for deep in (False, True):
+            for ty, vals in cases:
+                for v1 in vals:
+                    for v2 in vals:
+                        same_key = equality_key(ty, v1, deep) == equality_key(ty, v2, deep)
+                        assert same_key == (compare_values(ty, v1, v2, deep) == EQ), "{} vs {}".format(v1, v2)
+                        hash(equality_key(ty, v1, deep))
+
+    def test_comparator(self):
+        e = TEnum(("b", "a"))
+        r = TRecord((("x", INT), ("y", e)))
+        assert comparator(TBag(INT)) is comparator(TBag(INT))
+        assert comparator(TBag(INT))(Bag((2, 1)), Bag((1, 2))) == EQ
+        assert comparator(TBag(INT))(Bag((1, 1)), Bag((1, 2))) == LT
+        assert comparator(TBag(INT))(Bag((3,)), Bag((1, 2))) == LT
+        assert comparator(TBag(INT), deep=True)(Bag((2, 1)), Bag((1, 2))) == GT
+        assert comparator(e)("b", "a") == LT
+        assert comparator(TList(e))(("a", "b"), ("b", "a")) == GT
+        assert comparator(r)(FrozenDict({"x": 0, "y": "a"}), FrozenDict({"x": 0, "y": "b"})) == GT
+        assert comparator(r)(FrozenDict({"x": 0, "y": "a"}), FrozenDict({"x": 1, "y": "b"})) == LT
+
     def test_set_sub(self):
         t = TSet(INT)
         s1 = Bag((0, 1))
@@ -89,3 +131,175 @@ class TestEvaluation(unittest.TestCase):
         m = Map(TMap(INT, INT), 0, [(0, 1), (1, 2), (0, 3)])
         ks = list(m.keys())
         self.assertEqual(ks, [0, 1])
+
+    def test_map_value(self):
+        import pickle
+        t = TMap(TSet(INT), INT)
+        m = Map(t, 0, [(Bag((1, 2)), 1), (Bag(()), 2), (Bag((2, 1)), 3)])
+        assert len(m) == 2
+        assert list(m.items()) == [(Bag((1, 2)), 3), (Bag(()), 2)]
+        assert m[Bag((2, 1))] == 3 and m[Bag((3,))] == 0
+        assert Bag((2, 1)) in m
+        m2 = pickle.loads(pickle.dumps(m))
+        assert m2 == m and hash(m2) == hash(m)
+        assert list(m2.items()) == list(m.items())
+
+    def test_collection_ops_use_normal_equality(self):
+        # handles are == when their addresses match; sets are == regardless
+        # of element order
+        h = THandle("H", INT)
+        hs = EVar("hs").with_type(TBag(h))
+        x = EVar("x").with_type(h)
+        env = {
+            "hs": Bag((Handle(0, 1), Handle(1, 1), Handle(0, 2))),
+            "x": Handle(0, 5),
+            "ss": Bag((Bag((1, 2)), Bag((2, 1)), Bag((3,)))),
+            "s": Bag((2, 1))}
+        assert eval(EBinOp(x, BOp.In, hs).with_type(BOOL), env) is True
+        assert eval(EUnaryOp(UOp.Distinct, hs).with_type(hs.type), env) == Bag((Handle(0, 1), Handle(1, 1)))
+        assert eval(EUnaryOp(UOp.AreUnique, hs).with_type(BOOL), env) is False
+        assert eval(EBinOp(hs, "-", ESingleton(x).with_type(hs.type)).with_type(hs.type), env) == Bag((Handle(1, 1), Handle(0, 2)))
+        t = TSet(INT)
+        ss = EVar("ss").with_type(TBag(t))
+        s = EVar("s").with_type(t)
+        assert eval(EBinOp(ss, "-", ESingleton(s).with_type(ss.type)).with_type(ss.type), env) == Bag((Bag((2, 1)), Bag((3,))))
+        assert eval(EUnaryOp(UOp.Distinct, ss).with_type(ss.type), env) == Bag((Bag((1, 2)), Bag((3,))))
+        m = EMakeMap2(ss, mk_lambda(t, lambda k: EUnaryOp(UOp.Length, k).with_type(INT))).with_type(TMap(t, INT))
+        assert eval(EHasKey(m, s).with_type(BOOL), env) is True
+        assert eval(EMapGet(m, s).with_type(INT), env) == 2
+        assert eval(EUnaryOp(UOp.Length, EMapKeys(m).with_type(ss.type)).with_type(INT), env) == 2
+
+    def test_membership_in_large_bags(self):
+        import pickle
+        h = THandle("H", INT)
+        hs = EVar("hs").with_type(TBag(h))
+        ys = EVar("ys").with_type(TBag(h))
+        bag = Bag(Handle(i, -i) for i in range(20))
+        e = EFilter(ys, mk_lambda(h, lambda y: EBinOp(y, BOp.In, hs).with_type(BOOL))).with_type(ys.type)
+        env = {"hs": bag, "ys": Bag((Handle(3, 0), Handle(30, 0), Handle(19, 5)))}
+        for use_stack in (False, True):
+            with save_property(stack_evaluator, "value"):
+                stack_evaluator.value = use_stack
+                assert eval(e, env) == Bag((Handle(3, 0), Handle(19, 5)))
+        assert bag.key_set(h) == frozenset(range(20))
+        assert "_key_set" not in pickle.loads(pickle.dumps(bag)).__dict__
+
+    def test_program_cache(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        def e(name, t):
+            v = EVar(name).with_type(t)
+            return EMap(xs, ELambda(v, ESingleton(v).with_type(TBag(t)))).with_type(TBag(TBag(t)))
+        env = {"xs": Bag((1, 2))}
+        compiled_programs.clear()
+        assert eval(e("x", INT), env) == Bag((Bag((1,)), Bag((2,))))
+        assert (compiled_programs.hits, compiled_programs.misses) == (0, 1)
+        eval(e("x", INT), env)
+        eval(e("y", INT), env)
+        assert (compiled_programs.hits, compiled_programs.misses) == (2, 1)
+        # same expression, different types: must be compiled again
+        eval(e("x", FLOAT), env)
+        assert (compiled_programs.hits, compiled_programs.misses) == (2, 2)
+
+    def test_memoizing_evaluator(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        envs = [{"x": 0, "xs": Bag(())}, {"x": 1, "xs": Bag((1, 2))}]
+        evaluator = MemoizingEvaluator(envs)
+        filtered = EFilter(xs, ELambda(EVar("y").with_type(INT), EEq(EVar("y").with_type(INT), x))).with_type(INT_BAG)
+        es = [
+            EUnaryOp(UOp.Length, filtered).with_type(INT),
+            EUnaryOp(UOp.Sum, filtered).with_type(INT),
+            ECond(EEq(x, zero), zero, EUnaryOp(UOp.The, filtered).with_type(INT)).with_type(INT)]
+        for e in es:
+            assert evaluator.eval(e) == tuple(eval_bulk(e, envs)), pprint(e)
+        # `filtered` was only evaluated for the first expression
+        assert (evaluator.hits, evaluator.misses) == (1, 5)
+        length = EUnaryOp(UOp.Length, xs).with_type(INT)
+        evaluator.remember(length, (5, 6))
+        assert evaluator.eval(EBinOp(length, "+", one).with_type(INT)) == (6, 7)
+
+class TestEvaluationBackends(unittest.TestCase):
+    """The closure compiler must agree with the reference stack machine."""
+
+    def check(self, es, envs):
+        for e in es:
+            with save_property(stack_evaluator, "value"):
+                stack_evaluator.value = True
+                expected = eval_bulk(e, envs)
+            res = eval_bulk(e, envs)
+            assert res == expected, "{}: {} != {}".format(pprint(e), res, expected)
+            assert [type(v) for v in res] == [type(v) for v in expected], pprint(e)
+
+    def test_handwritten(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(TList(INT))
+        t = TRecord((("a", INT), ("b", BOOL)))
+        rs = EVar("rs").with_type(TBag(t))
+        f = EVar("f").with_type(INT)
+        envs = [
+            {"xs": Bag(()), "ys": (), "rs": Bag(()), "f": 0},
+            {"xs": Bag((3, 1, 3)), "ys": (2, 1, 2), "rs": Bag((FrozenDict({"a": 1, "b": True}), FrozenDict({"a": 0, "b": False}))), "f": 2}]
+        es = [
+            EArgMin(xs, mk_lambda(INT, lambda x: EUnaryOp("-", x).with_type(INT))).with_type(INT),
+            EArgMax(rs, mk_lambda(t, lambda r: EGetField(r, "a").with_type(INT))).with_type(t),
+            EMakeMap2(xs, mk_lambda(INT, lambda x: EBinOp(x, "+", f).with_type(INT))).with_type(TMap(INT, INT)),
+            EHasKey(EMakeMap2(xs, mk_lambda(INT, lambda x: x)).with_type(TMap(INT, INT)), f).with_type(BOOL),
+            EMapKeys(EMakeMap2(xs, mk_lambda(INT, lambda x: x)).with_type(TMap(INT, INT))).with_type(INT_BAG),
+            EMapGet(EMakeMap2(xs, mk_lambda(INT, lambda x: ESingleton(x).with_type(INT_BAG))).with_type(TMap(INT, INT_BAG)), f).with_type(INT_BAG),
+            EFlatMap(xs, mk_lambda(INT, lambda x: EBinOp(ESingleton(x).with_type(INT_BAG), "+", ESingleton(f).with_type(INT_BAG)).with_type(INT_BAG))).with_type(INT_BAG),
+            ELet(EUnaryOp(UOp.Length, xs).with_type(INT), mk_lambda(INT, lambda n: ETuple((n, EMakeRecord((("a", n), ("b", ETRUE))).with_type(t))).with_type(TTuple((INT, t))))).with_type(TTuple((INT, t))),
+            EListSlice(ys, ONE, EUnaryOp(UOp.Length, ys).with_type(INT)).with_type(ys.type),
+            EListGet(ys, f).with_type(INT),
+            EUnaryOp(UOp.Reversed, ys).with_type(ys.type),
+            EUnaryOp(UOp.Distinct, xs).with_type(INT_BAG),
+            EUnaryOp(UOp.AreUnique, xs).with_type(BOOL),
+            EBinOp(ys, "-", ESingleton(f).with_type(ys.type)).with_type(ys.type),
+            EBinOp(EBinOp(xs, "-", ESingleton(f).with_type(INT_BAG)).with_type(INT_BAG), "===", xs).with_type(BOOL),
+            ESorted(xs, EFALSE).with_type(TList(INT)),
+            EDropFront(ys).with_type(ys.type),
+            EFilter(rs, mk_lambda(t, lambda r: EBinOp(EGetField(r, "b").with_type(BOOL), BOp.Or, EBinOp(EGetField(r, "a").with_type(INT), "<=", f).with_type(BOOL)).with_type(BOOL))).with_type(rs.type),
+            ECond(EBinOp(f, BOp.In, xs).with_type(BOOL), EHandle(f, xs).with_type(THandle("H", INT_BAG)), EHandle(ONE, EEmptyList().with_type(INT_BAG)).with_type(THandle("H", INT_BAG))).with_type(THandle("H", INT_BAG))]
+        self.check(es, envs)
+
+    def test_columns(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        b = EVar("b").with_type(BOOL)
+        t = TEnum(("Low", "High"))
+        c = EVar("c").with_type(t)
+        n = EUnaryOp(UOp.Length, xs).with_type(INT)
+        vars = ["xs", "x", "b", "c"]
+        cols = [
+            [Bag(()), Bag((1,)), Bag((1, 2)), Bag((2, 2, 2))],
+            [0, 1, 5, -2],
+            [True, False, True, False],
+            ["High", "Low", "Low", "High"]]
+        es = [
+            EBinOp(EBinOp(x, "*", x).with_type(INT), "-", n).with_type(INT),
+            EBinOp(b, BOp.Or, EBinOp(n, ">=", x).with_type(BOOL)).with_type(BOOL),
+            ECond(b, EUnaryOp("-", x).with_type(INT), n).with_type(INT),
+            ECond(EBinOp(x, "<", ONE).with_type(BOOL), xs, ESingleton(x).with_type(INT_BAG)).with_type(INT_BAG),
+            EBinOp(c, "<", EEnumEntry("High").with_type(t)).with_type(BOOL),
+            EUnaryOp(UOp.Not, EBinOp(EStateVar(xs).with_type(INT_BAG), "==", xs).with_type(BOOL)).with_type(BOOL)]
+        for e in es:
+            with save_property(stack_evaluator, "value"):
+                stack_evaluator.value = True
+                expected = compile_columns(e, vars)(cols, 4)
+            assert compile_columns(e, vars)(cols, 4) == expected, pprint(e)
+            assert eval_bulk(e, [dict(zip(vars, row)) for row in zip(*cols)]) == expected, pprint(e)
+        assert compile_columns(ONE, [])([], 3) == [1, 1, 1]
+
+    def test_enumerated(self):
+        from cozy.synthesis.enumeration import Enumerator
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(TList(INT))
+        h = EVar("h").with_type(THandle("H", INT))
+        x = EVar("x").with_type(INT)
+        envs = [
+            {"xs": Bag(()), "ys": (), "h": Handle(0, 0), "x": 0},
+            {"xs": Bag((1, 2, 1)), "ys": (2, 0), "h": Handle(1, 5), "x": 2}]
+        context = RootCtx(state_vars=[xs, ys], args=[h, x])
+        enumerator = Enumerator(examples=envs, cost_model=CostModel())
+        for size in range(3):
+            for pool in (STATE_POOL, RUNTIME_POOL):
+                self.check(list(enumerator.enumerate(context, size, pool)), envs)
@@ -0,0 +1,128 @@
+import os
+import time
+import unittest
+
+from cozy.jobs import Job, WorkerPool, SafeQueue, stop_jobs, wait_any
+
+class ReportPid(Job):
+    def __init__(self, q):
+        super().__init__()
+        self.q = q
+    def run(self):
+        self.q.put(os.getpid())
+
+class ReportNiceness(Job):
+    def __init__(self, q):
+        super().__init__()
+        self.q = q
+    def run(self):
+        self.q.put(os.nice(0))
+
+class Fail(Job):
+    def run(self):
+        raise ValueError("this job always fails")
+
+class Spin(Job):
+    def run(self):
+        while not self.stop_requested:
+            time.sleep(0.01)
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_workers_are_reused(self):
+        with SafeQueue() as q:
+            with WorkerPool(size=1, shared=[q.handle_for_subjobs()]) as pool:
+                pids = []
+                for i in range(3):
+                    job = ReportPid(q.handle_for_subjobs())
+                    job.start(pool=pool)
+                    job.join()
+                    assert job.done
+                    assert job.successful
+                    pids.append(q.get(block=True, timeout=10))
+                assert len(set(pids)) == 1, pids
+                assert len(pool) == 1
+
+    def test_workers_are_reused_after_failed_jobs(self):
+        with SafeQueue() as q:
+            with WorkerPool(size=1, shared=[q.handle_for_subjobs()]) as pool:
+                failed = Fail()
+                failed.start(pool=pool)
+                failed.join()
+                assert failed.done
+                assert not failed.successful
+                job = ReportPid(q.handle_for_subjobs())
+                job.start(pool=pool)
+                job.join()
+                assert job.successful
+                assert q.get(block=True, timeout=10) == failed.pid
+                assert len(pool) == 1
+
+    def test_workers_are_reniced_once(self):
+        with SafeQueue() as q:
+            with WorkerPool(size=1, shared=[q.handle_for_subjobs()], nice=1) as pool:
+                levels = []
+                for i in range(2):
+                    job = ReportNiceness(q.handle_for_subjobs())
+                    job.start(pool=pool)
+                    job.join()
+                    levels.append(q.get(block=True, timeout=10))
+                assert levels == [min(os.nice(0) + 1, 19)] * 2, levels
+
+    def test_pool_grows_when_busy(self):
+        with WorkerPool(size=1) as pool:
+            jobs = [Spin(), Spin()]
+            for j in jobs:
+                j.start(pool=pool)
+            assert len(pool) == 2
+            assert jobs[0].pid != jobs[1].pid
+            stop_jobs(jobs)
+            assert all(j.done and j.successful for j in jobs)
+
+    def test_stop_pooled_job(self):
+        with WorkerPool(size=1) as pool:
+            j1 = Spin()
+            j1.start(pool=pool)
+            stop_jobs([j1])
+            assert j1.done
+            assert j1.successful
+
+            # The worker should not carry the stop request over to its next job.
+            j2 = Spin()
+            j2.start(pool=pool)
+            assert j2.pid == j1.pid
+            time.sleep(0.2)
+            assert not j2.done
+            assert j1.done
+            stop_jobs([j2])
+            assert j2.done
+
+class TestWaiting(unittest.TestCase):
+
+    def test_wait_for_queue(self):
+        with SafeQueue() as q:
+            start = time.time()
+            wait_any(queues=[q], timeout=0.2)
+            assert time.time() - start >= 0.2
+            assert q.drain() == []
+
+            q.handle_for_subjobs().put(1)
+            start = time.time()
+            wait_any(queues=[q], timeout=30)
+            assert time.time() - start < 10
+            assert q.drain() == [1]
+
+    def test_wait_for_job(self):
+        with SafeQueue() as q:
+            with WorkerPool(size=2, shared=[q.handle_for_subjobs()]) as pool:
+                spinner = Spin()
+                spinner.start(pool=pool)
+                job = ReportPid(q.handle_for_subjobs())
+                job.start(pool=pool)
+                start = time.time()
+                wait_any([spinner, job], queues=[q], timeout=30)
+                assert time.time() - start < 10
+                assert job.done or q.drain()
+                assert not spinner.done
+                stop_jobs([spinner, job])
+                assert spinner.done and job.done
@@ -92,3 +92,28 @@ class TestRandomAssignment(unittest.TestCase):
         for test in tests3:
             solver = init_solver()
             assert unsatisfiable(test), pprint(test)
+
+    def test_falsifier_regression(self):
+        falsifier = Falsifier(vars=[EVar("l").with_type(TBag(TInt())), EVar("n").with_type(TInt())], funcs={})
+        for target, new_target, expected in tests[:3]:
+            e = ENot(EEq(target, new_target))
+            actual = falsifier.satisfy(e)
+            assert actual is not None, pprint(e)
+            assert eval(e, actual)
+        assert falsifier.hits == falsifier.calls == 3
+
+    def test_falsifier_types(self):
+        t = TRecord((("m", TMap(TEnum(("A", "B")), TInt())), ("h", THandle("H", TTuple((TBool(), TString()))))))
+        x = EVar("x").with_type(t)
+        m = EGetField(x, "m").with_type(t.fields[0][1])
+        e = EEq(EMapGet(m, EEnumEntry("B").with_type(m.type.k)).with_type(INT), ENum(1).with_type(INT))
+        falsifier = Falsifier(vars=[x], funcs={ "f": TFunc((INT,), INT) }, samples=16)
+        model = falsifier.satisfy(e)
+        assert model is not None and eval(e, model)
+        assert isinstance(model["f"], ExtractedFunc)
+        assert falsifier.satisfy(EAll([e, ENot(e)])) is None
+        assert falsifier.assignments_tried <= 2 * 16
+        assert falsifier.report().startswith("falsifier: 1 hits / 2 calls")
+        for ty in (t, TList(t), TSet(INT), TMinTreeMultiset(INT)):
+            values = small_values(ty)
+            assert values[0] == mkval(ty)
@@ -1,12 +1,15 @@
 import unittest
+import pickle
 
-from cozy.common import OrderedSet
-from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver, ModelCachingSolver
+from cozy.common import OrderedSet, save_property
+from cozy.solver import satisfy, valid, satisfiable, IncrementalSolver, ModelCachingSolver, SolverPool, solver_memory_limit, max_solver_examples, SolverPortfolio, PortfolioMember, default_portfolio, ExtractedFunc
+from cozy.contexts import RootCtx
 from cozy.typecheck import typecheck, retypecheck
 from cozy.target_syntax import *
 from cozy.structures.heaps import *
 from cozy.syntax_tools import pprint, equal, implies, mk_lambda, free_vars
 from cozy.evaluation import eval
+from cozy.value_types import Bag, approximate_size
 
 zero = ENum(0).with_type(TInt())
 one  = ENum(1).with_type(TInt())
@@ -347,6 +350,49 @@ class TestSolver(unittest.TestCase):
         assert "f" in model
         assert model["f"](model["x"]) == model["x"]
 
+    def test_function_extraction06(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        f = lambda a: ECall("f", (a,)).with_type(INT)
+        model = satisfy(EAll([EEq(f(x), ONE), EEq(f(y), ZERO)]))
+        assert isinstance(model["f"], ExtractedFunc)
+        model = pickle.loads(pickle.dumps(model))
+        assert model["f"](model["x"]) == 1
+        assert model["f"](model["y"]) == 0
+
+    def test_extracted_func_otherwise(self):
+        # f(a, b) = a - 2*b, except f(0, 0) = 5
+        f = ExtractedFunc({(0, 0): 5}, 0,
+            otherwise=("+", ("var", 0), ("*", ("const", -2), ("var", 1))),
+            arg_types=(INT, INT), out_type=INT)
+        assert f(0, 0) == 5
+        assert f(10, 1) == 8
+        assert pickle.loads(pickle.dumps(f))(3, 3) == -3
+
+    def test_function_extraction07(self):
+        t = TEnum(("A", "B", "C"))
+        x = EVar("x").with_type(t)
+        y = EVar("y").with_type(t)
+        f = lambda a: ECall("f", (a,)).with_type(t)
+        model = satisfy(EAll([
+            EEq(f(x), EEnumEntry("B").with_type(t)),
+            EEq(f(y), EEnumEntry("C").with_type(t)),
+            EEq(y, EEnumEntry("A").with_type(t))]))
+        assert model["f"](model["x"]) == "B"
+        assert model["f"]("A") == "C"
+        assert model["f"](model["f"]("A")) in t.cases
+
+    def test_extracted_func_arguments(self):
+        t = TEnum(("A", "B", "C"))
+        f = ExtractedFunc({}, 0,
+            otherwise=("ite", ("==", ("var", 0), ("const", 1)), ("const", 5), ("const", 7)),
+            arg_types=(t,), out_type=INT)
+        assert f("B") == 5
+        assert f("C") == 7
+        g = ExtractedFunc({(2,): "C"}, "A", otherwise=("var", 0), arg_types=(STRING,), out_type=t)
+        assert g("xy") == "C"
+        assert g("a") == "B"
+
     def test_argmin1(self):
         satisfy(EUnaryOp('not', EBinOp(EUnaryOp('not', EBool(True).with_type(TBool())).with_type(TBool()), 'or', EBinOp(EBinOp(EArgMin(EBinOp(EVar('xs').with_type(TBag(TInt())), '+', ESingleton(EVar('i').with_type(TInt())).with_type(TBag(TInt()))).with_type(TBag(TInt())), ELambda(EVar('_var148').with_type(TInt()), EVar('_var148').with_type(TInt()))).with_type(TInt()), '+', EUnaryOp('-', EArgMin(EVar('xs').with_type(TBag(TInt())), ELambda(EVar('_var148').with_type(TInt()), EVar('_var148').with_type(TInt()))).with_type(TInt())).with_type(TInt())).with_type(TInt()), '==', EBinOp(EArgMin(EBinOp(EVar('_var164').with_type(TBag(TInt())), '+', ESingleton(EVar('i').with_type(TInt())).with_type(TBag(TInt()))).with_type(TBag(TInt())), ELambda(EVar('_var148').with_type(TInt()), EVar('_var148').with_type(TInt()))).with_type(TInt()), '+', EUnaryOp('-', EArgMin(EVar('_var164').with_type(TBag(TInt())), ELambda(EVar('_var148').with_type(TInt()), EVar('_var148').with_type(TInt()))).with_type(TInt())).with_type(TInt())).with_type(TInt())).with_type(TBool())).with_type(TBool())).with_type(TBool()), vars=OrderedSet([EVar('xs').with_type(TBag(TInt())), EVar('i').with_type(TInt()), EVar('_var164').with_type(TBag(TInt()))]), collection_depth=2, validate_model=True)
 
@@ -549,6 +595,113 @@ class TestSolver(unittest.TestCase):
             assert retypecheck(e)
             assert valid(EEq(e, EHeapPeek(to_heap(e)).with_type(INT)))
 
+    def test_concurrent_solvers(self):
+        from concurrent.futures import ThreadPoolExecutor
+        xs = EVar("xs").with_type(INT_BAG)
+        def check(i):
+            s = IncrementalSolver(validate_model=True)
+            n = ENum(i).with_type(INT)
+            m = s.satisfy(EAll([EEq(EUnaryOp(UOp.Length, xs).with_type(INT), ENum(2).with_type(INT)), EIn(n, xs)]))
+            return m is not None and i in m["xs"] and not s.satisfiable(EGt(EUnaryOp(UOp.Length, xs).with_type(INT), ENum(100).with_type(INT)))
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            assert all(pool.map(check, range(16)))
+
+    def test_model_caching_solver_example_limit(self):
+        x = EVar("x").with_type(INT)
+        with save_property(max_solver_examples, "value"):
+            max_solver_examples.value = 2
+            s = ModelCachingSolver(vars=[x], funcs={})
+            s.add_example({"x": 1})
+            s.add_example({"x": 2})
+            assert s.satisfy(EEq(x, one)) == {"x": 1}
+            s.add_example({"x": 3})
+            assert s.examples == [{"x": 1}, {"x": 3}]
+            assert s.evicted_examples == 1
+            assert s.examples_size == sum(approximate_size(x) for x in s.examples)
+            assert s.approximate_memory() == s.solver.approximate_memory() + s.examples_size
+
+    def test_solver_pool_limit(self):
+        pool = SolverPool()
+        contexts = [RootCtx(state_vars=[], args=[EVar(name).with_type(INT)]) for name in ("x", "y", "z")]
+        def get(ctx):
+            return pool.get(ctx, lambda: ModelCachingSolver(vars=[v for v, _ in ctx.vars()], funcs={}))
+        with save_property(solver_memory_limit, "value"):
+            solver_memory_limit.value = 0
+            s = get(contexts[0])
+            assert get(contexts[0]) is s
+            get(contexts[1])
+            assert len(pool) == 2
+            solver_memory_limit.value = 1
+            get(contexts[2])
+            assert list(pool.solvers.keys()) == [contexts[2]]
+            assert (pool.hits, pool.misses, pool.evictions) == (1, 3, 2)
+
+    def test_deepening(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        length = EUnaryOp(UOp.Length, xs).with_type(INT)
+        s = IncrementalSolver(deepening=True)
+        assert s.satisfy(EIn(one, xs)) == {"xs": Bag((1,))}
+        assert len(s.satisfy(EGt(length, one))["xs"]) == 2
+        assert s.satisfy(EGt(length, ENum(4).with_type(INT))) is None
+
+    def test_encoding_cache(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        def filtered(name, bound):
+            x = EVar(name).with_type(INT)
+            return EFilter(xs, ELambda(x, EGt(x, bound))).with_type(INT_BAG)
+        length = EUnaryOp(UOp.Length, filtered("x", one)).with_type(INT)
+        s = IncrementalSolver(do_cse=False)
+        assert s.satisfy(EGt(length, one)) is not None
+        # same subexpression, different binder name
+        assert s.satisfy(EGt(EUnaryOp(UOp.Length, filtered("y", one)).with_type(INT), ENum(3).with_type(INT))) is not None
+        assert s.visitor.cache_hits > 0
+        # same shape, different bound value
+        assert s.satisfy(EAll([EEq(filtered("x", one), filtered("x", zero)), EIn(one, xs)])) is None
+        s.push()
+        size = len(s.visitor.cache)
+        s.add_assumption(EEq(EUnaryOp(UOp.Sum, xs).with_type(INT), ENum(7).with_type(INT)))
+        assert len(s.visitor.cache) > size
+        s.pop()
+        assert len(s.visitor.cache) == size
+        assert s.report().startswith("encode ")
+
+    def test_portfolio(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        length = EUnaryOp(UOp.Length, xs).with_type(INT)
+        s = SolverPortfolio(vars=[xs], funcs={}, assumptions=ELe(length, ENum(3).with_type(INT)))
+        m = s.satisfy(EIn(one, xs))
+        assert 1 in m["xs"] and len(m["xs"]) <= 3
+        assert s.satisfy(EGt(length, ENum(3).with_type(INT))) is None
+        assert s.calls == 2 and sum(s.wins.values()) == 2
+        # members keep their threads across queries; the falsifier has no Z3 solver
+        threads = list(s._threads)
+        s.satisfy(EIn(one, xs))
+        assert s._threads == threads and all(t.is_alive() for t in threads)
+        assert s.solvers[[m.name for m in s.members].index("random")] is None
+        s.close()
+        for t in threads:
+            t.join(5)
+        assert not any(t.is_alive() for t in threads)
+
+    def test_portfolio_behind_model_cache(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        s = SolverPortfolio(vars=[xs], funcs={})
+        cache = ModelCachingSolver(vars=[xs], funcs={})
+        m = cache.satisfy(EIn(one, xs), fallback=s)
+        assert m is not None and cache.examples == [m] and s.calls == 1
+        assert cache.satisfy(EIn(one, xs), fallback=s) is m
+        assert s.calls == 1 and cache.hits == 1
+
+    def test_portfolio_ignores_incomplete_unsat(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        length = EUnaryOp(UOp.Length, xs).with_type(INT)
+        s = SolverPortfolio(vars=[xs], funcs={}, collection_depth=4, members=[
+            PortfolioMember("tiny", {"collection_depth": 1}, complete=False),
+            PortfolioMember("full", {})])
+        assert len(s.satisfy(EEq(length, ENum(3).with_type(INT)))["xs"]) == 3
+        assert s.wins["full"] == 1
+        assert [m.name for m in default_portfolio(1, falsifier=False)] == ["default", "no-cse", "deepening", "QF_UFLIRA"]
+
     def test_regression29(self):
         satisfy(EUnaryOp('not', EBinOp(EBool(True).with_type(TBool()), '=>', EBinOp(EArgMax(EBinOp(ESingleton(EBinOp(EUnaryOp('sum', EMap(ECond(EBinOp(EMapGet(EMakeMap2(EMap(EVar('xs').with_type(TList(TFloat())), ELambda(EVar('x').with_type(TFloat()), EBinOp(ECall('log', (EBinOp(ENum(1.0).with_type(TFloat()), '+', EVar('x').with_type(TFloat())).with_type(TFloat()),)).with_type(TFloat()), '+', ECall('log', (ENum(1.5).with_type(TFloat()),)).with_type(TFloat())).with_type(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var77592').with_type(TFloat()), EUnaryOp('len', EFilter(EMap(EVar('xs').with_type(TList(TFloat())), ELambda(EVar('x').with_type(TFloat()), EBinOp(ECall('log', (EBinOp(ENum(1.0).with_type(TFloat()), '+', EVar('x').with_type(TFloat())).with_type(TFloat()),)).with_type(TFloat()), '+', ECall('log', (ENum(1.5).with_type(TFloat()),)).with_type(TFloat())).with_type(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var77593').with_type(TFloat()), EBinOp(EVar('_var77592').with_type(TFloat()), '==', EVar('_var77593').with_type(TFloat())).with_type(TBool()))).with_type(TList(TFloat()))).with_type(TInt()))).with_type(TMap(TFloat(), TInt())), ENum(1.0).with_type(TFloat())).with_type(TInt()), '==', ENum(1).with_type(TInt())).with_type(TBool()), EEmptyList().with_type(TList(TFloat())), ESingleton(ENum(1.0).with_type(TFloat())).with_type(TList(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var2195290').with_type(TFloat()), ENum(4).with_type(TInt()))).with_type(TBag(TInt()))).with_type(TInt()), '+', ENum(4).with_type(TInt())).with_type(TInt())).with_type(TBag(TInt())), '+', ESingleton(EBinOp(EUnaryOp('sum', EMap(ECond(EBinOp(EMapGet(EMakeMap2(EMap(EVar('xs').with_type(TList(TFloat())), ELambda(EVar('x').with_type(TFloat()), EBinOp(ECall('log', (EBinOp(ENum(1.0).with_type(TFloat()), '+', EVar('x').with_type(TFloat())).with_type(TFloat()),)).with_type(TFloat()), '+', ECall('log', (ENum(1.5).with_type(TFloat()),)).with_type(TFloat())).with_type(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var77592').with_type(TFloat()), EUnaryOp('len', EFilter(EMap(EVar('xs').with_type(TList(TFloat())), ELambda(EVar('x').with_type(TFloat()), EBinOp(ECall('log', (EBinOp(ENum(1.0).with_type(TFloat()), '+', EVar('x').with_type(TFloat())).with_type(TFloat()),)).with_type(TFloat()), '+', ECall('log', (ENum(1.5).with_type(TFloat()),)).with_type(TFloat())).with_type(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var77593').with_type(TFloat()), EBinOp(EVar('_var77592').with_type(TFloat()), '==', EVar('_var77593').with_type(TFloat())).with_type(TBool()))).with_type(TList(TFloat()))).with_type(TInt()))).with_type(TMap(TFloat(), TInt())), ENum(1.5).with_type(TFloat())).with_type(TInt()), '==', ENum(1).with_type(TInt())).with_type(TBool()), EEmptyList().with_type(TList(TFloat())), ESingleton(ENum(1.5).with_type(TFloat())).with_type(TList(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var2195292').with_type(TFloat()), ENum(4).with_type(TInt()))).with_type(TBag(TInt()))).with_type(TInt()), '+', ENum(4).with_type(TInt())).with_type(TInt())).with_type(TBag(TInt()))).with_type(TBag(TInt())), ELambda(EVar('x').with_type(TInt()), EVar('x').with_type(TInt()))).with_type(TInt()), '>=', EBinOp(EUnaryOp('sum', EMap(ECond(EBinOp(EMapGet(EMakeMap2(EVar('xs').with_type(TList(TFloat())), ELambda(EVar('_var66768').with_type(TFloat()), EUnaryOp('len', EFilter(EVar('xs').with_type(TList(TFloat())), ELambda(EVar('_var66769').with_type(TFloat()), EBinOp(EVar('_var66768').with_type(TFloat()), '==', EVar('_var66769').with_type(TFloat())).with_type(TBool()))).with_type(TList(TFloat()))).with_type(TInt()))).with_type(TMap(TFloat(), TInt())), ENum(1.5).with_type(TFloat())).with_type(TInt()), '==', ENum(1).with_type(TInt())).with_type(TBool()), EEmptyList().with_type(TList(TFloat())), ESingleton(ENum(1.5).with_type(TFloat())).with_type(TList(TFloat()))).with_type(TList(TFloat())), ELambda(EVar('_var2195293').with_type(TFloat()), ENum(4).with_type(TInt()))).with_type(TBag(TInt()))).with_type(TInt()), '+', ENum(4).with_type(TInt())).with_type(TInt())).with_type(TBool())).with_type(TBool())).with_type(TBool()), vars=OrderedSet([EVar('isDropped').with_type(TBool()), EVar('dropped').with_type(TInt()), EVar('xs').with_type(TList(TFloat())), EVar('_var155564').with_type(TFloat()), EVar('_var158099').with_type(TFloat()), EVar('_var159048').with_type(TFloat()), EVar('_var160499').with_type(TFloat()), EVar('x').with_type(TFloat())]), collection_depth=4, validate_model=True)
 
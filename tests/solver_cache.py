@@ -0,0 +1,59 @@
+import unittest
+import os
+import tempfile
+
+from cozy.common import save_property
+from cozy.target_syntax import *
+from cozy.solver import IncrementalSolver
+from cozy.solver_cache import solver_cache, solver_cache_path, query_key
+
+class TestSolverCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_renamed_queries_share_key(self):
+        def query(x, y):
+            x = EVar(x).with_type(INT)
+            ys = EVar(y).with_type(INT_BAG)
+            z = EVar("z").with_type(INT)
+            return EIn(x, EFilter(ys, ELambda(z, EGt(z, x))).with_type(INT_BAG))
+        k1, names1 = query_key(query("x", "ys"), [], [], {}, 4, 0)
+        k2, names2 = query_key(query("a", "bs"), [], [], {}, 4, 0)
+        k3, _ = query_key(query("x", "ys"), [], [], {}, 3, 0)
+        assert k1 == k2
+        assert k1 != k3
+        assert names1 == ["x", "ys"]
+        assert names2 == ["a", "bs"]
+
+    def test_results_are_reused(self):
+        with save_property(solver_cache_path, "value"):
+            solver_cache_path.value = os.path.join(self.tmpdir.name, "cache.db")
+            cache = solver_cache()
+            x = EVar("x").with_type(INT)
+            y = EVar("y").with_type(INT)
+            sat = EGt(x, ENum(10).with_type(INT))
+            unsat = EAll([EGt(x, y), EGt(y, x)])
+
+            m = IncrementalSolver().satisfy(sat)
+            assert m["x"] > 10
+            assert IncrementalSolver().satisfy(unsat) is None
+            assert (cache.hits, cache.misses) == (0, 2)
+
+            # same questions about differently-named variables
+            a = EVar("a").with_type(INT)
+            b = EVar("b").with_type(INT)
+            s = IncrementalSolver(vars=[b])
+            m = s.satisfy(EGt(a, ENum(10).with_type(INT)))
+            assert m["a"] > 10 and "b" in m
+            assert IncrementalSolver().satisfy(EAll([EGt(a, b), EGt(b, a)])) is None
+            assert (cache.hits, cache.misses) == (2, 2)
+
+            # assumptions are part of the query
+            s = IncrementalSolver()
+            s.add_assumption(ELt(x, ENum(5).with_type(INT)))
+            assert s.satisfy(sat) is None
+            assert (cache.hits, cache.misses) == (2, 3)
@@ -1,5 +1,8 @@
 import unittest
 import datetime
+import queue
+import tempfile
+from multiprocessing import Value
 
 from cozy.common import save_property
 from cozy.syntax_tools import mk_lambda, pprint, alpha_equivalent, deep_copy
@@ -7,10 +10,12 @@ from cozy.target_syntax import *
 from cozy.contexts import RootCtx, UnderBinder
 from cozy.typecheck import retypecheck, typecheck
 from cozy.evaluation import mkval
-from cozy.cost_model import CostModel
+from cozy.cost_model import CostModel, is_constant_time
 from cozy.synthesis import construct_initial_implementation, improve_implementation
-from cozy.synthesis.core import improve, allow_random_assignment_heuristic
-from cozy.synthesis.enumeration import Enumerator, Fingerprint
+from cozy.synthesis.high_level_interface import max_jobs, job_time_slice, query_priority, log_dir, ImproveQueryJob
+from cozy.synthesis.core import improve, allow_random_assignment_heuristic, improvement_limit
+from cozy.synthesis.enumeration import Enumerator, Fingerprint, ExpCache
+from cozy.synthesis.shared_examples import ExampleStore, SharedExamples, start_example_store
 from cozy.parse import parse_spec
 from cozy.solver import valid, satisfy
 from cozy.pools import RUNTIME_POOL, STATE_POOL
@@ -133,6 +138,128 @@ class TestEnumeration(unittest.TestCase):
         assert not fp1.subset_of(fp2)
         assert fp2.subset_of(fp1)
 
+    def test_add_example(self):
+        """
+        Adding an example to an incremental enumerator should give the same
+        equivalence classes as starting over with all the examples.
+        """
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        context = RootCtx(args=[x, xs])
+        old_examples = [{"x": 0, "xs": Bag(())}]
+        new_example = {"x": 1, "xs": Bag((1, 2))}
+        max_size = 2
+
+        def classes(enumerator):
+            return [
+                set(info.fingerprint for info in enumerator.enumerate_with_info(context, size, RUNTIME_POOL))
+                for size in range(max_size + 1)]
+
+        fresh = Enumerator(
+            examples=old_examples + [new_example],
+            cost_model=CostModel())
+        incremental = Enumerator(
+            examples=old_examples,
+            cost_model=CostModel(),
+            incremental=True)
+
+        for size in range(max_size):
+            for e in incremental.enumerate(context, size, RUNTIME_POOL):
+                pass
+        # abandon an enumeration halfway through
+        for e in incremental.enumerate(context, max_size, RUNTIME_POOL):
+            break
+
+        incremental.add_example(new_example)
+        assert classes(incremental) == classes(fresh)
+
+        with self.assertRaises(ValueError):
+            fresh.add_example(new_example)
+
+    def test_compositional_fingerprints(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        context = RootCtx(state_vars=[xs], args=[x])
+        examples = [
+            {"x": 0, "xs": Bag(())},
+            {"x": 1, "xs": Bag((1, 2))},
+            {"x": 2, "xs": Bag((2, 2, 3))}]
+        enumerator = Enumerator(
+            examples=examples,
+            cost_model=CostModel())
+        count = 0
+        for size in range(3):
+            for pool in (STATE_POOL, RUNTIME_POOL):
+                for info in enumerator.enumerate_with_info(context, size, pool):
+                    assert info.fingerprint == Fingerprint.of(info.e, examples), pprint(info.e)
+                    count += 1
+        assert count > 0
+
+    def test_normalized_fingerprints(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        ys = EVar("ys").with_type(INT_BAG)
+        examples = [
+            {"xs": Bag((1, 2)), "ys": Bag((2, 1))},
+            {"xs": Bag((1, 1)), "ys": Bag((1, 1))}]
+        fps = [Fingerprint.of(e, examples) for e in (xs, ys, EUnaryOp(UOp.Distinct, xs).with_type(INT_BAG))]
+        for fp1 in fps:
+            for fp2 in fps:
+                assert fp1.equal_to(fp2) == (fp1.normalized() == fp2.normalized())
+        assert fps[0] != fps[1]
+        assert fps[0].normalized() == fps[1].normalized()
+
+    def test_enumeration_operand_order(self):
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        context = RootCtx(state_vars=[], args=[x, y])
+        examples = [{"x": 0, "y": 1}, {"x": 2, "y": 2}]
+        enumerator = Enumerator(examples=examples, cost_model=CostModel())
+        leaves = list(enumerator.enumerate(context, 0, RUNTIME_POOL))
+        ints = [e for e in leaves if e.type == INT]
+        sums = [(e.e1, e.e2) for e in enumerator._enumerate_core(context, 1, RUNTIME_POOL)
+            if isinstance(e, EBinOp) and e.op == "+"]
+        # both operands come from the same list of smaller expressions, in order
+        assert sums == [(e1, e2) for e1 in ints for e2 in ints]
+
+    def _enumerate_fingerprints(self, enumerator, context, max_size):
+        res = []
+        for size in range(max_size + 1):
+            for pool in (STATE_POOL, RUNTIME_POOL):
+                res.append(set(info.fingerprint for info in enumerator.enumerate_with_info(context, size, pool)))
+        return res
+
+    def test_cache_spill(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        context = RootCtx(state_vars=[xs], args=[x])
+        examples = [
+            {"x": 0, "xs": Bag(())},
+            {"x": 1, "xs": Bag((1, 2))}]
+        reference = Enumerator(examples=examples, cost_model=CostModel())
+        with tempfile.TemporaryDirectory() as d:
+            enumerator = Enumerator(examples=examples, cost_model=CostModel())
+            enumerator.cache = ExpCache(memory_limit=1, spill_directory=d)
+            for i in range(2):
+                expected = self._enumerate_fingerprints(reference, context, 2)
+                assert self._enumerate_fingerprints(enumerator, context, 2) == expected
+            assert enumerator.cache.spilled_levels > 0
+            assert enumerator.cache.reloaded_levels > 0
+
+    def test_cache_memory_limit(self):
+        x = EVar("x").with_type(INT)
+        xs = EVar("xs").with_type(INT_BAG)
+        context = RootCtx(state_vars=[xs], args=[x])
+        examples = [
+            {"x": 0, "xs": Bag(())},
+            {"x": 1, "xs": Bag((1, 2))}]
+        enumerator = Enumerator(examples=examples, cost_model=CostModel())
+        enumerator.cache = cache = ExpCache(memory_limit=1)
+        for fps in self._enumerate_fingerprints(enumerator, context, 2):
+            assert fps
+        assert cache.evicted_exps > 0
+        assert len(cache) == sum(len(l) for (by_size, _) in cache.data.values() for l in by_size.values())
+        assert cache.memory_used == sum(cache.level_bytes.values())
+
     def test_state_pool_boundary(self):
         """
         When enumerating expressions, we shouldn't ever enumerate state
@@ -287,3 +414,143 @@ class TestSpecificationSynthesis(unittest.TestCase):
         (v, e), = list(impl.concretization_functions.items())
         print("{} = {}".format(v, pprint(e)))
         assert e.type == BOOL
+
+    def test_job_budget(self):
+        spec = """
+            MyDataStructure:
+
+                state elements : Bag<Int>
+
+                query containsZero()
+                    exists [x | x <- elements, x == 0]
+
+                query containsOne()
+                    exists [x | x <- elements, x == 1]
+
+                op addElement(x : Int)
+                    elements.add(x);
+        """
+
+        spec = parse_spec(spec)
+        errs = typecheck(spec)
+        assert not errs, str(errs)
+        spec = desugar(spec)
+
+        impl = construct_initial_implementation(spec)
+        with save_property(max_jobs, "value"):
+            with save_property(job_time_slice, "value"):
+                max_jobs.value = 1
+                job_time_slice.value = 5
+                impl = improve_implementation(impl, timeout=datetime.timedelta(seconds=45))
+
+        print(pprint(impl.code))
+
+        # both queries got a turn, even though only one job ran at a time
+        assert len(impl.concretization_functions) == 2
+        for q in impl.query_impls.values():
+            assert is_constant_time(q.ret), pprint(q)
+
+    def test_query_priority(self):
+        spec = """
+            MyDataStructure:
+
+                state elements : Bag<Int>
+
+                private query size()
+                    sum [1 | x <- elements]
+
+                query first()
+                    sum [x | x <- elements]
+
+                query second()
+                    1
+
+                op addElement(x : Int)
+                    elements.add(x);
+        """
+
+        spec = parse_spec(spec)
+        errs = typecheck(spec)
+        assert not errs, str(errs)
+        spec = desugar(spec)
+
+        impl = construct_initial_implementation(spec)
+        order = [q.name for q in sorted(impl.query_specs, key=lambda q: query_priority(impl, q))]
+        assert order[:2] == ["first", "second"], order
+        assert len(order) > 2, order
+
+    def test_resumed_job_does_not_repeat_solution(self):
+        spec = """
+            MyDataStructure:
+
+                state elements : Bag<Int>
+
+                query size()
+                    sum [1 | x <- elements]
+
+                op addElement(x : Int)
+                    elements.add(x);
+        """
+
+        spec = parse_spec(spec)
+        errs = typecheck(spec)
+        assert not errs, str(errs)
+        spec = desugar(spec)
+
+        impl = construct_initial_implementation(spec)
+        q = impl.query_specs[0]
+        with tempfile.TemporaryDirectory() as d:
+            with save_property(log_dir, "value"):
+                with save_property(improvement_limit, "value"):
+                    log_dir.value = d
+                    improvement_limit.value = 0
+                    for resumed in (False, True):
+                        solutions = queue.Queue()
+                        job = ImproveQueryJob(
+                            impl.abstract_state,
+                            list(impl.spec.assumptions) + list(q.assumptions),
+                            q,
+                            context=impl.context_for_method(q),
+                            solutions_q=solutions,
+                            improve_count=Value("i", 0),
+                            resumed=resumed)
+                        job.run()
+                        assert solutions.qsize() == (0 if resumed else 1)
+
+class TestSharedExamples(unittest.TestCase):
+
+    def test_examples_move_between_contexts(self):
+        xs = EVar("xs").with_type(INT_BAG)
+        x = EVar("x").with_type(INT)
+        y = EVar("y").with_type(INT)
+        ctx1 = RootCtx(state_vars=[xs], args=[x])
+        ctx2 = RootCtx(state_vars=[xs], args=[y])
+
+        store = ExampleStore()
+        job1 = SharedExamples(store)
+        job2 = SharedExamples(store)
+
+        assert job1.publish(ctx1, {"xs": Bag((1, 2)), "x": 5})
+        assert not job1.publish(ctx1, {"xs": Bag((1, 2)), "x": 6})
+        assert job1.publish(ctx1, {"xs": Bag(()), "x": 5})
+        assert len(store) == 2
+
+        # a job never receives its own examples
+        assert job1.receive(ctx1, ETRUE) == []
+
+        # examples that violate the receiving job's assumptions are dropped
+        received = job2.receive(ctx2, EGt(ELen(xs), ZERO))
+        assert received == [{"xs": Bag((1, 2)), "y": 0}], received
+
+        # examples are only delivered once
+        assert job2.receive(ctx2, ETRUE) == []
+
+    def test_store_server(self):
+        manager, store = start_example_store()
+        try:
+            xs = EVar("xs").with_type(INT_BAG)
+            ctx = RootCtx(state_vars=[xs])
+            assert SharedExamples(store).publish(ctx, {"xs": Bag((1,))})
+            assert SharedExamples(store).receive(ctx, ETRUE) == [{"xs": Bag((1,))}]
+        finally:
+            manager.shutdown()